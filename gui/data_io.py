@@ -5,11 +5,22 @@
 @Time : 2020/12/1 16:00
 @Desc :
 '''
+import os
+import weakref
 import scipy.io as sio
+from mne.io import BaseRaw
 
-def write_raw_edf(fname, raw):
-    """Export raw to EDF/BDF file (requires pyEDFlib)."""
+def write_raw_edf(fname, raw, chunk_duration=60, progress=None):
+    """Export raw to EDF/BDF file (requires pyEDFlib).
+
+    The data is streamed from raw (preloaded, memory-mapped or lazily read)
+    in chunks of chunk_duration seconds: one pass gets the physical range of
+    every channel, a second pass writes the data records. progress, if
+    given, is called with the finished percentage. If writing fails or
+    progress raises to cancel it, the partial file is removed.
+    """
     from pathlib import Path
+    import numpy as np
     import pyedflib
 
     ext = "".join(Path(fname).suffixes)
@@ -19,8 +30,14 @@ def write_raw_edf(fname, raw):
     elif ext == ".bdf":
         filetype = pyedflib.FILETYPE_BDFPLUS
         dmin, dmax = -8388608, 8388607
-    data = raw.get_data() * 1e6  # convert to microvolts
+    else:
+        raise ValueError('File name should end with .edf or .bdf')
     fs = raw.info["sfreq"]
+    n_times = raw.n_times
+    # chunks hold whole data records of one second
+    chunk = max(int(chunk_duration), 1) * int(round(fs))
+    starts = list(range(0, n_times, chunk))
+    n_steps = 2 * len(starts)
     nchan = raw.info["nchan"]
     ch_names = raw.info["ch_names"]
     if raw.info["meas_date"] is not None:
@@ -29,10 +46,17 @@ def write_raw_edf(fname, raw):
         meas_date = None
     prefilter = (f"{raw.info['highpass']}Hz - "
                  f"{raw.info['lowpass']}")
-    pmin, pmax = data.min(axis=1), data.max(axis=1)
+    pmin, pmax = np.full(nchan, np.inf), np.full(nchan, -np.inf)
+    for step, start in enumerate(starts):
+        data = raw.get_data(start=start, stop=min(start + chunk, n_times))
+        pmin = np.minimum(pmin, data.min(axis=1) * 1e6)  # convert to microvolts
+        pmax = np.maximum(pmax, data.max(axis=1) * 1e6)
+        if progress is not None:
+            progress(int(100 * (step + 1) / n_steps))
+    # a flat channel still needs a valid physical range
+    pmax[pmax <= pmin] = pmin[pmax <= pmin] + 1
     f = pyedflib.EdfWriter(fname, nchan, filetype)
     channel_info = []
-    data_list = []
     for i in range(nchan):
         channel_info.append(dict(label=ch_names[i],
                                  dimension="uV",
@@ -43,40 +67,951 @@ def write_raw_edf(fname, raw):
                                  digital_max=dmax,
                                  transducer="",
                                  prefilter=prefilter))
-        data_list.append(data[i])
-    f.setTechnician("Exported by MNELAB")
-    f.setSignalHeaders(channel_info)
-    if raw.info["meas_date"] is not None:
-        f.setStartdatetime(meas_date)
-    # note that currently, only blocks of whole seconds can be written
-    f.writeSamples(data_list)
-    for ann in raw.annotations:
-        f.writeAnnotation(ann["onset"], ann["duration"], ann["description"])
+    try:
+        f.setTechnician("Exported by MNELAB")
+        f.setSignalHeaders(channel_info)
+        if raw.info["meas_date"] is not None:
+            f.setStartdatetime(meas_date)
+        # note that currently, only blocks of whole seconds can be written
+        for step, start in enumerate(starts):
+            data = raw.get_data(start=start, stop=min(start + chunk, n_times)) * 1e6
+            f.writeSamples(list(data))
+            if progress is not None:
+                progress(int(100 * (len(starts) + step + 1) / n_steps))
+        for ann in raw.annotations:
+            f.writeAnnotation(ann["onset"], ann["duration"], ann["description"])
+    except BaseException:
+        f.close()
+        os.remove(fname)
+        raise
+    f.close()
 
 
-def write_raw_set(fname, raw):
-        """Export raw to EEGLAB .set file."""
+def write_raw_set(fname, raw, chunk_duration=60, progress=None):
+        """Export raw or epochs to EEGLAB .set file.
+
+        The .set file only holds the header, the data is streamed in chunks to
+        a float32 .fdt file next to it, so that no full copy of the data is
+        made. Epochs are written with trials > 1. progress, if given, is
+        called with the finished percentage. If writing the .fdt file fails
+        or progress raises to cancel it, the partial file is removed.
+        """
+        import numpy as np
         from numpy.core.records import fromarrays
-        data = raw.get_data() * 1e6  # convert to microvolts
+        from mne import BaseEpochs
+
+        if not fname.endswith('.set'):
+            fname += '.set'
+        fdt_name = os.path.splitext(fname)[0] + '.fdt'
         fs = raw.info["sfreq"]
         times = raw.times
         ch_names = raw.info["ch_names"]
         chanlocs = fromarrays([ch_names], names=["labels"])
-        events = fromarrays([raw.annotations.description,
-                             raw.annotations.onset * fs + 1,
-                             raw.annotations.duration * fs],
-                            names=["type", "latency", "duration"])
-        sio.savemat(fname + '.set', dict(EEG=dict(data=data,
-                                     setname=fname,
-                                     nbchan=data.shape[0],
-                                     pnts=data.shape[1],
-                                     trials=1,
-                                     srate=fs,
-                                     xmin=times[0],
-                                     xmax=times[-1],
-                                     chanlocs=chanlocs,
-                                     event=events,
-                                     icawinv=[],
-                                     icasphere=[],
-                                     icaweights=[])),
-                                     appendmat=False)
\ No newline at end of file
+        epoched = isinstance(raw, BaseEpochs)
+
+        # .fdt holds float32 (n_chan, n_samples) in column-major order,
+        # i.e. all the channels of one sample after another
+        try:
+            with open(fdt_name, 'wb') as fdt:
+                if epoched:
+                    if not raw.preload:
+                        # the number of trials is only known after reading
+                        raw.drop_bad()
+                    trials = len(raw)
+                    for step, epoch in enumerate(raw):
+                        (epoch.T * 1e6).astype('<f4').tofile(fdt)  # convert to microvolts
+                        if progress is not None:
+                            progress(int(100 * (step + 1) / trials))
+                else:
+                    trials = 1
+                    chunk = max(int(chunk_duration * fs), 1)
+                    starts = range(0, raw.n_times, chunk)
+                    for step, start in enumerate(starts):
+                        data = raw.get_data(start=start, stop=min(start + chunk, raw.n_times))
+                        (data.T * 1e6).astype('<f4').tofile(fdt)  # convert to microvolts
+                        if progress is not None:
+                            progress(int(100 * (step + 1) / len(starts)))
+        except BaseException:
+            os.remove(fdt_name)
+            raise
+
+        pnts = len(times)
+        if epoched:
+            # every epoch holds its event at time 0
+            id_name = {value: key for key, value in raw.event_id.items()}
+            types = [id_name.get(event, str(event)) for event in raw.events[:, 2]]
+            zero = int(round(-times[0] * fs))
+            latency = np.arange(trials) * pnts + zero + 1
+            events = fromarrays([types, latency, np.zeros(trials),
+                                 np.arange(1, trials + 1)],
+                                names=["type", "latency", "duration", "epoch"])
+            epoch = fromarrays([np.arange(1, trials + 1), types, np.zeros(trials)],
+                               names=["event", "eventtype", "eventlatency"])
+        else:
+            events = fromarrays([raw.annotations.description,
+                                 raw.annotations.onset * fs + 1,
+                                 raw.annotations.duration * fs],
+                                names=["type", "latency", "duration"])
+            epoch = []
+        setname = os.path.splitext(os.path.basename(fname))[0]
+        sio.savemat(fname, dict(EEG=dict(data=os.path.basename(fdt_name),
+                                         datfile=os.path.basename(fdt_name),
+                                         setname=setname,
+                                         filename=os.path.basename(fname),
+                                         filepath=os.path.dirname(os.path.abspath(fname)),
+                                         nbchan=len(ch_names),
+                                         pnts=pnts,
+                                         trials=trials,
+                                         srate=fs,
+                                         xmin=times[0],
+                                         xmax=times[-1],
+                                         chanlocs=chanlocs,
+                                         event=events,
+                                         epoch=epoch,
+                                         icawinv=[],
+                                         icasphere=[],
+                                         icaweights=[])),
+                    appendmat=False)
+
+# id to weak reference of every RawHDF5 alive, so that a workspace is not
+# changed under their lazy reads (mne raws are not hashable)
+_live_raws = dict()
+
+
+def _track_raw(raw):
+    key = id(raw)
+    _live_raws[key] = weakref.ref(raw, lambda ref: _live_raws.pop(key, None))
+
+
+class RawHDF5(BaseRaw):
+    """Raw data stored in a workspace file, samples are read on demand."""
+
+    def __init__(self, fname, path, verbose=None):
+        import json
+        import h5py
+        import numpy as np
+        from datetime import datetime, timezone
+        from mne import create_info, Annotations
+
+        with h5py.File(fname, 'r') as f:
+            group = f[path]
+            info = create_info(json.loads(group.attrs['ch_names']), float(group.attrs['sfreq']),
+                               json.loads(group.attrs['ch_types']))
+            info['highpass'] = float(group.attrs['highpass'])
+            info['lowpass'] = float(group.attrs['lowpass'])
+            info['bads'] = json.loads(group.attrs['bads'])
+            first_samp = int(group.attrs['first_samp'])
+            n_times = group['data'].shape[1]
+            meas_date = group.attrs['meas_date']
+            if 'onset' in group:
+                annotations = (group['onset'][()], group['duration'][()],
+                               json.loads(group.attrs['description']),
+                               bool(group.attrs['orig_time']))
+            else:
+                annotations = None
+        super(RawHDF5, self).__init__(info, preload=False, first_samps=(first_samp,),
+                                      last_samps=(first_samp + n_times - 1,),
+                                      filenames=(fname,), raw_extras=[dict(path=path, first_samp=first_samp)],
+                                      orig_format='double', dtype=np.float64, verbose=verbose)
+        if not np.isnan(meas_date):
+            self.set_meas_date(datetime.fromtimestamp(meas_date, timezone.utc))
+        if annotations is not None:
+            onset, duration, description, orig_time = annotations
+            self.set_annotations(Annotations(onset, duration, description,
+                                             orig_time=self.info['meas_date'] if orig_time else None))
+        _track_raw(self)
+
+    def __deepcopy__(self, memo):
+        # copies and crops read the same group, they are tracked as well
+        from copy import deepcopy
+
+        result = self.__class__.__new__(self.__class__)
+        memo[id(self)] = result
+        for key, value in self.__dict__.items():
+            result.__dict__[key] = deepcopy(value, memo)
+        _track_raw(result)
+        return result
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        """Read a chunk of raw data."""
+        import h5py
+        from mne.io.utils import _mult_cal_one
+
+        # start and stop count from the first sample of the recording
+        offset = self._raw_extras[fi]['first_samp']
+        with h5py.File(self._filenames[fi], 'r') as f:
+            one = f[self._raw_extras[fi]['path']]['data'][:, start - offset:stop - offset]
+        _mult_cal_one(data, one, idx, cals, mult)
+
+
+def _lazy_reads(raw, fname, paths=None):
+    """Whether raw reads samples from the groups paths (all if None) of fname."""
+    if raw.preload:
+        return False
+    return any(os.path.abspath(name) == fname and (paths is None or extra['path'] in paths)
+               for name, extra in zip(raw._filenames, raw._raw_extras))
+
+
+def _release_groups(fname, paths=None, keep=()):
+    """Load the lazy RawHDF5 reading the groups of fname that are removed.
+
+    paths are the HDF5 groups about to be removed or replaced, None for the
+    whole file. The raws whose id is in keep are left to the caller, which
+    points them to the group their samples were just written to.
+    """
+    for ref in list(_live_raws.values()):
+        raw = ref()
+        if raw is not None and id(raw) not in keep and _lazy_reads(raw, fname, paths):
+            raw.load_data()
+
+
+def _own_group(seeg):
+    """The RawHDF5 of a raw SEEG whose samples can be read from where it is saved."""
+    data = seeg.data
+    if seeg.mode == 'raw' and isinstance(data, RawHDF5) and not data.preload and \
+            len(data._filenames) == 1:
+        return data
+    return None
+
+
+def _point_raw(raw, fname, path):
+    """Read the samples of a single-file RawHDF5 from the group it was written to."""
+    raw._filenames = [fname]
+    raw._raw_extras[0] = dict(path=path, first_samp=raw.first_samp)
+
+
+def _seeg_signature(seeg):
+    """The header of a SEEG, written to its group and compared by _is_unchanged.
+
+    The samples are not checked: the code changing them in place calls
+    seeg.modified() instead, see _is_unchanged.
+    """
+    import json
+    import zlib
+    import numpy as np
+
+    data = seeg.data
+    if seeg.mode == 'raw':
+        annotations = data.annotations
+        extra = [data.n_times, data.first_samp, len(annotations),
+                 zlib.crc32(np.asarray(annotations.onset, dtype=np.float64).tobytes() +
+                            np.asarray(annotations.duration, dtype=np.float64).tobytes() +
+                            json.dumps([str(des) for des in annotations.description]).encode())]
+    else:
+        extra = [len(data.events), data.tmin, data.tmax]
+    return json.dumps([seeg.mode, data.info['sfreq'], data.info['ch_names'], data.info['bads'],
+                       extra, seeg.data_para, seeg.provenance,
+                       None if seeg.events is None else np.asarray(seeg.events).shape],
+                      default=str)
+
+
+def _is_unchanged(group, seeg):
+    """Whether the SEEG is the same as the one written to the HDF5 group.
+
+    It is if the group is where the SEEG was last saved or loaded from, it
+    has not been modified since, and its header is the same.
+    """
+    saved = (os.path.abspath(group.file.filename), group.name, seeg.version)
+    return seeg.saved == saved and group.attrs.get('signature') == _seeg_signature(seeg)
+
+
+def _repack(fname, ratio=2.):
+    """Rewrite a workspace that is mostly space left by removed groups.
+
+    h5py never reclaims the space of deleted groups. The groups are copied
+    to a new file under the same paths, so lazy reads stay valid after it
+    replaces fname. Returns whether the file is rewritten.
+    """
+    import h5py
+
+    used = []
+    with h5py.File(fname, 'r') as f:
+        f.visititems(lambda name, obj: used.append(obj.id.get_storage_size())
+                     if isinstance(obj, h5py.Dataset) else None)
+    if os.path.getsize(fname) < ratio * sum(used) + 2 ** 20:
+        return False
+    tmp_name = fname + '.tmp'
+    try:
+        with h5py.File(fname, 'r') as src, h5py.File(tmp_name, 'w') as dst:
+            for key, value in src.attrs.items():
+                dst.attrs[key] = value
+            for name in src:
+                src.copy(src[name], dst, name=name)
+        os.replace(tmp_name, fname)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    return True
+
+
+def _write_seeg(group, seeg, chunk_duration, progress=None):
+    """Write one SEEG to an HDF5 group, the samples are streamed in chunks."""
+    import json
+    import numpy as np
+    from mne.io.pick import channel_type
+
+    data, info = seeg.data, seeg.data.info
+    group.attrs['signature'] = _seeg_signature(seeg)
+    group.attrs['name'] = seeg.name
+    group.attrs['mode'] = seeg.mode
+    group.attrs['data_para'] = json.dumps(seeg.data_para)
+    group.attrs['provenance'] = json.dumps(seeg.provenance)
+    group.attrs['sfreq'] = info['sfreq']
+    group.attrs['ch_names'] = json.dumps(info['ch_names'])
+    group.attrs['ch_types'] = json.dumps([channel_type(info, i) for i in range(info['nchan'])])
+    group.attrs['highpass'] = info['highpass']
+    group.attrs['lowpass'] = info['lowpass']
+    group.attrs['bads'] = json.dumps(info['bads'])
+    group.attrs['meas_date'] = np.nan if info['meas_date'] is None else info['meas_date'].timestamp()
+    if seeg.events is not None:
+        group.create_dataset('events', data=np.asarray(seeg.events))
+
+    if seeg.mode == 'raw':
+        group.attrs['first_samp'] = data.first_samp
+        group.create_dataset('onset', data=data.annotations.onset)
+        group.create_dataset('duration', data=data.annotations.duration)
+        group.attrs['description'] = json.dumps([str(des) for des in data.annotations.description])
+        group.attrs['orig_time'] = data.annotations.orig_time is not None
+        n_samples = data.n_times
+    else:
+        if not data.preload:
+            # the number of epochs is only known after reading
+            data.drop_bad()
+        # epochs are stored one after another as a continuous recording
+        group.attrs['first_samp'] = 0
+        group.attrs['tmin'] = data.tmin
+        group.attrs['tmax'] = data.tmax
+        group.attrs['event_id'] = json.dumps(data.event_id)
+        group.create_dataset('epoch_events', data=data.events)
+        n_samples = len(data) * len(data.times)
+    chunk = min(n_samples, max(int(chunk_duration * info['sfreq']), 1))
+    dset = group.create_dataset('data', shape=(info['nchan'], n_samples), dtype=np.float64,
+                                chunks=(1, chunk), compression='gzip', compression_opts=4,
+                                shuffle=True)
+    if seeg.mode == 'raw':
+        starts = range(0, n_samples, chunk)
+        for step, start in enumerate(starts):
+            stop = min(start + chunk, n_samples)
+            dset[:, start:stop] = data.get_data(start=start, stop=stop)
+            if progress is not None:
+                progress((step + 1) / len(starts))
+    else:
+        n_times = len(data.times)
+        for step, epoch in enumerate(data):
+            dset[:, step * n_times:(step + 1) * n_times] = epoch
+            if progress is not None:
+                progress((step + 1) / len(data))
+
+
+def save_workspace(fname, subject, chunk_duration=60, progress=None):
+    """Save Subject/SEEG trees to a chunked, compressed HDF5 workspace.
+
+    subject is a dict of Subject objects, from another thread a snapshot of
+    those of the main window, see snapshot_workspace. Every SEEG is stored
+    with its events, data_para and provenance, the samples are streamed
+    from the source in chunks of chunk_duration seconds. The file is
+    written next to fname, so that data lazily read from an old workspace
+    at fname stays valid while saving; it replaces fname once the returned
+    plan is given to commit_workspace, on the thread owning the data.
+    progress, if given, is called with the finished percentage. If saving
+    fails or progress raises to cancel it, fname is left as it was.
+    """
+    import h5py
+
+    if not fname.endswith('.h5'):
+        fname += '.h5'
+    fname = os.path.abspath(fname)
+    items = [(name, key, subject[name].seeg[key]) for name in subject for key in subject[name].seeg]
+    tmp_name = fname + '.tmp'
+    try:
+        with h5py.File(tmp_name, 'w') as f:
+            f.attrs['format'] = 'PACS workspace'
+            f.attrs['version'] = 1
+            for name in subject:
+                group = f.create_group('subject/' + name)
+                group.attrs['name'] = name
+                if subject[name].group is not None:
+                    group.attrs['group'] = str(subject[name].group)
+                group.create_group('seeg')
+            for step, (name, key, seeg) in enumerate(items):
+                def seeg_progress(done, step=step):
+                    if progress is not None:
+                        progress(int(100 * (step + done) / len(items)))
+                _write_seeg(f['subject/' + name + '/seeg'].create_group(key),
+                            seeg, chunk_duration, seeg_progress)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    return dict(fname=fname, tmp_name=tmp_name, written=items)
+
+
+def update_workspace(fname, subject, chunk_duration=60, progress=None):
+    """Incrementally save Subject/SEEG trees to an HDF5 workspace.
+
+    subject is a snapshot of the Subject objects of the main window, see
+    snapshot_workspace. Only the SEEG entries that are new or modified
+    since they were last written (see _is_unchanged) are written, to
+    temporary groups. Nothing the main window uses is changed here: the
+    returned plan is given to commit_workspace on the GUI thread, which
+    removes the old groups and the entries that no longer exist. The file
+    is repacked first once the groups removed by the last commit take most
+    of it.
+    """
+    import h5py
+
+    if not fname.endswith('.h5'):
+        fname += '.h5'
+    fname = os.path.abspath(fname)
+    if os.path.exists(fname):
+        # the paths are kept, so lazy reads stay valid
+        _repack(fname)
+    items = [(name, key, seeg) for name, sub in subject.items() for key, seeg in sub.seeg.items()]
+    with h5py.File(fname, 'a') as f:
+        f.attrs['format'] = 'PACS workspace'
+        f.attrs['version'] = 1
+        root = f.require_group('subject')
+        changed = []
+        for name, key, seeg in items:
+            group = root.require_group(name)
+            group.attrs['name'] = name
+            if subject[name].group is not None:
+                group.attrs['group'] = str(subject[name].group)
+            group = group.require_group('seeg')
+            if not (key in group and _is_unchanged(group[key], seeg)):
+                changed.append((name, key, seeg))
+        for step, (name, key, seeg) in enumerate(changed):
+            def seeg_progress(done, step=step):
+                if progress is not None:
+                    progress(int(100 * (step + done) / len(changed)))
+            group = root[name]['seeg']
+            if key + '.tmp' in group:
+                del group[key + '.tmp']
+            _write_seeg(group.create_group(key + '.tmp'), seeg, chunk_duration, seeg_progress)
+        # the groups of the removed entries, of the replaced ones and the
+        # temporary groups left by an interrupted update
+        new = set('/subject/' + name + '/seeg/' + key + '.tmp' for name, key, _ in changed)
+        kept = set('/subject/' + name + '/seeg/' + key for name, key, _ in items) - \
+            set(path[:-len('.tmp')] for path in new)
+        removed = [group.name for name in root for group in root[name]['seeg'].values()
+                   if group.name not in kept and group.name not in new]
+        f.flush()
+    return dict(fname=fname, tmp_name=None, written=changed, removed=removed,
+                subjects=list(subject))
+
+
+def commit_workspace(plan, pairs=()):
+    """Finish a save_workspace or an update_workspace on the GUI thread.
+
+    The raws still reading the groups or the file replaced are loaded into
+    memory, or pointed to the group their samples were just written to;
+    only then are the old groups removed and the new ones moved in place,
+    or the new file replaces the old one. pairs are the (SEEG, copy) of
+    snapshot_workspace: the saved state goes to the SEEG each copy was
+    taken from, unless it was modified since. Returns the list of
+    (subject name, key) written.
+    """
+    import h5py
+
+    fname = plan['fname']
+    removed = None if plan['tmp_name'] is not None else plan['removed']
+    origin = dict((id(copy), seeg) for seeg, copy in pairs)
+    entries = []
+    for name, key, copy in plan['written']:
+        seeg = origin.get(id(copy), copy)
+        if seeg.version == copy.version:
+            entries.append((seeg, '/subject/' + name + '/seeg/' + key))
+    moved = [(_own_group(seeg), path) for seeg, path in entries]
+    moved = [(raw, path) for raw, path in moved
+             if raw is not None and _lazy_reads(raw, fname, removed)]
+    _release_groups(fname, removed, keep=[id(raw) for raw, _ in moved])
+    if plan['tmp_name'] is not None:
+        os.replace(plan['tmp_name'], fname)
+    else:
+        with h5py.File(fname, 'a') as f:
+            root = f['subject']
+            for path in removed:
+                del f[path]
+            for name in list(root):
+                if name not in plan['subjects']:
+                    del root[name]
+            for name, key, _ in plan['written']:
+                root[name]['seeg'].move(key + '.tmp', key)
+    for raw, path in moved:
+        _point_raw(raw, fname, path)
+    for seeg, path in entries:
+        seeg.saved = (fname, path, seeg.version)
+    return [(name, key) for name, key, _ in plan['written']]
+
+
+def _header_copy(data):
+    """A shallow copy of raw or epochs with its own header.
+
+    The header (info, annotations, events) can be read from another
+    thread while the original one is edited, and reading epochs changes
+    only the copy. The samples are shared: in memory, memory-mapped or read
+    lazily, they are never changed in place, see SEEG.modified.
+    """
+    from copy import copy
+
+    out = copy(data)
+    out.info = data.info.copy()
+    if isinstance(data, BaseRaw):
+        out._annotations = data.annotations.copy()
+    else:
+        out.events = data.events.copy()
+        out.selection = data.selection.copy()
+        out.event_id = dict(data.event_id)
+    return out
+
+
+def snapshot_workspace(subject):
+    """A copy of Subject/SEEG trees that save_workspace or update_workspace can write from another thread.
+
+    It is taken on the GUI thread. Only the headers are copied, see
+    _header_copy, so it is quick whatever the size of the data. Returns the
+    copy and the list of (SEEG, its copy) for commit_workspace.
+    """
+    import numpy as np
+    from copy import deepcopy
+    try:
+        from gui.my_class import Subject, SEEG
+    except:
+        from my_class import Subject, SEEG
+
+    snapshot, pairs = dict(), []
+    for name, sub in subject.items():
+        snapshot[name] = Subject(name=name, group=sub.group)
+        for key, seeg in sub.seeg.items():
+            copy = SEEG(name=seeg.name, data=_header_copy(seeg.data), mode=seeg.mode,
+                        events=None if seeg.events is None else np.array(seeg.events))
+            copy.data_para = deepcopy(seeg.data_para)
+            copy.provenance = deepcopy(seeg.provenance)
+            copy.version, copy.saved = seeg.version, seeg.saved
+            snapshot[name].seeg[key] = copy
+            pairs.append((seeg, copy))
+    return snapshot, pairs
+
+
+def load_workspace(fname):
+    """Open an HDF5 workspace, only headers are read.
+
+    Returns a dict of Subject objects. Raw data is an instance of RawHDF5
+    and epochs are mne.Epochs on top of it, so the samples are read per
+    chunk when they are used.
+    """
+    import json
+    import h5py
+    import numpy as np
+    from mne import Epochs
+    try:
+        from gui.my_class import Subject, SEEG
+    except:
+        from my_class import Subject, SEEG
+
+    fname = os.path.abspath(fname)
+    subject = dict()
+    with h5py.File(fname, 'r') as f:
+        if not f.attrs.get('format') == 'PACS workspace':
+            raise ValueError('This is not a workspace file')
+        for name, group in f['subject'].items():
+            subject[name] = Subject(name=name, group=group.attrs.get('group'))
+            for key, seeg_group in group['seeg'].items():
+                if key.endswith('.tmp'):
+                    # left by an interrupted update_workspace
+                    continue
+                attrs = dict(seeg_group.attrs)
+                data = RawHDF5(fname, seeg_group.name)
+                if attrs['mode'] == 'epoch':
+                    epoch_events = seeg_group['epoch_events'][()]
+                    n_times = int(round((attrs['tmax'] - attrs['tmin']) * attrs['sfreq'])) + 1
+                    events = epoch_events.copy()
+                    events[:, 0] = np.arange(len(events)) * n_times - \
+                        int(round(attrs['tmin'] * attrs['sfreq']))
+                    data = Epochs(data, events, event_id=json.loads(attrs['event_id']),
+                                  tmin=attrs['tmin'], tmax=attrs['tmax'], baseline=None,
+                                  reject_by_annotation=False, preload=False)
+                seeg = SEEG(name=key, data=data, mode=attrs['mode'],
+                            events=seeg_group['events'][()] if 'events' in seeg_group else None)
+                seeg.data_para = json.loads(attrs['data_para'])
+                seeg.provenance = json.loads(attrs['provenance'])
+                seeg.saved = (fname, seeg_group.name, seeg.version)
+                subject[name].seeg[key] = seeg
+    return subject
+
+
+def read_raw_file(fname, preload=True):
+    """Read a raw recording with the mne reader matching its extension."""
+    from mne import io
+
+    if fname[-3:] == 'set':
+        return io.read_raw_eeglab(fname, preload=preload)
+    elif fname[-3:] == 'edf':
+        return io.read_raw_edf(fname, preload=preload)
+    elif fname[-3:] == 'fif':
+        return io.read_raw_fif(fname, preload=preload)
+    elif fname[-4:] == 'vhdr':
+        return io.read_raw_brainvision(fname, preload=preload)
+    raise ValueError('Only .set, .edf, .fif and .vhdr files are supported')
+
+
+def load_raw_chunked(raw, preload=True, chunk_duration=10, progress=None):
+    """Load the samples of a raw read with preload=False chunk by chunk.
+
+    The same as raw.load_data(preload), but progress, if given, is called
+    after every chunk with the bytes loaded so far and the total bytes.
+    """
+    import numpy as np
+
+    if raw.preload:
+        return raw
+    n_chan, n_times = len(raw.ch_names), raw.n_times
+    if preload is True:
+        data = np.empty((n_chan, n_times), raw._dtype)
+    else:
+        data = np.memmap(str(preload), mode='w+', dtype=raw._dtype, shape=(n_chan, n_times))
+    item_bytes = n_chan * data.itemsize
+    step = max(int(chunk_duration * raw.info['sfreq']), 1)
+    for start in range(0, n_times, step):
+        stop = min(start + step, n_times)
+        raw._read_segment(start, stop, data_buffer=data[:, start:stop],
+                          projector=raw._projector)
+        if progress is not None:
+            progress(stop * item_bytes, n_times * item_bytes)
+    raw._data = data
+    raw.preload = True
+    raw._comp = None
+    raw.close()
+    return raw
+
+
+def raw_like(raw, data, sfreq=None, lengths=None):
+    """A copy of raw holding data, e.g. a np.memmap, as its samples.
+
+    The samples of raw are neither copied nor loaded. If sfreq is given,
+    data is raw resampled to sfreq and lengths are the numbers of samples
+    of the raws concatenated in it; the first samples are then rescaled as
+    raw.resample does.
+    """
+    import numpy as np
+
+    if raw.preload:
+        samples, raw._data = raw._data, None
+        try:
+            out = raw.copy()
+        finally:
+            raw._data = samples
+    else:
+        out = raw.copy()
+    out._data = data
+    out.preload = True
+    # the samples given are read with the compensation already applied
+    out._comp = None
+    if sfreq is not None:
+        ratio = float(sfreq) / raw.info['sfreq']
+        out._first_samps = (np.asarray(out._first_samps) * ratio).astype(int)
+        out._last_samps = out._first_samps + np.asarray(lengths, int) - 1
+        out.info['sfreq'] = float(sfreq)
+        lowpass = out.info['lowpass']
+        out.info['lowpass'] = min(np.inf if lowpass is None else lowpass, sfreq / 2.)
+        out._update_times()
+    out.close()
+    return out
+
+
+def raw_memmap(raw, fname):
+    """A copy of raw holding its samples in a new np.memmap file fname.
+
+    The samples of raw are neither copied nor loaded, the memmap is zeros
+    to be filled by the caller, e.g. chunk by chunk.
+    """
+    import numpy as np
+
+    data = np.memmap(str(fname), mode='w+', dtype=np.float64,
+                     shape=(len(raw.ch_names), raw.n_times))
+    return raw_like(raw, data)
+
+
+# files made by memmap_fname and not removed yet, and those already
+# taken by the data they hold
+_memmap_files = set()
+_taken_memmaps = set()
+# files removed while still mapped, e.g. on Windows, retried later
+_stale_memmaps = []
+
+
+def memmap_fname(prefix, raw=None, dirname=None):
+    """A new file for the np.memmap written by a job on raw.
+
+    The file is in dirname, else next to the file raw is read from (the
+    workspace for data opened from one), else in ~/.pacs_streams; not in
+    the temporary directory, which is often in memory. The data holding
+    it takes it with take_memmap.
+    """
+    import tempfile
+
+    if dirname is None and raw is not None:
+        for source in raw.filenames:
+            if source is not None and os.access(os.path.dirname(os.path.abspath(source)),
+                                                os.W_OK):
+                dirname = os.path.dirname(os.path.abspath(source))
+                break
+    if dirname is None:
+        dirname = os.path.join(os.path.expanduser('~'), '.pacs_streams')
+    os.makedirs(dirname, exist_ok=True)
+    handle, fname = tempfile.mkstemp(prefix=prefix, suffix='.dat', dir=dirname)
+    os.close(handle)
+    _memmap_files.add(os.path.abspath(fname))
+    return fname
+
+
+def take_memmap(raw):
+    """The file of memmap_fname holding the samples of raw, None if raw is
+    in memory or its file is already taken. The caller removes the file
+    with remove_memmap once raw is dropped."""
+    fname = getattr(getattr(raw, '_data', None), 'filename', None)
+    if fname is None:
+        return None
+    fname = os.path.abspath(fname)
+    if fname not in _memmap_files or fname in _taken_memmaps:
+        return None
+    _taken_memmaps.add(fname)
+    return fname
+
+
+def remove_memmap(fname=None):
+    """Remove the file of a np.memmap, and retry the files that were still
+    mapped; None only retries."""
+    if fname is not None:
+        fname = os.path.abspath(fname)
+        _memmap_files.discard(fname)
+        _taken_memmaps.discard(fname)
+        _stale_memmaps.append(fname)
+    for name in list(_stale_memmaps):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # still mapped by some data
+            continue
+        _stale_memmaps.remove(name)
+
+
+def remove_memmaps():
+    """Remove every file of memmap_fname, on exit."""
+    for fname in list(_memmap_files):
+        remove_memmap(fname)
+
+
+def _read_raw_timed(fname):
+    """Read one recording in a worker process, return it with the time spent."""
+    import time
+
+    start = time.time()
+    raw = read_raw_file(fname, preload=True)
+    raw.set_channel_types({ch_name: 'seeg' for ch_name in raw.ch_names})
+    return raw, time.time() - start
+
+
+def _contiguous(raw_0, raw_1, tolerance=1.):
+    """Whether raw_1 starts where raw_0 ends, EDF start times have a
+    resolution of one second so tolerance is in seconds."""
+    from datetime import timedelta
+
+    if raw_0.info['meas_date'] is None or raw_1.info['meas_date'] is None:
+        return False
+    if not (raw_0.ch_names == raw_1.ch_names and raw_0.info['sfreq'] == raw_1.info['sfreq']):
+        return False
+    end = raw_0.info['meas_date'] + timedelta(seconds=raw_0.n_times / raw_0.info['sfreq'])
+    return abs((raw_1.info['meas_date'] - end).total_seconds()) <= tolerance
+
+
+def batch_read_raw(fnames, n_jobs=None, concat=False, callback=None):
+    """Read a batch of raw recordings on a process pool.
+
+    Files are decoded in parallel and returned in the order of their names.
+    If concat, contiguous segments (same channels and sampling rate, each
+    starting where the previous one ends) are concatenated into one raw.
+    callback, if given, is called after every file with a dict of its path,
+    size (MB), time (s) and throughput (MB/s) and the number of files done.
+    :return: list of dict(name, raw, path), path is the list of files
+    """
+    import time
+    from multiprocessing import cpu_count
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from mne import concatenate_raws
+
+    fnames = sorted(fnames)
+    if n_jobs is None:
+        n_jobs = max(cpu_count() - 1, 1)
+    n_jobs = min(n_jobs, len(fnames))
+    raws = [None] * len(fnames)
+
+    def report(index, seconds):
+        size = os.path.getsize(fnames[index]) / 2 ** 20
+        info = dict(path=fnames[index], size=size, time=seconds,
+                    throughput=size / max(seconds, 1e-6), done=sum(raw is not None for raw in raws),
+                    total=len(fnames))
+        print('{path}: {size:.1f} MB in {time:.2f} s, {throughput:.1f} MB/s'.format(**info))
+        catalog_para(fnames[index], raws[index], annotation_events(raws[index]))
+        if callback is not None:
+            callback(info)
+
+    start = time.time()
+    if n_jobs <= 1:
+        for index, fname in enumerate(fnames):
+            raws[index], seconds = _read_raw_timed(fname)
+            report(index, seconds)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(_read_raw_timed, fname): index
+                       for index, fname in enumerate(fnames)}
+            try:
+                for future in as_completed(futures):
+                    raws[futures[future]], seconds = future.result()
+                    report(futures[future], seconds)
+            except BaseException:
+                # e.g. cancelled from the callback, the files not started
+                # yet are dropped instead of being decoded on exit
+                for future in futures:
+                    future.cancel()
+                raise
+    total = sum(os.path.getsize(fname) for fname in fnames) / 2 ** 20
+    print('{} files, {:.1f} MB in {:.2f} s'.format(len(fnames), total, time.time() - start))
+
+    groups = []
+    for index, raw in enumerate(raws):
+        if concat and len(groups) and _contiguous(raws[groups[-1][-1]], raw):
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+    result = []
+    for group in groups:
+        raw = raws[group[0]]
+        if len(group) > 1:
+            raw = concatenate_raws([raws[index] for index in group])
+        name = os.path.splitext(os.path.basename(fnames[group[0]]))[0]
+        result.append(dict(name=name, raw=raw, path=[fnames[index] for index in group]))
+    return result
+
+
+def annotation_events(raw):
+    """Events of the numeric annotations of raw, None if there is none."""
+    from mne import events_from_annotations
+
+    des = list(set(raw.annotations.description))
+    try:
+        event_id = {str(mark): int(mark) for mark in des}
+        events, _ = events_from_annotations(raw, event_id=event_id)
+    except:
+        return None
+    return events
+
+
+def header_para(raw, events=None):
+    """The data_para of a raw from its header, the samples are not read."""
+    para = dict()
+    para['epoch_num'] = str(1)
+    para['sfreq'] = str(raw.info['sfreq'])
+    para['chan_num'] = str(raw.info['nchan'])
+    para['epoch_start'] = str(raw._first_time)
+    para['epoch_end'] = str(round(raw._last_time, 2))
+    para['time_point'] = str(raw.n_times)
+    try:
+        para['event_class'] = str(len(set(events[:, 2])))
+        para['event_num'] = str(len(events))
+    except:
+        pass
+    if raw.preload:
+        size = raw._size
+    else:
+        # the size of the samples is taken from the header
+        size = raw.info['nchan'] * raw.n_times * 8
+    para['data_size'] = str(round(0.5 *(size /((2 ** 10) ** 2)), 2))
+    return para
+
+
+class Header_Catalog(object):
+    """Header metadata and event summaries of the files seen.
+
+    The catalog is a SQLite file in the directory of the data, an entry is
+    only returned while the mtime and size of its file are unchanged.
+    """
+
+    name = '.pacs_catalog.sqlite'
+
+    def __init__(self, data_dir):
+        self.fname = os.path.join(data_dir, self.name)
+
+    def _connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.fname, timeout=5)
+        connection.execute('CREATE TABLE IF NOT EXISTS header (path TEXT PRIMARY KEY, '
+                           'mtime REAL, size INTEGER, para TEXT)')
+        return connection
+
+    def get(self, path):
+        """The data_para of path, None if it is not in the catalog or stale."""
+        import json
+        import sqlite3
+
+        path = os.path.abspath(path)
+        if not os.path.isfile(self.fname):
+            return None
+        try:
+            stat = os.stat(path)
+            connection = self._connect()
+            try:
+                row = connection.execute('SELECT mtime, size, para FROM header WHERE path = ?',
+                                         (path,)).fetchone()
+            finally:
+                connection.close()
+        except (OSError, sqlite3.Error):
+            return None
+        if row is None or not (row[0] == stat.st_mtime and row[1] == stat.st_size):
+            return None
+        return json.loads(row[2])
+
+    def put(self, path, para):
+        """Store the data_para of path, a read-only directory is ignored."""
+        import json
+        import sqlite3
+
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute('INSERT OR REPLACE INTO header VALUES (?, ?, ?, ?)',
+                                       (path, stat.st_mtime, stat.st_size, json.dumps(para)))
+            finally:
+                connection.close()
+        except (OSError, sqlite3.Error) as error:
+            print('Header catalog not updated:', error)
+
+
+def file_para(path, read=True):
+    """The data_para of a file from the catalog next to it.
+
+    If the file is not in the catalog, or has changed since, its header is
+    read (only if read) and the catalog is updated.
+    """
+    catalog = Header_Catalog(os.path.dirname(os.path.abspath(path)))
+    para = catalog.get(path)
+    if para is None and read:
+        raw = read_raw_file(path, preload=False)
+        para = header_para(raw, annotation_events(raw))
+        para['path'] = path
+        catalog.put(path, para)
+    return para
+
+
+def catalog_para(path, raw, events=None):
+    """Put the header of a raw just read from path into the catalog."""
+    para = header_para(raw, events)
+    para['path'] = path
+    Header_Catalog(os.path.dirname(os.path.abspath(path))).put(path, para)
+    return para
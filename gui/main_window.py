@@ -7,6 +7,7 @@
 '''
 
 import os
+import glob
 import traceback
 import matplotlib
 matplotlib.use('Qt5Agg')
@@ -17,6 +18,7 @@ import numpy as np
 import pandas as pd
 import scipy.io as sio
 import gc
+import time
 
 from PyQt5.QtWidgets import QMainWindow, QDesktopWidget, QAction, QMenu, \
     QFileDialog, QLabel, QGroupBox, QVBoxLayout, QHBoxLayout,  \
@@ -27,11 +29,14 @@ from PyQt5.QtWidgets import QMainWindow, QDesktopWidget, QAction, QMenu, \
 from PyQt5.QtCore import Qt, pyqtSignal, QUrl
 from PyQt5.QtGui import QKeySequence, QIcon, QDesktopServices
 from mne import Annotations, events_from_annotations, BaseEpochs, Epochs
-from gui.my_thread import Import_Thread, Load_Epoched_Data_Thread, Resample_Thread, Filter_Thread, Calculate_Power
+from gui.my_thread import Import_Thread, Load_Epoched_Data_Thread, Resample_Thread, Filter_Thread, Calculate_Power, \
+    Export_Thread, Autosave_Thread, Batch_Import_Thread, Filter_Cache
 from gui.sub_window import Choose_Window, Event_Window, Select_Time, Select_Chan, Select_Event, Epoch_Time, \
                            Refer_Window, Baseline_Time, My_Progress, Time_Freq_Win, Con_Win
 from gui.re_ref import car_ref, gwr_ref, esr_ref, bipolar_ref, monopolar_ref, laplacian_ref
-from gui.data_io import write_raw_edf, write_raw_set
+from gui.data_io import write_raw_edf, write_raw_set, save_workspace, load_workspace, \
+    snapshot_workspace, commit_workspace, \
+    annotation_events, file_para, read_raw_file, take_memmap, remove_memmap, remove_memmaps
 from gui.my_class import Subject, SEEG, UiScreenshot
 from visbrain.gui.brain.user import BrainUserMethods
 from visbrain.objects.scene_obj import VisbrainCanvas
@@ -115,6 +120,17 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         self.resample_worker.resample.connect(self.get_seeg_data)
         self.filter_worker = Filter_Thread()
         self.filter_worker.filter_signal.connect(self.get_seeg_data)
+        # filter designs are kept between the runs and the sessions
+        self.filter_worker.filter_cache = Filter_Cache(os.path.join(os.path.expanduser('~'),
+                                                                    '.pacs_filters'))
+        self.export_worker = Export_Thread()
+        self.export_worker.export.connect(self.finish_export)
+        # (SEEG, copy) of the snapshot the export worker saves as a workspace
+        self.workspace_pairs = []
+        self.batch_import_worker = Batch_Import_Thread()
+        self.batch_import_worker.batch.connect(self.get_batch_data)
+        self.autosave_worker = Autosave_Thread()
+        self.autosave_worker.autosave.connect(self.finish_autosave)
 
     def create_action(self):
         '''create actions for menu bar'''
@@ -128,6 +144,21 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                                      statusTip='Import raw sEEG data',
                                      triggered=self.execute_import_data)
         self.import_action.setEnabled(False)
+        self.import_lazy_action = QAction('Import raw sEEG data (lazy)', self,
+                                          statusTip='Read the header only, load samples on demand',
+                                          triggered=self.execute_import_lazy)
+        self.import_lazy_action.setEnabled(False)
+        self.import_subset_action = QAction('Import raw sEEG data (channels / time range)', self,
+                                            statusTip='Import the chosen channels and time range only',
+                                            triggered=self.execute_import_subset)
+        self.import_subset_action.setEnabled(False)
+        self.import_batch_action = QAction('Import a directory of raw sEEG data', self,
+                                           statusTip='Import all the raw sEEG data in a directory',
+                                           triggered=self.execute_batch_import)
+        self.import_batch_action.setEnabled(False)
+        self.file_info_action = QAction('Show recording info', self,
+                                        statusTip='Show the header of a recording without importing it',
+                                        triggered=self.show_file_info)
         self.import_epoch_action = QAction('Import Epoch data', self,
                                            statusTip='Import Epoch data',
                                            triggered=self.execute_load_epoched_data)
@@ -139,6 +170,15 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         self.clear_workshop_action = QAction('Clear the workshop', self,
                                       statusTip='Clear the workshop',
                                       triggered=self.clear_all)
+        self.save_workspace_action = QAction('Save workspace', self,
+                                             statusTip='Save all the subjects to a HDF5 workspace',
+                                             triggered=self.save_workspace)
+        self.open_workspace_action = QAction('Open workspace', self,
+                                             statusTip='Open a HDF5 workspace',
+                                             triggered=self.open_workspace)
+        self.autosave_action = QAction('Autosave workspace', self, checkable=True,
+                                       statusTip='Save the new or modified data to a workspace every minute',
+                                       triggered=self.autosave_workspace)
         self.clear_all_action = QAction('Clear all', self,
                                  statusTip='Clear all workshops',
                                  triggered=self.clear_all)
@@ -202,7 +242,10 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         self.iir = QAction('IIR filter', self,
                           statusTip='Filter the sEEG data using iir',
                           triggered=self.filter_data_iir)
-        self.raw_action['filter_sub_menu'].addActions([self.fir, self.iir])
+        self.line_noise = QAction('Line noise removal', self,
+                                  statusTip='Remove the line noise and its harmonics by regression',
+                                  triggered=self.filter_line_noise)
+        self.raw_action['filter_sub_menu'].addActions([self.fir, self.iir, self.line_noise])
 
         self.raw_action['select_data_menu'] = QMenu('Select sub-sEEG data', self)
         self.select_time_action = QAction('Time', self,
@@ -486,9 +529,17 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         self.file_menu.addAction(self.create_subject_action)
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.import_action)
+        self.file_menu.addAction(self.import_lazy_action)
+        self.file_menu.addAction(self.import_subset_action)
+        self.file_menu.addAction(self.import_batch_action)
+        self.file_menu.addAction(self.file_info_action)
         self.file_menu.addAction(self.import_epoch_action)
         self.file_menu.addAction(self.load_coord)
         self.file_menu.addSeparator()
+        self.file_menu.addAction(self.open_workspace_action)
+        self.file_menu.addAction(self.save_workspace_action)
+        self.file_menu.addAction(self.autosave_action)
+        self.file_menu.addSeparator()
         self.file_menu.addAction(self.clear_all_action)
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.setting_action)
@@ -1311,40 +1362,48 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                                            QLineEdit.Normal)
         try:
             if self.subject_name:
-                try:
-                    self.subject_stack.removeWidget(self.empty_label_0)
-                except Exception as error:
-                    pass
-                try:
-                    self.subject_stack.removeWidget(self.tree)
-                except Exception as error:
-                    pass
-                self.subject[self.subject_name] = Subject(name=self.subject_name)
-                self.subject_cb.addItem(self.subject_name)
-                self.subject_cb.setCurrentText(self.subject_name)
-                self.tree = QTreeWidget()
-                self.tree.setContextMenuPolicy(Qt.CustomContextMenu)
-                self.tree.setProperty('name', 'ptc')
-                self.root = self.tree.invisibleRootItem()
-                self.tree.setHeaderHidden(True)  # 隐藏列标题栏
-                self.node_00 = QTreeWidgetItem(self.tree)
-                self.node_00.setText(0, self.subject_name)
-                self.node_00.setIcon(0, QIcon('image/subject.ico'))
-                self.tree.expandAll()
-                self.tree.itemChanged.connect(self.change_current_data)
-                self.tree_dict[self.subject_name] = self.tree
-                self.subject_stack.addWidget(self.tree)
-                self.tree_item[self.subject_name] = dict()
-                self.tree_item[self.subject_name]['root'] = self.node_00
-                print('创建subject', self.subject_name)
-                self.load_coord.setEnabled(True)
+                self.add_subject(Subject(name=self.subject_name))
             self.import_action.setEnabled(True)
+            self.import_lazy_action.setEnabled(True)
+            self.import_subset_action.setEnabled(True)
+            self.import_batch_action.setEnabled(True)
             self.import_epoch_action.setEnabled(True)
             self.elec_df = None
             self.reset_source(self.subject_name)
         except Exception as error:
             self.show_error(error)
 
+    def add_subject(self, subject):
+        '''add a Subject and its tree'''
+        self.subject_name = subject.name
+        try:
+            self.subject_stack.removeWidget(self.empty_label_0)
+        except Exception as error:
+            pass
+        try:
+            self.subject_stack.removeWidget(self.tree)
+        except Exception as error:
+            pass
+        self.subject[self.subject_name] = subject
+        self.subject_cb.addItem(self.subject_name)
+        self.subject_cb.setCurrentText(self.subject_name)
+        self.tree = QTreeWidget()
+        self.tree.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.tree.setProperty('name', 'ptc')
+        self.root = self.tree.invisibleRootItem()
+        self.tree.setHeaderHidden(True)  # 隐藏列标题栏
+        self.node_00 = QTreeWidgetItem(self.tree)
+        self.node_00.setText(0, self.subject_name)
+        self.node_00.setIcon(0, QIcon('image/subject.ico'))
+        self.tree.expandAll()
+        self.tree.itemChanged.connect(self.change_current_data)
+        self.tree_dict[self.subject_name] = self.tree
+        self.subject_stack.addWidget(self.tree)
+        self.tree_item[self.subject_name] = dict()
+        self.tree_item[self.subject_name]['root'] = self.node_00
+        print('创建subject', self.subject_name)
+        self.load_coord.setEnabled(True)
+
     def reset_source(self, name):
         if self.sources is not None:
             try:
@@ -1404,12 +1463,27 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         return child, item
 
     # import sEEG data
-    def show_pbar(self):
-        self.pbar = My_Progress()
+    def show_pbar(self, worker=None):
+        '''show a progress window, following the reports of worker if given'''
+        if getattr(self, 'pbar', None) is not None:
+            # the window of a replaced job
+            self.pbar.close()
+        self.pbar = My_Progress(worker=worker)
         self.pbar.show()
 
     def execute_import_data(self):
         '''execute import data worker'''
+        self.start_import_data(preload=True)
+
+    def execute_import_lazy(self):
+        '''execute import data worker, only the header is read'''
+        self.start_import_data(preload=False)
+
+    def execute_import_subset(self):
+        '''execute import data worker on the chosen channels and time range'''
+        self.start_import_data(preload=True, subset=True)
+
+    def start_import_data(self, preload=True, subset=False):
         subject_name = self.subject_cb.currentText()
         if not subject_name:
             QMessageBox.warning(self,'Error', 'Please create a subject first')
@@ -1419,15 +1493,105 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                'edf' == self.data_path[-3:] or \
                'fif' == self.data_path[-3:] or \
                'vhdr' == self.data_path[-4:]:
-                self.import_worker.data_path = self.data_path
-                self.import_worker.start()
-                self.flag += 1
-                self.data_mode = 'raw'
-                self.show_pbar()
+                # a running import is replaced by this one once it starts
+                self.import_job = dict(data_path=self.data_path, preload=preload,
+                                       chans=None, time=None)
+                # show the header from the catalog while the data is loading
+                para = file_para(self.data_path, read=False)
+                if para is not None:
+                    self.update_func(para)
+                if subset:
+                    self.choose_import_subset()
+                else:
+                    self.start_import_worker()
             elif self.flag == 0 and self.data_path:
                 QMessageBox.warning(self, 'Data Format Error',
                                     'Please select the right file!')
 
+    def start_import_worker(self):
+        self.show_pbar(self.import_worker)
+        self.import_worker.start(**self.import_job)
+        self.flag += 1
+        self.data_mode = 'raw'
+
+    def choose_import_subset(self):
+        '''choose the channels and the time range to import from the header'''
+        try:
+            header = read_raw_file(self.data_path, preload=False)
+        except Exception as error:
+            self.show_error(error)
+            return
+        self.import_time_end = round(header.times[-1], 2)
+        self.import_chan_win = Select_Chan(chan_name=header.ch_names)
+        self.import_chan_win.chan_signal.connect(self.get_import_chan)
+        self.import_chan_win.show()
+
+    def get_import_chan(self, chan):
+        self.import_job['chans'] = chan if len(chan) else None
+        self.import_time_win = Select_Time(self.import_time_end)
+        self.import_time_win.time_signal.connect(self.get_import_time)
+        self.import_time_win.show()
+
+    def get_import_time(self, time):
+        self.import_job['time'] = [float(time[0]), float(time[1])]
+        self.start_import_worker()
+
+    def execute_batch_import(self):
+        '''execute batch import worker on a directory'''
+        subject_name = self.subject_cb.currentText()
+        if not subject_name:
+            QMessageBox.warning(self, 'Error', 'Please create a subject first')
+            return
+        data_dir = QFileDialog.getExistingDirectory(self, 'Import a directory')
+        if not data_dir:
+            return
+        pattern, ok = QInputDialog.getText(self, 'Import a directory', 'File name pattern',
+                                           QLineEdit.Normal, '*')
+        if not ok:
+            return
+        data_path = [path for path in glob.glob(os.path.join(data_dir, pattern or '*'))
+                     if path[-4:] in ['.set', '.edf', '.fif'] or path[-5:] == '.vhdr']
+        if not len(data_path):
+            QMessageBox.warning(self, 'Data Format Error', 'No .set, .edf, .fif or .vhdr file found')
+            return
+        concat = QMessageBox.question(self, 'Import a directory',
+                                      'Concatenate contiguous segments?',
+                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        self.show_pbar(self.batch_import_worker)
+        self.batch_import_worker.start(data_path=data_path, concat=concat == QMessageBox.Yes)
+
+    def get_batch_data(self, result):
+        '''register the batch imported data under the current subject'''
+        self.pbar.step = 100
+        subject_name = self.subject_cb.currentText()
+        try:
+            for item in result:
+                key = item['name'] + '_raw'
+                index = 1
+                while key in self.subject[subject_name].seeg:
+                    key = item['name'] + '_' + str(index) + '_raw'
+                    index += 1
+                self.data_path = item['path'][0]
+                self.add_seeg(subject_name, key, item['raw'], 'raw', self.data_path)
+                self.flag += 1
+            if len(result):
+                self.data_mode = 'raw'
+                self.set_current_data(key=key)
+        except Exception as error:
+            self.show_error(error)
+
+    def show_file_info(self):
+        '''show the header of a recording from the catalog'''
+        data_path, _ = QFileDialog.getOpenFileName(self, 'Show recording info')
+        if 'set' == data_path[-3:] or \
+           'edf' == data_path[-3:] or \
+           'fif' == data_path[-3:] or \
+           'vhdr' == data_path[-4:]:
+            try:
+                self.update_func(file_para(data_path))
+            except Exception as error:
+                self.show_error(error)
+
     def execute_load_epoched_data(self):
         '''execute load epoched data'''
         subject_name = self.subject_cb.currentText()
@@ -1449,6 +1613,15 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                 QMessageBox.warning(self, 'Data Format Error',
                                     'Please select the right file!')
 
+    def load_current_data(self):
+        '''load the whole current data if it was imported lazily'''
+        data = self.current_data.data
+        if not data.preload:
+            print('Loading the whole data')
+            data.load_data()
+            self.current_data.get_para()
+        return data
+
     def get_seeg_data(self, seeg_data):
         '''get seeg data'''
         self.pbar.step = 100
@@ -1476,59 +1649,20 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                     else:
                         [self.epoch_action[action].setEnabled(True) for action in self.epoch_action]
                 subject_name = self.subject_cb.currentText()
-
-                self.subject[subject_name].seeg[self.key] = SEEG(name=self.key, data=seeg_data,
-                                                                 mode=self.data_mode)
-                self.subject[subject_name].seeg[self.key].data_para['path'] = self.data_path
-                if self.data_mode == 'raw':
-                    des = list(set(seeg_data._annotations.description))
-                    try:
-                        event_id = {str(mark): int(mark) for mark in des}
-                        events, _ = mne.events_from_annotations(seeg_data, event_id=event_id)
-                        self.subject[subject_name].seeg[self.key].events = events
-                    except:
-                        pass
-                    if 'Raw sEEG' in child:
-                        self.node_20 = QTreeWidgetItem(self.tree_item[subject_name]['raw'])
-                        self.node_20.setText(0, self.key)
-                        self.node_20.setIcon(0, QIcon('image/sEEG.jpg'))
-                        self.node_20.setCheckState(0, Qt.Checked)
-                        self.tree.expandAll()
-                    else:
-                        self.node_10 = QTreeWidgetItem(self.tree_item[subject_name]['root'])
-                        self.node_10.setText(0, 'Raw sEEG')
-                        self.node_10.setIcon(0, QIcon('image/EEG.ico'))
-                        self.node_20 = QTreeWidgetItem(self.node_10)
-                        self.node_20.setText(0, self.key)
-                        self.node_20.setIcon(0, QIcon('image/sEEG.jpg'))
-                        self.node_20.setCheckState(0, Qt.Checked)
-                        self.tree_item[subject_name]['raw'] = self.node_10
-                        self.tree.expandAll()
-                elif self.data_mode == 'epoch':
-                    self.subject[subject_name].seeg[self.key].events = seeg_data.events
-                    if 'Epoch sEEG' in child:
-                        self.node_20 = QTreeWidgetItem(self.tree_item[subject_name]['epoch'])
-                        self.node_20.setText(0, self.key)
-                        self.node_20.setIcon(0, QIcon('image/sEEG.jpg'))
-                        self.node_20.setCheckState(0, Qt.Checked)
-                        self.tree.expandAll()
-                    else:
-                        self.node_11 = QTreeWidgetItem(self.tree_item[subject_name]['root'])
-                        self.node_11.setText(0, 'Epoch sEEG')
-                        self.node_11.setIcon(0, QIcon('image/EEG.ico'))
-                        self.node_20 = QTreeWidgetItem(self.node_11)
-                        self.node_20.setText(0, self.key)
-                        self.node_20.setIcon(0, QIcon('image/sEEG.jpg'))
-                        self.node_20.setCheckState(0, Qt.Checked)
-                        self.tree_item[subject_name]['epoch'] = self.node_11
-                        self.tree.expandAll()
-                self.subject[subject_name].seeg[self.key].get_para()
+                # derived data keeps the steps of the data it comes from
+                parent = self.current_data if isinstance(self.current_data, SEEG) else None
+                self.add_seeg(subject_name, self.key, seeg_data, self.data_mode, self.data_path,
+                              parent=parent)
                 self.event = self.subject[subject_name].seeg[self.key].events
                 self.set_current_data(key=self.key)
                 del seeg_data
                 gc.collect()
             else:
+                # the file written by a filter or resample job goes with it
+                stream = take_memmap(seeg_data)
                 del seeg_data
+                gc.collect()
+                remove_memmap(stream)
         except Exception as error:
             if error.args[0] == "'str' object has no attribute 'annotations'":
                 QMessageBox.warning(self, 'Data Error',
@@ -1539,6 +1673,39 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
             else:
                 self.show_error(error)
 
+    def add_seeg(self, subject_name, key, seeg_data, mode, path, parent=None):
+        '''register a SEEG under a subject and add its tree node'''
+        self.subject[subject_name].seeg[key] = SEEG(name=key, data=seeg_data, mode=mode)
+        self.subject[subject_name].seeg[key].data_para['path'] = path
+        # the file written by a filter or resample job is removed with the data
+        self.subject[subject_name].seeg[key].stream = take_memmap(seeg_data)
+        self.subject[subject_name].seeg[key].provenance = \
+            (list(parent.provenance) if parent is not None else []) + \
+            [dict(parent=parent.name if parent is not None else None, path=path,
+                  mode=mode, time=time.strftime('%Y-%m-%d %H:%M:%S'))]
+        if mode == 'raw':
+            self.subject[subject_name].seeg[key].events = annotation_events(seeg_data)
+        elif mode == 'epoch':
+            self.subject[subject_name].seeg[key].events = seeg_data.events
+        self.add_data_node(subject_name, key, mode)
+        self.subject[subject_name].seeg[key].get_para()
+
+    def add_data_node(self, subject_name, key, mode):
+        '''add the tree node of a SEEG'''
+        parent = 'raw' if mode == 'raw' else 'epoch'
+        if parent in self.tree_item[subject_name]:
+            self.node_20 = QTreeWidgetItem(self.tree_item[subject_name][parent])
+        else:
+            node = QTreeWidgetItem(self.tree_item[subject_name]['root'])
+            node.setText(0, 'Raw sEEG' if mode == 'raw' else 'Epoch sEEG')
+            node.setIcon(0, QIcon('image/EEG.ico'))
+            self.tree_item[subject_name][parent] = node
+            self.node_20 = QTreeWidgetItem(node)
+        self.node_20.setText(0, key)
+        self.node_20.setIcon(0, QIcon('image/sEEG.jpg'))
+        self.node_20.setCheckState(0, Qt.Checked)
+        self.tree_dict[subject_name].expandAll()
+
     def set_current_data(self, key):
         '''set the curent seeg data'''
         self.key = key
@@ -1575,17 +1742,35 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
     # save sEEG data
     def save_edf(self):
         self.save_path, _ = QFileDialog.getSaveFileName(self, 'Save data to EDF')
-        try:
-            write_raw_edf(self.save_path, self.current_data.data)
-        except Exception as error:
-            self.show_error(error)
+        if len(self.save_path):
+            if not self.save_path[-4:] in ['.edf', '.bdf']:
+                self.save_path += '.edf'
+            self.show_pbar(self.export_worker)
+            self.export_worker.start(data=self.current_data.data, save_path=self.save_path,
+                                     writer=write_raw_edf)
+
+    def finish_export(self, save_path, result=None):
+        self.pbar.step = 100
+        if save_path and isinstance(result, dict):
+            # the new workspace replaces the old one here, where the data lives
+            try:
+                commit_workspace(result, self.workspace_pairs)
+            except Exception as error:
+                self.show_error(error)
+                return
+            finally:
+                self.workspace_pairs = []
+        if save_path:
+            print('Finish saving SEEG data to', save_path)
 
     def save_set(self):
-        self.save_path, _ = QFileDialog.getSaveFileName(self, 'Save data to EDF')
-        try:
-            write_raw_set(self.save_path + '.set', self.current_data.data)
-        except Exception as error:
-            self.show_error(error)
+        self.save_path, _ = QFileDialog.getSaveFileName(self, 'Save data to SET')
+        if len(self.save_path):
+            if not self.save_path[-4:] == '.set':
+                self.save_path += '.set'
+            self.show_pbar(self.export_worker)
+            self.export_worker.start(data=self.current_data.data, save_path=self.save_path,
+                                     writer=write_raw_set)
 
     def save_fif(self):
         '''save as .fif data'''
@@ -1603,6 +1788,67 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
     def save_pd(self):
         pass
 
+    def save_workspace(self):
+        '''save all the subjects to a HDF5 workspace'''
+        if not len(self.subject):
+            QMessageBox.warning(self, 'Error', 'Please create a subject first')
+            return
+        self.save_path, _ = QFileDialog.getSaveFileName(self, 'Save workspace', filter='*.h5')
+        if len(self.save_path):
+            if not self.save_path[-3:] == '.h5':
+                self.save_path += '.h5'
+            # the worker writes a copy, the data here is left to the GUI
+            snapshot, self.workspace_pairs = snapshot_workspace(self.subject)
+            self.show_pbar(self.export_worker)
+            self.export_worker.start(data=snapshot, save_path=self.save_path,
+                                     writer=save_workspace)
+
+    def autosave_workspace(self, checked):
+        '''start or stop saving the new or modified data in the background'''
+        if checked:
+            save_path, _ = QFileDialog.getSaveFileName(self, 'Autosave workspace', filter='*.h5')
+            if not len(save_path):
+                self.autosave_action.setChecked(False)
+                return
+            if not save_path[-3:] == '.h5':
+                save_path += '.h5'
+            self.autosave_worker.subject = self.subject
+            self.autosave_worker.save_path = save_path
+            self.autosave_worker.start_autosave()
+        else:
+            self.autosave_worker.stop()
+
+    def finish_autosave(self, written):
+        self.statusBar().showMessage('Autosaved ' + ', '.join(key for _, key in written), 5000)
+
+    def open_workspace(self):
+        '''open a HDF5 workspace, only the headers are read'''
+        self.data_path, _ = QFileDialog.getOpenFileName(self, 'Open workspace', filter='*.h5')
+        if len(self.data_path):
+            try:
+                subject = load_workspace(self.data_path)
+            except Exception as error:
+                self.show_error(error)
+                return
+            for name in subject:
+                if name in self.subject:
+                    QMessageBox.warning(self, 'Name repeated',
+                                        'Subject ' + name + ' already exists, it is skipped')
+                    continue
+                seeg = subject[name].seeg
+                subject[name].seeg = dict()
+                self.add_subject(subject[name])
+                for key in seeg:
+                    subject[name].seeg[key] = seeg[key]
+                    self.add_data_node(name, key, seeg[key].mode)
+                    self.set_current_data(key=key)
+                    self.flag += 1
+            self.import_action.setEnabled(True)
+            self.import_lazy_action.setEnabled(True)
+            self.import_subset_action.setEnabled(True)
+            self.import_batch_action.setEnabled(True)
+            self.import_epoch_action.setEnabled(True)
+
     def export_npy(self):
         save_path, _ = QFileDialog.getSaveFileName(self, 'Save data')
         try:
@@ -1613,7 +1859,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def export_mat(self):
         try:
-            self.current_data.data.load_data()
+            self.load_current_data()
             save_path, _ = QFileDialog.getSaveFileName(self, 'Save data')
             sio.savemat(self.save_path + '_data.mat', {'seeg_data':self.current_data.data._data})
             sio.savemat(self.save_path + '_label.mat', {'label':self.current_data.events})
@@ -1623,13 +1869,20 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
     def clear_all(self):
         '''clear the whole workshop'''
         try:
+            seeg = [seeg for subject in self.subject.values() for seeg in subject.seeg.values()]
             del self.flag, self.tree_dict, self.tree_item, self.subject, self.event
             del self.current_data, self.data_mode, self.event_set
             gc.collect()
+            # the files of the data dropped, those still mapped are retried later
+            for data in seeg:
+                data.release()
             self.tree_dict = dict()
             self.tree_item = dict()
             self.subject = dict()
             self.event_set = dict()
+            # keep the autosaved workspace of the cleared subjects
+            self.autosave_worker.stop()
+            self.autosave_action.setChecked(False)
             self.subject_cb.clear()
             self.subject_cb.setCurrentText('')
             self.flag = 0
@@ -1674,14 +1927,14 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def car_reref(self):
         '''Reference sEEG data using Common Average Reference(CAR)'''
-        data = self.current_data.data.copy()
+        data = self.load_current_data().copy()
         print(data)
         raw = car_ref(data, data_class=self.data_mode)
         self.get_seeg_data(raw)
 
     def gwr_reref(self):
         '''Reference sEEG data using Gray-white Matter Reference(GWR)'''
-        data = self.current_data.data.copy()
+        data = self.load_current_data().copy()
         self.coord_path, _ = QFileDialog.getOpenFileName(self, 'Load MNI Coornidates')
         print(self.coord_path)
         try:
@@ -1692,7 +1945,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def esr_reref(self):
         '''Reference sEEG data using Electrode Shaft Reference(ESR)'''
-        data = self.current_data.data.copy()
+        data = self.load_current_data().copy()
         try:
             raw = esr_ref(data, data_class=self.data_mode)
             self.get_seeg_data(raw)
@@ -1701,7 +1954,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def bipolar_reref(self):
         '''Reference sEEG data using Bipolar Reference'''
-        data = self.current_data.data.copy()
+        data = self.load_current_data().copy()
         try:
             raw, _ = bipolar_ref(data, data_class=self.data_mode)
             self.get_seeg_data(raw)
@@ -1715,7 +1968,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def start_monopolar(self, ref_chan):
         '''Reference sEEG data using Monopolar Reference'''
-        data = self.current_data.data.copy()
+        data = self.load_current_data().copy()
         try:
             raw = monopolar_ref(data, data_class=self.data_mode, ref_chan=ref_chan)
             self.get_seeg_data(raw)
@@ -1724,7 +1977,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def laplacian_reref(self):
         '''Reference sEEG data using Laplacian Reference'''
-        data = self.current_data.data.copy()
+        data = self.load_current_data().copy()
         try:
             raw, _ = laplacian_ref(data, data_class=self.data_mode)
             self.get_seeg_data(raw)
@@ -1767,7 +2020,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         marker_chan_1 = ['DC09', 'DC10', 'DC11', 'DC12',
                          'DC13', 'DC14', 'DC15']
         try:
-            mark_data = self.current_data.data.copy().pick_channels(marker_chan_0)._data * 1e6
+            mark_data = self.current_data.data.copy().pick_channels(marker_chan_0).get_data() * 1e6
         except Exception as error:
             QMessageBox.warning(self, 'Marker Calculating Error', 'No channels match the selection')
             print('*****************************')
@@ -1896,6 +2149,13 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
     def show_con_win(self):
         data = self.current_data.data
         subject = self.subject_cb.currentText()
+        con_win = getattr(self, 'con_win', None)
+        if con_win is not None and con_win.data is data and con_win.subject == subject:
+            # same data, keep the spectra cached by the window
+            con_win.show()
+            return
+        if con_win is not None:
+            con_win.close()
         self.con_win = Con_Win(data, subject)
         self.con_win.show()
 
@@ -1911,7 +2171,6 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
 
     def get_sel_chan(self, chan):
         self.chan_sel = chan
-        self.current_data.data.load_data()
         sel_chan_data = self.current_data.data.copy().pick_channels(self.chan_sel)
         self.get_seeg_data(sel_chan_data)
 
@@ -1933,12 +2192,12 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
     def execute_resample_data(self):
         try:
             if self.current_data.data is not None:
-                self.resample_worker.resampling_rate,_ = self.value, _ = QInputDialog.getInt(self, 'Resample Data', 'Resample Rate(Hz)', 0, 0)
-                print(self.resample_worker.resampling_rate)
-                if self.resample_worker.resampling_rate > 0:
+                rate, _ = self.value, _ = QInputDialog.getInt(self, 'Resample Data', 'Resample Rate(Hz)', 0, 0)
+                print(rate)
+                if rate > 0:
                     print('开始重采样')
-                    self.resample_worker.data = self.current_data.data
-                    self.resample_worker.start()
+                    self.show_pbar(self.resample_worker)
+                    self.resample_worker.start(resampling_rate=rate, data=self.current_data.data)
         except Exception as error:
             print('*********************************************************************')
             self.show_error(error)
@@ -1949,7 +2208,7 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         self.fir_filter_window = Choose_Window('fir')
         self.fir_filter_window.signal.connect(self.filter_subwindow_para)
         self.fir_filter_window.notch_signal.connect(self.filter_subwindow_para)
-        self.filter_worker.filter_mode = 'fir'
+        self.filter_job = dict(filter_mode='fir')
         self.fir_filter_window.show()
 
     # filter sEEG data with iir filter
@@ -1957,9 +2216,24 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
         self.iir_filter_window = Choose_Window('iir')
         self.iir_filter_window.signal.connect(self.filter_subwindow_para)
         self.iir_filter_window.notch_signal.connect(self.filter_subwindow_para)
-        self.filter_worker.filter_mode = 'iir'
+        self.filter_job = dict(filter_mode='iir')
         self.iir_filter_window.show()
 
+    # remove the line noise of sEEG data by regression
+    def filter_line_noise(self):
+        try:
+            freq, ok = QInputDialog.getDouble(self, 'Line Noise Removal', 'Line Frequency(Hz)',
+                                              50., 1., 1000., 2)
+            if ok:
+                track = QMessageBox.question(self, 'Line Noise Removal',
+                                             'Track the drift of the line frequency?',
+                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+                self.filter_job = dict(filter_mode='line',
+                                       line_track=0.5 if track == QMessageBox.Yes else 0.)
+                self.filter_subwindow_para(None, None, freq)
+        except Exception as error:
+            self.show_error(error)
+
     def filter_subwindow_para(self, low_freq, high_freq, notch_freq):
         '''
         :param low_freq: lowpass cut frequency
@@ -1980,19 +2254,17 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                 notch_freq = None
             elif notch_freq:
                 notch_freq = float(notch_freq)
-            self.filter_worker.low_freq = low_freq
-            self.filter_worker.high_freq = high_freq
-            self.filter_worker.notch_freq = notch_freq
-            print('到这', type(self.filter_worker.low_freq), '\n',
-                  type(self.filter_worker.high_freq), '\n',
-                    type(self.filter_worker.notch_freq))
-            print('到这', self.filter_worker.low_freq, '\n',
-                  self.filter_worker.high_freq, '\n',
-                  self.filter_worker.notch_freq)
-            if self.filter_worker.low_freq or self.filter_worker.high_freq or \
-                self.filter_worker.notch_freq:
-                self.filter_worker.seeg_data = self.current_data.data
-                self.filter_worker.start()
+            print('到这', type(low_freq), '\n',
+                  type(high_freq), '\n',
+                    type(notch_freq))
+            print('到这', low_freq, '\n',
+                  high_freq, '\n',
+                  notch_freq)
+            if low_freq or high_freq or notch_freq:
+                self.show_pbar(self.filter_worker)
+                self.filter_worker.start(low_freq=low_freq, high_freq=high_freq,
+                                         notch_freq=notch_freq, seeg_data=self.current_data.data,
+                                         **self.filter_job)
         except Exception as error:
             self.show_error(error)
 
@@ -2126,6 +2398,17 @@ class MainWindow(QMainWindow, BrainUserMethods, UiScreenshot):
                                      QMessageBox.No)
         if reply == QMessageBox.Yes:
             event.accept()
+            # jobs stop at their next chunk, so no file is left half written
+            for worker in [self.import_worker, self.batch_import_worker, self.resample_worker,
+                           self.filter_worker, self.export_worker]:
+                worker.stop()
+            self.autosave_worker.stop()
+            self.autosave_worker.wait()
+            # the files written by the filter and resample jobs
+            self.subject = dict()
+            self.current_data = None
+            gc.collect()
+            remove_memmaps()
             os._exit(0)
         else:
             event.ignore()
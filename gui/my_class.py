@@ -7,6 +7,11 @@
 '''
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
+import numpy as np
+try:
+    from gui.data_io import header_para, remove_memmap
+except:
+    from data_io import header_para, remove_memmap
 
 
 class SEEG(object):
@@ -18,21 +23,28 @@ class SEEG(object):
         self.mode = mode
         self.events = events
         self.data_para = dict()
+        # where the data comes from, one dict per processing step
+        self.provenance = list()
+        # counts the in-place changes of data, see modified
+        self.version = 0
+        # (workspace file, HDF5 group, version) of the last save
+        self.saved = None
+        # the np.memmap file of a filter or resample job holding data
+        self.stream = None
+
+    def modified(self):
+        '''called by the code changing data in place, so it is saved again'''
+        self.version += 1
+
+    def release(self):
+        '''remove the file of stream, once data is dropped'''
+        fname, self.stream = self.stream, None
+        if fname is not None:
+            remove_memmap(fname)
 
     def get_para(self):
         if self.mode == 'raw':
-            self.data_para['epoch_num'] = str(1)
-            self.data_para['sfreq'] = str(self.data.info['sfreq'])
-            self.data_para['chan_num'] = str(self.data.info['nchan'])
-            self.data_para['epoch_start'] = str(self.data._first_time)
-            self.data_para['epoch_end'] = str(round(self.data._last_time, 2))
-            self.data_para['time_point'] = str(self.data.n_times)
-            try:
-                self.data_para['event_class'] = str(len(set(self.events[:, 2])))
-                self.data_para['event_num'] = str(len(self.events))
-            except:
-                pass
-            self.data_para['data_size'] = str(round(0.5 *(self.data._size /((2 ** 10) ** 2)), 2))
+            self.data_para.update(header_para(self.data, self.events))
         else:
             self.data_para['epoch_num'] = str(self.events.shape[0])
             self.data_para['sfreq'] = str(self.data.info['sfreq'])
@@ -60,6 +72,67 @@ class Subject(object):
         self.c_obj = c_obj
 
 
+class Tri_Con(object):
+    '''
+    Symmetric connectivity stored as its strictly lower triangle
+
+    data: numpy.array, shape (n_pairs, ...)
+          values of the pairs np.tril_indices(n_chan, -1), the remaining
+          axes are frequencies and / or times
+    '''
+
+    def __init__(self, data, n_chan, diag=0.):
+        super(Tri_Con, self).__init__()
+        data = np.asarray(data)
+        if data.shape[0] != n_chan * (n_chan - 1) // 2:
+            raise ValueError('data does not match the number of channels')
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        self.data = data
+        self.n_chan = n_chan
+        self.diag = diag
+        self.rows, self.cols = np.tril_indices(n_chan, -1)
+
+    @classmethod
+    def from_dense(cls, con, diag=0.):
+        '''pack a (n_chan, n_chan, ...) matrix whose lower triangle is filled'''
+        rows, cols = np.tril_indices(con.shape[0], -1)
+        return cls(con[rows, cols], con.shape[0], diag=diag)
+
+    @property
+    def shape(self):
+        return (self.n_chan, self.n_chan) + self.data.shape[1:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _unpack(self, values):
+        matrix = np.empty((self.n_chan, self.n_chan) + values.shape[1:],
+                          dtype=self.data.dtype)
+        matrix[self.rows, self.cols] = values
+        matrix[self.cols, self.rows] = values
+        index = np.arange(self.n_chan)
+        matrix[index, index] = self.diag
+        return matrix
+
+    def frame(self, index):
+        '''dense symmetric matrix of one frequency / time'''
+        if not isinstance(index, tuple):
+            index = (index, )
+        return self._unpack(self.data[(slice(None), ) + index])
+
+    def to_dense(self):
+        '''dense symmetric matrix of all the frames'''
+        return self._unpack(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) > 2 and \
+                key[0] == slice(None) and key[1] == slice(None):
+            return self.frame(key[2:])
+        return self.to_dense()[key]
+
+
 class Change_Figure(Figure):
 
     def __init__(self, data, title, *args, **kwargs):
@@ -48,11 +48,35 @@ def new_layout(chan):
     return layout
 
 
-def plot_sensors_connectivity(con, dir=False):
-    if not dir:
-        pass
+def plot_sensors_connectivity(info, con, picks=None, dir=False):
+    '''
+    Visualize the sensor connectivity in 3D
+    :param info: instance of Info
+                 information of the channels
+    :param con: instance of Tri_Con | numpy.array
+                connectivity, only the first frequency / time is plotted
+    :param picks: list | None
+                  channels' name that con is calculated from
+    :param dir: bool
+                if con is directed, keep the stronger direction of each pair
+    :return: instance of Figure
+    '''
+    from mne.viz import plot_sensors_connectivity as plot_con
+    try:
+        from gui.my_class import Tri_Con
+    except:
+        from my_class import Tri_Con
+
+    if isinstance(con, Tri_Con):
+        con = con.frame((0, ) * (con.ndim - 2))
     else:
-        pass
+        con = np.asarray(con)
+        while con.ndim > 2:
+            con = con[..., 0]
+    if dir:
+        con = np.maximum(con, con.T)
+
+    return plot_con(info, con, picks=picks)
 
 
 def standardize_epoch(epoch, baseline, normal=False):
@@ -105,150 +129,1247 @@ def standardize_evoke(evoke, baseline):
     return evoke_new
 
 
-def get_pearson(epoch):
+def _zscore(data, axis=-1):
+    '''
+    Remove the mean and scale to unit norm along one axis
+    :param data: numpy.array
+                 data needed to be normalized
+    :param axis: int
+                 axis of the time points
+    :return: numpy.array
+             normalized data, the dot product of two rows is their pearson
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    data = data - data.mean(axis=axis, keepdims=True)
+    norm = np.sqrt((data ** 2).sum(axis=axis, keepdims=True))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data /= norm
+    return data
+
+
+def _share_array(data):
+    '''
+    Put data in shared memory so that worker processes can read it without
+    pickled copies, a memmapped temporary file is used before python 3.8
+    :param data: numpy.array
+    :return: handle, tuple
+             handle to release the memory, description for _attach_array
+    '''
+    data = np.ascontiguousarray(data)
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        shared_memory = None
+    if shared_memory is not None:
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+        return shm, ('shm', shm.name, data.shape, data.dtype.str)
+    import os
+    import tempfile
+    fd, fname = tempfile.mkstemp(suffix='.dat')
+    os.close(fd)
+    mm = np.memmap(fname, dtype=data.dtype, mode='w+', shape=data.shape)
+    mm[...] = data
+    mm.flush()
+    del mm
+    return fname, ('memmap', fname, data.shape, data.dtype.str)
+
+
+def _release_array(handle):
+    if isinstance(handle, str):
+        import os
+        os.remove(handle)
+    else:
+        handle.close()
+        handle.unlink()
+
+
+def _block_worker(desc, func, index, kwargs):
+    '''run func on one block in a worker process'''
+    kind, name, shape, dtype = desc
+    if kind == 'shm':
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            result = func(data, *index, **kwargs)
+            del data
+        finally:
+            shm.close()
+    else:
+        data = np.memmap(name, dtype=dtype, mode='r', shape=shape)
+        result = func(data, *index, **kwargs)
+        del data
+    return result
+
+
+def parallel_blocks(data, func, index, n_jobs=1, block_size=None, axis=0, callback=None,
+                    **kwargs):
+    '''
+    Split the channel / channel-pair space into blocks and run
+    func(data, *index_block, **kwargs) on a process pool, the workers read
+    data from shared memory
+    :param data: numpy.array
+                 data shared by all the blocks
+    :param func: function
+                 module level function, returns a numpy.array
+    :param index: tuple of numpy.array
+                  arrays of the same length, e.g. (rows, cols) of the pairs
+                  or (chans, )
+    :param n_jobs: int
+                   number of worker processes, 1 runs in this process
+    :param block_size: int | None
+                       length of each block, None splits the index into
+                       4 blocks per worker
+    :param axis: int | None
+                 axis to concatenate the results of the blocks along,
+                 None returns the list of the results
+    :param callback: function | None
+                     called with the number of indices done and the total
+                     after every block, the blocks then run one by one in
+                     this process when n_jobs is 1; an exception raised by
+                     it stops the remaining blocks
+    :return: numpy.array | list
+    '''
+    index = tuple(np.asarray(i) for i in index)
+    n_index = len(index[0])
+    if n_jobs is None or n_index < 2 * n_jobs:
+        # too few to be worth starting the workers
+        n_jobs = 1
+    if block_size is None:
+        block_size = int(np.ceil(n_index / (max(int(n_jobs), 1) * 4.)))
+    block_size = max(int(block_size), 1)
+    blocks = [slice(start, min(start + block_size, n_index))
+              for start in range(0, n_index, block_size)]
+    if (n_jobs <= 1 or len(blocks) <= 1) and callback is None:
+        result = [func(data, *index, **kwargs)]
+    elif n_jobs <= 1 or len(blocks) <= 1:
+        result = []
+        for block in blocks:
+            result.append(func(data, *tuple(i[block] for i in index), **kwargs))
+            callback(block.stop, n_index)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        handle, desc = _share_array(data)
+        try:
+            with ProcessPoolExecutor(max_workers=int(n_jobs)) as pool:
+                futures = [pool.submit(_block_worker, desc, func,
+                                       tuple(i[block] for i in index), kwargs)
+                           for block in blocks]
+                result = []
+                try:
+                    for block, future in zip(blocks, futures):
+                        result.append(future.result())
+                        if callback is not None:
+                            callback(block.stop, n_index)
+                except BaseException:
+                    # e.g. cancelled from the callback, the blocks not
+                    # started yet are dropped
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            _release_array(handle)
+    if axis is None:
+        return result
+    return np.concatenate(result, axis=axis)
+
+
+def _pearson_rows(data, chans, n_x=None):
+    '''
+    pearson between a block of channel rows and the columns, summed over epochs
+    :param data: numpy.array
+                 z-scored data, shape (n_epochs, n_chan, n_times)
+    :param chans: numpy.array
+                  consecutive channel rows of the block
+    :param n_x: int | None
+                the columns are the channels from n_x on, None for all
+    :return: numpy.array
+             shape (n_block, n_cols)
+    '''
+    rows = data[:, chans[0]:chans[-1] + 1]
+    cols = data if n_x is None else data[:, n_x:]
+    return np.matmul(rows, cols.transpose((0, 2, 1))).sum(axis=0)
+
+
+def _cross_spec_rows(spec, chans, n_x):
+    '''
+    cross spectra between a block of channel rows and the channels from
+    n_x on, summed over epochs
+    :param spec: numpy.array
+                 rFFT of the data, shape (n_epochs, n_chan, n_freqs)
+    :param chans: numpy.array
+                  consecutive channel rows of the block
+    :return: numpy.array
+             shape (n_block, n_chan - n_x, n_freqs)
+    '''
+    return np.einsum('exf,eyf->xyf', spec[:, chans[0]:chans[-1] + 1],
+                     spec[:, n_x:].conj(), optimize=True)
+
+
+def _spec_con_pairs(data, rows, cols, **kwargs):
+    '''mne spectral connectivity of the channel pairs'''
+    from mne.connectivity import spectral_connectivity
+
+    con, freqs, times, n_epochs, n_tapers = spectral_connectivity(
+        data, indices=(rows, cols), **kwargs)
+    return con, freqs, times
+
+
+def _mt_spectra_chans(data, chans, sfreq, bandwidth, freq_mask, adaptive=True):
+    '''
+    tapered spectra of some channels with the tapers and adaptive weights of
+    mne spectral_connectivity, scaled so that the cross spectrum of two
+    channels is the sum of x * y.conj() over the tapers
+    :param data: numpy.array
+                 shape (n_epochs, n_chan, n_times)
+    :param freq_mask: numpy.array
+                      frequencies of the rFFT to keep
+    :return: numpy.array
+             shape (n_epochs, n_chans, n_tapers, n_freqs)
+    '''
+    from mne.time_frequency.multitaper import _compute_mt_params, _mt_spectra, \
+        _psd_from_mt_adaptive
+
+    dpss, eigvals, adaptive = _compute_mt_params(data.shape[-1], sfreq, bandwidth,
+                                                 True, adaptive)
+    spectra = list()
+    for epoch in data:
+        x_mt, _ = _mt_spectra(epoch[chans], dpss, sfreq)
+        if adaptive:
+            _, weights = _psd_from_mt_adaptive(x_mt, eigvals, freq_mask,
+                                               return_weights=True)
+        else:
+            weights = np.sqrt(eigvals)[np.newaxis, :, np.newaxis]
+        x_mt = weights * x_mt[:, :, freq_mask]
+        x_mt *= np.sqrt(2. / (weights ** 2).sum(axis=-2, keepdims=True))
+        spectra.append(x_mt)
+    return np.array(spectra)
+
+
+def _spec_con_spectra_pairs(spectra, rows, cols, method):
+    '''
+    mne spectral connectivity of the channel pairs from the spectra of
+    _mt_spectra_chans
+    :param spectra: numpy.array
+                    shape (n_epochs, n_chan, n_tapers, n_freqs)
+    :param method: str | list
+                   connectivity measures of mne spectral_connectivity
+    :return: numpy.array | list
+             con of each method, shape (n_pairs, n_freqs)
+    '''
+    from mne.connectivity.spectral import _check_estimators
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+    method_types, _, accumulate_psd, n_args = _check_estimators(methods, 'multitaper')
+    n_epochs, n_freqs = spectra.shape[0], spectra.shape[-1]
+    estimators = [method_type(len(rows), n_freqs, 0) for method_type in method_types]
+    psd_x, psd_y = 0., 0.
+    for epoch in spectra:
+        x, y = epoch[rows], epoch[cols]
+        csd = np.einsum('ptf,ptf->pf', x, y.conj())
+        for estimator in estimators:
+            estimator.start_epoch()
+            estimator.accumulate(slice(None), csd)
+        if accumulate_psd:
+            psd_x = psd_x + (x.real ** 2 + x.imag ** 2).sum(axis=1)
+            psd_y = psd_y + (y.real ** 2 + y.imag ** 2).sum(axis=1)
+    con = list()
+    for estimator, n in zip(estimators, n_args):
+        if n == 3:
+            estimator.compute_con(slice(None), n_epochs)
+        else:
+            estimator.compute_con(slice(None), n_epochs, psd_x / n_epochs,
+                                  psd_y / n_epochs)
+        con.append(estimator.con_scores)
+    if isinstance(method, (list, tuple)):
+        return con
+    return con[0]
+
+
+def _multitaper_chans(data, chans, **kwargs):
+    '''
+    multitaper fourier coefficients of some channels
+    :param data: numpy.array
+                 shape (n_epochs, n_chan, n_times)
+    :return: numpy.array
+             shape (n_windows, n_epochs, n_tapers, n_fft, n_chans)
+    '''
+    from spectral_connectivity import Multitaper
+
+    return Multitaper(data[:, chans, :].transpose((2, 0, 1)), **kwargs).fft()
+
+
+def get_pearson(epoch, return_epochs=False, n_jobs=1, callback=None):
     '''
     Calculate Pearson Correlation for all channels
-    :param epoch: instance of BaseRpochs
+    :param epoch: instance of BaseEpochs
                   data needed to be calculated
+    :param return_epochs: bool
+                          also return the pearson of every single epoch
+    :param n_jobs: int
+                   number of worker processes over blocks of channel rows,
+                   not used if return_epochs
+    :param callback: function | None
+                     called with the channel rows done and the total after every
+                     block, an exception raised by it stops the calculation
     :return: numpy.array
-             pearson
+             pearson, shape (n_chan, n_chan)
+             if return_epochs, pearson of each epoch is returned as well,
+             shape (n_epochs, n_chan, n_chan)
     '''
-    from scipy.stats import pearsonr
-    import numpy as np
-    from mne.epochs import BaseEpochs
-
     if not isinstance(epoch, BaseEpochs):
         raise TypeError('This is not BaseEpochs class')
 
-    chan = epoch.ch_names
-    pearson = np.zeros((1, len(chan), len(chan)))
-    for j in range(len(epoch)):
-        print('calculating epoch ' + str(j))
-        pearson_tmp = np.zeros((1, len(chan))).astype(np.float32)
-        data = epoch[j]._data[0, :, :]
-        for k in range(len(chan)):
-            result = np.array([])
-            for i in range(len(chan)):
-                result = np.append(result, pearsonr(data[k], data[i])[0])
-            pearson_tmp = np.vstack((pearson_tmp, result.reshape(1, -1)))
-        pearson_tmp = np.delete(pearson_tmp, 0, axis=0)
-        pearson_tmp = np.expand_dims(pearson_tmp, 0).astype(np.float32)
-        pearson = np.concatenate((pearson, pearson_tmp), axis=0)
-    pearson = np.delete(pearson, 0, axis=0)
-    pearson = np.mean(pearson, axis=0)
+    data = _zscore(epoch.get_data())
+    if (n_jobs > 1 or callback is not None) and not return_epochs:
+        # each worker multiplies its channel rows with all the channels
+        pearson = parallel_blocks(data, _pearson_rows, (np.arange(data.shape[1]), ),
+                                  n_jobs=n_jobs, callback=callback)
+        return pearson / data.shape[0]
+    # one batched matrix multiply gives every channel-by-channel matrix
+    pearson_epochs = np.matmul(data, data.transpose((0, 2, 1)))
+    pearson = pearson_epochs.mean(axis=0)
 
+    if return_epochs:
+        return pearson, pearson_epochs
     return pearson
 
 
-def get_spec_pearson(epochx, epochy):
+def _n_epochs(epoch):
     '''
-    Calculate Pearson Coorelation for sub channels
-    :param epochx: instance of BaseEpochs
-    :param epochy: instance of BaseEpochs
-    :return: pearson for sub channels
+    Number of epochs of BaseEpochs or a 3-D numpy.array
     '''
-    from scipy.stats import pearsonr
-    import numpy as np
-    from mne.epochs import BaseEpochs
+    if isinstance(epoch, BaseEpochs):
+        return len(epoch)
+    if isinstance(epoch, np.ndarray):
+        if epoch.ndim != 3:
+            raise ValueError('Data should be 3-D (n_epochs, n_chan, n_times)')
+        return epoch.shape[0]
+    raise TypeError('This is not BaseEpochs class or numpy.array')
 
-    if not isinstance(epochx, BaseEpochs):
-        raise TypeError('This is not BaseEpochs class')
-    if not isinstance(epochy, BaseEpochs):
-        raise TypeError('This is not BaseEpochs class')
-    if not len(epochx) == len(epochy):
+
+def _epoch_block(epoch, start, stop):
+    '''
+    Get the data of epochs[start:stop] without copying the rest
+    :param epoch: instance of BaseEpochs | numpy.array
+    :return: numpy.array
+             shape (stop - start, n_chan, n_times)
+    '''
+    if isinstance(epoch, BaseEpochs):
+        if epoch.preload:
+            return epoch._data[start:stop]
+        return epoch[start:stop].get_data()
+    return epoch[start:stop]
+
+
+def _cross_pairs(n_x, n_y):
+    '''
+    Pairs between n_x channels and the n_y channels stacked after them
+    :return: numpy.array, numpy.array
+             rows and cols, x-major order
+    '''
+    rows = np.repeat(np.arange(n_x), n_y)
+    cols = np.tile(np.arange(n_y), n_x) + n_x
+    return rows, cols
+
+
+def get_spec_pearson(epochx, epochy, block_size=32, n_jobs=1, callback=None):
+    '''
+    Calculate Pearson Coorelation for sub channels
+    :param epochx: instance of BaseEpochs | numpy.array
+                   shape (n_epochs, n_chanx, n_times) if numpy.array
+    :param epochy: instance of BaseEpochs | numpy.array
+                   shape (n_epochs, n_chany, n_times) if numpy.array
+    :param block_size: int
+                       number of epochs computed at once, peak memory
+                       grows with it instead of the number of epochs
+    :param n_jobs: int
+                   number of worker processes over the channels of epochx,
+                   used for each block of epochs
+    :param callback: function | None
+                     called with the epochs done and the total after every
+                     block, an exception raised by it stops the calculation
+    :return: pearson for sub channels, shape (n_chanx, n_chany)
+    '''
+    n_epochs = _n_epochs(epochx)
+    if not n_epochs == _n_epochs(epochy):
         raise TypeError('This is not the same epoch')
+    block_size = max(int(block_size), 1)
 
-    chanx = epochx.ch_names
-    chany = epochy.ch_names
-    pearson = np.zeros((1, len(chanx), len(chany)))
-    for i in range(len(epochx)):
-        print('calculating epoch ' + str(i))
-        pearson_tmp = np.zeros((1, len(chany))).astype(np.float32)
-        datax = epochx[i]._data[0, :, :]
-        datay = epochy[i]._data[0, :, :]
-        for j in range(len(chanx)):
-            result = np.array([])
-            for k in range(len(chany)):
-                result = np.append(result, pearsonr(datax[j, :], datay[k, :])[0])
-            pearson_tmp = np.vstack((pearson_tmp, result.reshape(1, -1)))
-        pearson_tmp = np.delete(pearson_tmp, 0, axis=0)
-        pearson_tmp = np.expand_dims(pearson_tmp, 0).astype(np.float32)
-        pearson = np.concatenate((pearson, pearson_tmp), axis=0)
-    pearson = np.delete(pearson, 0, axis=0)
-    pearson = np.mean(pearson, axis=0)
-    return pearson
+    pearson = None
+    for start in range(0, n_epochs, block_size):
+        stop = min(start + block_size, n_epochs)
+        print('calculating epoch ' + str(start) + ' - ' + str(stop - 1))
+        datax = _zscore(_epoch_block(epochx, start, stop))
+        datay = _zscore(_epoch_block(epochy, start, stop))
+        if n_jobs > 1:
+            n_x = datax.shape[1]
+            block = parallel_blocks(np.concatenate((datax, datay), axis=1), _pearson_rows,
+                                    (np.arange(n_x), ), n_jobs=n_jobs, n_x=n_x)
+        else:
+            block = np.einsum('eit,ejt->ij', datax, datay, optimize=True)
+        pearson = block if pearson is None else pearson + block
+        if callback is not None:
+            callback(stop, n_epochs)
+    pearson /= n_epochs
 
+    return pearson
 
-def get_corr(epoch1, epoch2, baseline, normal=False, mode='same', norm=True):
-    from scipy.signal import correlate
 
-    sta_epoch1 = standardize_epoch(epoch1, baseline, normal=normal)
-    sta_epoch2 = standardize_epoch(epoch2, baseline, normal=normal)
-    try:
-        data1 = sta_epoch1.copy().crop(0.)._data
-        data2 = sta_epoch2.copy().crop(0.)._data
-    except:
-        data1 = sta_epoch1._data
-        data2 = sta_epoch2._data
+def _corr_lags(n_times, mode='same', max_lag=None):
+    '''
+    Lags (in samples) returned by scipy.signal.correlate for two signals
+    of the same length
+    :param n_times: int
+                    length of the signals
+    :param mode: str
+                 'valid' | 'same' | 'full'
+    :param max_lag: int | None
+                    only keep the lags within [-max_lag, max_lag]
+    :return: numpy.array
+             lags
+    '''
     if mode == 'valid':
-        corr = np.zeros((1, data1.shape[1], data2.shape[1]))
-        for i in range(len(epoch1)):
-            print('calculating epoch ' + str(i))
-            datax = data1[i, :, :]
-            datay = data2[i, :, :]
-            corr_tmp = np.zeros((1, datay.shape[0])).astype(np.float32)
-            for j in range(len(datax)):
-                result = np.array([])
-                for k in range(len(datay)):
-                    result = np.append(result, correlate(datax[j, :], datay[k, :], mode=mode))
-                corr_tmp = np.vstack((corr_tmp, np.expand_dims(result, 0)))
-            corr_tmp = np.delete(corr_tmp, 0, axis=0).astype(np.float32)
-            corr = np.concatenate((corr, np.expand_dims(corr_tmp, 0)), axis=0)
-        corr = np.delete(corr, 0, axis=0)
-        corr = np.mean(corr, axis=0)
+        lags = np.array([0])
     elif mode == 'full':
-        corr = np.zeros((data2.shape[0], data2.shape[1], 2 * data2.shape[2] - 1))
-        for i in range (len (data1)):
-            for j in range (data2.shape[1]):
-                corr_tmp = correlate(data1[i, 0, :], data2[i, j, :], mode=mode)
-                corr[i, j, :] = np.expand_dims(corr_tmp, 0)
-        if norm:
-            print ('calculate normalized cross-correlation')
-            trans = np.zeros ((1, len (epoch2.ch_names), 1))
-            for i in range (data2.shape[0]):
-                trans_tmp = np.array ([])
-                for j in range (data2.shape[1]):
-                    n = np.sqrt (np.dot (data1[i, 0, :], data1[i, 0, :].T) *
-                                 np.dot (data2[i, j, :], data2[i, j, :].T))
-                    trans_tmp = np.expand_dims (np.append (trans_tmp, np.array ([n])), axis=1)
-                trans = np.vstack ((trans, np.expand_dims (trans_tmp, axis=0)))
-            trans = np.delete (trans, 0, axis=0)
-            corr = np.true_divide (corr, trans)
-        corr = np.mean(corr, axis=0)
+        lags = np.arange(-(n_times - 1), n_times)
+    elif mode == 'same':
+        lags = np.arange(-(n_times // 2), n_times - n_times // 2)
     else:
-        corr = np.zeros((data2.shape[0], data2.shape[1], data2.shape[2]))
-        for i in range (len (data1)):
-            for j in range (data2.shape[1]):
-                corr_tmp = correlate(data1[i, 0, :], data2[i, j, :], mode='same')
-                corr[i, j, :] = np.expand_dims(corr_tmp, 0)
+        raise ValueError("mode should be 'valid', 'same' or 'full'")
+    if max_lag is not None:
+        lags = lags[np.abs(lags) <= int(max_lag)]
+    return lags
+
+
+def get_corr(epoch1, epoch2, baseline=None, normal=False, mode='same', norm=True,
+             max_lag=None, block_size=32, return_lags=False, n_jobs=1, callback=None):
+    '''
+    Calculate cross-correlation between every channel of epoch1 and every
+    channel of epoch2, averaged over epochs
+    :param epoch1: instance of BaseEpochs | numpy.array
+                   seed channels, shape (n_epochs, n_chanx, n_times) if numpy.array
+    :param epoch2: instance of BaseEpochs | numpy.array
+                   target channels, shape (n_epochs, n_chany, n_times) if numpy.array
+    :param baseline: tuple | None
+                     standardize the epochs with the baseline before
+                     calculating, only for BaseEpochs
+    :param normal: bool
+                   use min-max normalization instead of z-score
+    :param mode: str
+                 'valid' | 'same' | 'full', the same as scipy.signal.correlate
+    :param norm: bool
+                 normalize by sqrt(sum(x ** 2) * sum(y ** 2)) of each
+                 epoch so that the result lies in [-1, 1]
+    :param max_lag: int | None
+                    maximum lag in samples, None keeps all the lags of mode
+    :param block_size: int
+                       number of epochs transformed at once
+    :param return_lags: bool
+                        also return the lags in samples
+    :param n_jobs: int
+                   number of worker processes over the channels of epoch1,
+                   used for each block of epochs
+    :param callback: function | None
+                     called with the epochs done and the total after every
+                     block, an exception raised by it stops the calculation
+    :return: numpy.array
+             corr, shape (n_chanx, n_chany, n_lags)
+    '''
+    from scipy.fftpack import next_fast_len
+
+    if baseline is not None:
+        epoch1 = standardize_epoch(epoch1, baseline, normal=normal)
+        epoch2 = standardize_epoch(epoch2, baseline, normal=normal)
+        try:
+            epoch1 = epoch1.crop(0.)
+            epoch2 = epoch2.crop(0.)
+        except:
+            pass
+    n_epochs = _n_epochs(epoch1)
+    if not n_epochs == _n_epochs(epoch2):
+        raise TypeError('This is not the same epoch')
+    block_size = max(int(block_size), 1)
+
+    n_times = _epoch_block(epoch1, 0, 1).shape[-1]
+    lags = _corr_lags(n_times, mode=mode, max_lag=max_lag)
+    # zero-padding to n_times + max lag avoids circular wrap-around
+    n_fft = next_fast_len(n_times + int(np.abs(lags).max()))
+
+    spec = None
+    for start in range(0, n_epochs, block_size):
+        stop = min(start + block_size, n_epochs)
+        print('calculating epoch ' + str(start) + ' - ' + str(stop - 1))
+        datax = np.asarray(_epoch_block(epoch1, start, stop), dtype=np.float64)
+        datay = np.asarray(_epoch_block(epoch2, start, stop), dtype=np.float64)
+        # rFFT of every channel once per epoch
+        fftx = np.fft.rfft(datax, n=n_fft, axis=-1)
+        ffty = np.fft.rfft(datay, n=n_fft, axis=-1)
         if norm:
-            print ('calculate normalized cross-correlation')
-            trans = np.zeros ((1, len (epoch2.ch_names), 1))
-            for i in range (data2.shape[0]):
-                trans_tmp = np.array ([])
-                for j in range (data2.shape[1]):
-                    n = np.sqrt (np.dot (data1[i, 0, :], data1[i, 0, :].T) *
-                                 np.dot (data2[i, j, :], data2[i, j, :].T))
-                    trans_tmp = np.expand_dims (np.append (trans_tmp, np.array ([n])), axis=1)
-                trans = np.vstack ((trans, np.expand_dims (trans_tmp, axis=0)))
-            trans = np.delete (trans, 0, axis=0)
-            corr = np.true_divide (corr, trans)
-        corr = np.mean(corr, axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fftx /= np.sqrt((datax ** 2).sum(axis=-1, keepdims=True))
+                ffty /= np.sqrt((datay ** 2).sum(axis=-1, keepdims=True))
+        # all seed-by-target spectral products, summed over the epochs
+        if n_jobs > 1:
+            n_x = fftx.shape[1]
+            block = parallel_blocks(np.concatenate((fftx, ffty), axis=1), _cross_spec_rows,
+                                    (np.arange(n_x), ), n_jobs=n_jobs, n_x=n_x)
+        else:
+            block = np.einsum('exf,eyf->xyf', fftx, ffty.conj(), optimize=True)
+        spec = block if spec is None else spec + block
+        if callback is not None:
+            callback(stop, n_epochs)
+
+    spec /= n_epochs
+    corr = np.fft.irfft(spec, n=n_fft, axis=-1)[..., lags % n_fft]
+
+    if return_lags:
+        return corr, lags
     return corr
 
 
-def get_mutual_info():
-    pass
+def _lagged_cov(epoch, max_lag, block_size=32, callback=None):
+    '''
+    Lagged covariance R(k) = E[x(t) x(t - k).T] pooled over epochs
+    :param epoch: instance of BaseEpochs | numpy.array
+    :param max_lag: int
+    :param block_size: int
+                       number of epochs used at once
+    :param callback: function | None
+                     called with the epochs done and the total
+    :return: numpy.array
+             shape (max_lag + 1, n_chan, n_chan)
+    '''
+    n_epochs = _n_epochs(epoch)
+    cov = None
+    n_obs = 0
+    for start in range(0, n_epochs, block_size):
+        stop = min(start + block_size, n_epochs)
+        data = np.asarray(_epoch_block(epoch, start, stop), dtype=np.float64)
+        data = data - data.mean(axis=-1, keepdims=True)
+        n_times = data.shape[-1]
+        if cov is None:
+            cov = np.zeros((max_lag + 1, data.shape[1], data.shape[1]))
+        for k in range(max_lag + 1):
+            cov[k] += np.tensordot(data[:, :, k:], data[:, :, :n_times - k],
+                                   axes=([0, 2], [0, 2]))
+        n_obs += data.shape[0] * n_times
+        if callback is not None:
+            callback(stop, n_epochs)
+    return cov / n_obs, n_obs
+
+
+def _lwr(cov, order):
+    '''
+    Fit VAR models with the Levinson-Whittle-Wiggins-Robinson recursion,
+    works on a batch of models at once
+    :param cov: numpy.array
+                lagged covariance, shape (..., order + 1, n, n)
+    :param order: int
+                  model order
+    :return: coef, sigma, sigmas
+             coef: shape (..., order, n, n)
+             sigma: residual covariance of the model, shape (..., n, n)
+             sigmas: list of the residual covariance of orders 1 ... order
+    '''
+    def t(x):
+        return np.swapaxes(x, -1, -2)
+
+    n = cov.shape[-1]
+    batch = cov.shape[:-3]
+    coef_f = np.zeros(batch + (order, n, n))
+    coef_b = np.zeros(batch + (order, n, n))
+    sigma_f = cov[..., 0, :, :].copy()
+    sigma_b = sigma_f.copy()
+    sigmas = []
+    for m in range(1, order + 1):
+        delta = cov[..., m, :, :].copy()
+        for k in range(1, m):
+            delta -= coef_f[..., k - 1, :, :] @ cov[..., m - k, :, :]
+        a_m = delta @ np.linalg.pinv(sigma_b)
+        b_m = t(delta) @ np.linalg.pinv(sigma_f)
+        a_old = coef_f[..., :m - 1, :, :].copy()
+        b_old = coef_b[..., :m - 1, :, :].copy()
+        for k in range(1, m):
+            coef_f[..., k - 1, :, :] = a_old[..., k - 1, :, :] - a_m @ b_old[..., m - k - 1, :, :]
+            coef_b[..., k - 1, :, :] = b_old[..., k - 1, :, :] - b_m @ a_old[..., m - k - 1, :, :]
+        coef_f[..., m - 1, :, :] = a_m
+        coef_b[..., m - 1, :, :] = b_m
+        sigma_f = sigma_f - a_m @ t(delta)
+        sigma_b = sigma_b - b_m @ delta
+        sigmas.append(sigma_f)
+    return coef_f, sigma_f, sigmas
+
+
+def _var_order(cov, n_obs, criterion='bic'):
+    '''
+    Choose the VAR model order of all the channels by information criterion
+    :param cov: numpy.array
+                lagged covariance, shape (max_order + 1, n_chan, n_chan)
+    :param n_obs: int
+                  number of samples used
+    :param criterion: str
+                      'bic' | 'aic'
+    :return: int
+             model order
+    '''
+    n_chan = cov.shape[-1]
+    _, _, sigmas = _lwr(cov, cov.shape[0] - 1)
+    ic = []
+    for p, sigma in enumerate(sigmas, 1):
+        n_para = p * n_chan ** 2
+        if criterion == 'aic':
+            penalty = 2. * n_para / n_obs
+        elif criterion == 'bic':
+            penalty = np.log(n_obs) * n_para / n_obs
+        else:
+            raise ValueError("criterion should be 'bic' or 'aic'")
+        ic.append(np.linalg.slogdet(sigma)[1] + penalty)
+    return int(np.argmin(ic)) + 1
+
+
+def _pair_granger(cov, rows, cols, order, freqs, sfreq):
+    '''
+    Granger causality of bivariate models fitted for all the pairs at once
+    :param cov: numpy.array
+                lagged covariance, shape (>= order + 1, n_chan, n_chan)
+    :param rows, cols: numpy.array
+                       channel pairs
+    :return: gc_rc, gc_cr, spec_rc, spec_cr
+             time-domain and spectral granger causality of row -> col
+             and col -> row, shape (n_pairs, ) and (n_pairs, n_freqs)
+    '''
+    cov = cov[:order + 1]
+    pair = np.stack((rows, cols), axis=1)
+    # (n_pairs, order + 1, 2, 2)
+    cov_pair = np.moveaxis(cov[:, pair[:, :, None], pair[:, None, :]], 0, 1)
+    coef, sigma, _ = _lwr(cov_pair, order)
+    # restricted models: univariate AR of each channel
+    chans = np.arange(cov.shape[-1])
+    cov_self = np.moveaxis(cov[:, chans, chans], 0, 1)[..., None, None]
+    _, sigma_self, _ = _lwr(cov_self, order)
+    sigma_self = sigma_self[:, 0, 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gc_rc = np.log(sigma_self[cols] / sigma[:, 1, 1])
+        gc_cr = np.log(sigma_self[rows] / sigma[:, 0, 0])
+
+        # transfer function H(f) of the VAR gives the spectral factorization
+        # S(f) = H(f) sigma H(f)*
+        lags = np.arange(1, order + 1)
+        phase = np.exp(-2j * np.pi * np.outer(freqs, lags) / sfreq)
+        trans = np.eye(2) - np.einsum('pkab,fk->pfab', coef, phase)
+        h = np.linalg.inv(trans)
+        spec = h @ sigma[:, None] @ np.conj(np.swapaxes(h, -1, -2))
+        s_00, s_01, s_11 = sigma[:, 0, 0, None], sigma[:, 0, 1, None], sigma[:, 1, 1, None]
+        spec_rc = np.log(spec[..., 1, 1].real / (spec[..., 1, 1].real -
+                         (s_00 - s_01 ** 2 / s_11) * np.abs(h[..., 1, 0]) ** 2))
+        spec_cr = np.log(spec[..., 0, 0].real / (spec[..., 0, 0].real -
+                         (s_11 - s_01 ** 2 / s_00) * np.abs(h[..., 0, 1]) ** 2))
+    return gc_rc, gc_cr, spec_rc, spec_cr
+
+
+def get_granger(epochx, epochy=None, order=None, max_order=20, criterion='bic',
+                sfreq=None, n_freqs=100, block_size=32, callback=None):
+    '''
+    Calculate Granger causality with bivariate autoregressive models
+    fitted across epochs
+    :param epochx: instance of BaseEpochs | numpy.array
+                   seed channels, or all the channels if epochy is None
+    :param epochy: instance of BaseEpochs | numpy.array | None
+                   target channels
+    :param order: int | None
+                  model order, None chooses it by criterion
+    :param max_order: int
+                      maximum model order tested
+    :param criterion: str
+                      'bic' | 'aic'
+    :param sfreq: float | None
+                  sampling frequency, needed for numpy.array
+    :param n_freqs: int
+                    number of frequencies between 0 and the nyquist frequency
+    :param block_size: int
+                       number of epochs used at once
+    :param callback: function | None
+                     called with the epochs done and the total while the
+                     lagged covariance is pooled, an exception raised by it
+                     stops the calculation
+    :return: gc, gc_spec, freqs
+             gc: time-domain granger causality, shape (n_chanx, n_chany) from
+                 the seed channels to the target channels, or
+                 (n_chan, n_chan) from row to column if epochy is None
+             gc_spec: spectral granger causality, shape (..., n_freqs)
+             freqs: numpy.array
+    '''
+    if sfreq is None:
+        if not isinstance(epochx, BaseEpochs):
+            raise ValueError('sfreq is needed for numpy.array')
+        sfreq = epochx.info['sfreq']
+    n_epochs = _n_epochs(epochx)
+    if epochy is not None:
+        if not n_epochs == _n_epochs(epochy):
+            raise TypeError('This is not the same epoch')
+        data = np.concatenate((_epoch_block(epochx, 0, n_epochs),
+                               _epoch_block(epochy, 0, n_epochs)), axis=1)
+    else:
+        data = epochx
+    max_lag = max_order if order is None else order
+    cov, n_obs = _lagged_cov(data, max_lag, block_size=block_size, callback=callback)
+    if order is None:
+        order = _var_order(cov, n_obs, criterion=criterion)
+    print('model order of granger causality: ' + str(order))
+    freqs = np.linspace(0., sfreq / 2., n_freqs)
+
+    if epochy is None:
+        n_chan = cov.shape[-1]
+        rows, cols = np.tril_indices(n_chan, -1)
+        gc_rc, gc_cr, spec_rc, spec_cr = _pair_granger(cov, rows, cols, order, freqs, sfreq)
+        gc = np.zeros((n_chan, n_chan))
+        gc[rows, cols], gc[cols, rows] = gc_rc, gc_cr
+        gc_spec = np.zeros((n_chan, n_chan, n_freqs))
+        gc_spec[rows, cols], gc_spec[cols, rows] = spec_rc, spec_cr
+    else:
+        n_x = _epoch_block(epochx, 0, 1).shape[1]
+        n_y = cov.shape[-1] - n_x
+        rows, cols = _cross_pairs(n_x, n_y)
+        gc, _, gc_spec, _ = _pair_granger(cov, rows, cols, order, freqs, sfreq)
+        gc = gc.reshape(n_x, n_y)
+        gc_spec = gc_spec.reshape(n_x, n_y, n_freqs)
+
+    return gc, gc_spec, freqs
+
+
+def _one_hot(code, n_codes, dtype=np.float32):
+    '''
+    One-hot matrix of the symbols of every row
+    :param code: numpy.array
+                 integer symbols in [0, n_codes), shape (n_rows, n_samples)
+    :return: numpy.array
+             shape (n_samples, n_rows * n_codes)
+    '''
+    n_rows, n_samples = code.shape
+    one_hot = np.zeros((n_samples, n_rows * n_codes), dtype=dtype)
+    one_hot[np.arange(n_samples)[:, np.newaxis], code.T + np.arange(n_rows) * n_codes] = 1
+    return one_hot
+
+
+def _entropy_counts(count, axis):
+    '''
+    Plug-in entropy (nats) from the counts of the symbols along axis
+    '''
+    n = count.sum(axis=axis)
+    plogp = (count * np.log(np.maximum(count, 1))).sum(axis=axis)
+    return np.log(n) - plogp / n
+
+
+def _delay_embed(data, k, tau, lags, binned=True, n_bins=4, max_samples=None, seed=0):
+    '''
+    Delay embedding of every channel, computed once and shared by all the pairs
+    :param data: numpy.array
+                 shape (n_epochs, n_chan, n_times)
+    :param k: int
+              embedding dimension of the target's past
+    :param tau: int
+                embedding delay in samples
+    :param lags: list of int
+                 source lags in samples
+    :param binned: bool
+                   symbolize with n_bins equiprobable bins, else keep the
+                   rank-normalized values
+    :param max_samples: int | None
+                        randomly keep at most max_samples time points
+    :return: numpy.array
+             binned: shape (n_chan, 2 + n_lags, n_samples), rows are
+                     present, past code, source at each lag
+             else: shape (n_chan, 1 + k + n_lags, n_samples), rows are
+                   present, past values 1 ... k, source at each lag
+    '''
+    from scipy.stats import rankdata
+
+    n_epochs, n_chan, n_times = data.shape
+    start = max((k - 1) * tau + 1, max(lags))
+    times = np.arange(start, n_times)
+    if max_samples is not None and n_epochs * len(times) > max_samples:
+        rng = np.random.RandomState(seed)
+        pick = np.sort(rng.choice(n_epochs * len(times), int(max_samples), replace=False))
+    else:
+        pick = slice(None)
+
+    def take(shift):
+        # (n_chan, n_epochs * n_used_times), time points shifted back by shift
+        return data[:, :, times - shift].transpose((1, 0, 2)).reshape(n_chan, -1)[:, pick]
+
+    # rank-normalize each channel over all the epochs and time points
+    value = np.empty((n_chan, n_epochs * n_times))
+    flat = data.transpose((1, 0, 2)).reshape(n_chan, -1)
+    for c in range(n_chan):
+        value[c] = rankdata(flat[c]) / flat.shape[1]
+    data = value.reshape(n_chan, n_epochs, n_times).transpose((1, 0, 2))
+    if binned:
+        data = np.minimum((data * n_bins).astype(np.int64), n_bins - 1)
+        past = np.zeros_like(take(1))
+        for i in range(k):
+            past = past * n_bins + take(1 + i * tau)
+        rows = [take(0), past] + [take(lag) for lag in lags]
+    else:
+        rows = [take(0)] + [take(1 + i * tau) for i in range(k)] + [take(lag) for lag in lags]
+    return np.stack(rows, axis=1)
+
+
+def _te_binned_pairs(emb, rows, cols, n_bins, k):
+    '''
+    Binned transfer entropy rows -> cols at every lag, the joint histograms
+    of all the sources and targets of the block come from one matrix product
+    of their one-hot symbols, the histograms of the targets are shared by
+    all the sources
+    :param emb: numpy.array
+                binned delay embedding from _delay_embed
+    :return: numpy.array
+             shape (n_pairs, n_lags)
+    '''
+    n_lags = emb.shape[1] - 2
+    n_samples = emb.shape[-1]
+    n_past = n_bins ** k
+    sources, source_index = np.unique(rows, return_inverse=True)
+    targets, target_index = np.unique(cols, return_inverse=True)
+    # joint symbol of the target's present and past
+    present_past = emb[targets, 0] + n_bins * emb[targets, 1]
+    # about 64 MB of one-hot targets at once, the counts stay exact in float32
+    step = max(min(2 ** 24 // (len(targets) * n_bins * n_past), 2 ** 24), 1)
+    count = np.zeros((n_lags, len(sources) * n_bins, len(targets) * n_bins * n_past))
+    for start in range(0, n_samples, step):
+        samples = slice(start, start + step)
+        one_hot = _one_hot(present_past[:, samples], n_bins * n_past)
+        for i in range(n_lags):
+            count[i] += _one_hot(emb[sources, 2 + i, samples], n_bins).T @ one_hot
+    # (lag, source, x, target, past, present)
+    count = count.reshape(n_lags, len(sources), n_bins, len(targets), n_past, n_bins)
+    # entropies of shape (lag, source, target), or (target, ) of the target alone
+    h_all = _entropy_counts(count, axis=(2, 4, 5))
+    h_x_past = _entropy_counts(count.sum(axis=-1), axis=(2, 4))
+    target_count = count[0, 0].sum(axis=0)
+    h_present_past = _entropy_counts(target_count, axis=(1, 2))
+    h_past = _entropy_counts(target_count.sum(axis=-1), axis=1)
+    te = h_present_past + h_x_past - h_all - h_past
+    return te[:, source_index, target_index].T
+
+
+def _te_ksg_pairs(emb, rows, cols, k, n_neighbors):
+    '''
+    Kraskov-Stoegbauer-Grassberger (KSG) transfer entropy rows -> cols at
+    every lag, the neighbours are searched with KD-trees in max-norm
+    :param emb: numpy.array
+                delay embedding from _delay_embed(binned=False)
+    :return: numpy.array
+             shape (n_pairs, n_lags)
+    '''
+    from scipy.spatial import cKDTree
+    from scipy.special import digamma
+
+    n_lags = emb.shape[1] - 1 - k
+    rng = np.random.RandomState(0)
+    # tiny noise breaks the ties of the rank values
+    emb = emb + 1e-10 * rng.standard_normal(emb.shape)
+    te = np.zeros((len(rows), n_lags))
+    trees = dict()
+    for p, (source, target) in enumerate(zip(rows, cols)):
+        present = emb[target, :1].T
+        past = emb[target, 1:1 + k].T
+        if target not in trees:
+            trees[target] = (cKDTree(past), cKDTree(np.hstack((present, past))))
+        tree_past, tree_present_past = trees[target]
+        for i in range(n_lags):
+            x = emb[source, 1 + k + i][:, np.newaxis]
+            joint = np.hstack((present, past, x))
+            dist, _ = cKDTree(joint).query(joint, k=n_neighbors + 1, p=np.inf)
+            # strictly closer than the k-th neighbour
+            radius = np.nextafter(dist[:, -1], 0)
+            xz = np.hstack((x, past))
+            n_z = tree_past.query_ball_point(past, radius, p=np.inf, return_length=True)
+            n_yz = tree_present_past.query_ball_point(np.hstack((present, past)), radius,
+                                                      p=np.inf, return_length=True)
+            n_xz = cKDTree(xz).query_ball_point(xz, radius, p=np.inf, return_length=True)
+            te[p, i] = digamma(n_neighbors) + np.mean(digamma(n_z) - digamma(n_yz) - digamma(n_xz))
+    return te
+
+
+def get_transfer_entropy(epochx, epochy=None, lags=(1, 2, 3, 4, 5), k=1, tau=1,
+                         estimator='binned', n_bins=4, n_neighbors=4, max_samples=5000,
+                         screen=0.1, n_jobs=1, callback=None):
+    '''
+    Calculate transfer entropy between channels
+    :param epochx: instance of BaseEpochs | numpy.array
+                   source channels, or all the channels if epochy is None
+    :param epochy: instance of BaseEpochs | numpy.array | None
+                   target channels
+    :param lags: list of int
+                 source lags in samples, the one with the largest transfer
+                 entropy is chosen for each pair
+    :param k: int
+              embedding dimension of the target's past
+    :param tau: int
+                embedding delay in samples
+    :param estimator: str
+                      'binned': fast estimator with n_bins equiprobable bins
+                      'ksg': KD-tree nearest-neighbour estimator
+                      'hybrid': binned for all the pairs, then KSG for the
+                      strongest screen fraction of pairs at their best lag,
+                      te only holds the KSG values and is 0 for the other
+                      pairs
+    :param n_bins: int
+                   number of bins of the binned estimator
+    :param n_neighbors: int
+                        number of neighbours of the KSG estimator
+    :param max_samples: int | None
+                        number of time points used by KSG
+    :param screen: float
+                   fraction of the pairs refined by KSG in 'hybrid'
+    :param n_jobs: int
+                   number of worker processes over the channel pairs
+    :param callback: function | None
+                     called with the pairs done and the total after every
+                     block, an exception raised by it stops the calculation
+                     of the binned pass, then of the KSG pass in 'hybrid'
+    :return: te, lag
+             te: transfer entropy (nats), shape (n_chanx, n_chany) from the
+                 source channels to the target channels, or
+                 (n_chan, n_chan) from row to column if epochy is None
+             lag: the chosen lag in samples, the same shape as te
+    '''
+    if estimator not in ['binned', 'ksg', 'hybrid']:
+        raise ValueError("estimator should be 'binned', 'ksg' or 'hybrid'")
+    lags = [int(lag) for lag in lags]
+    n_epochs = _n_epochs(epochx)
+    if epochy is not None:
+        if not n_epochs == _n_epochs(epochy):
+            raise TypeError('This is not the same epoch')
+        data = np.concatenate((_epoch_block(epochx, 0, n_epochs),
+                               _epoch_block(epochy, 0, n_epochs)), axis=1)
+        n_x = data.shape[1] - _epoch_block(epochy, 0, 1).shape[1]
+        rows, cols = _cross_pairs(n_x, data.shape[1] - n_x)
+    else:
+        data = _epoch_block(epochx, 0, n_epochs)
+        rows, cols = np.nonzero(~np.eye(data.shape[1], dtype=bool))
+    data = np.asarray(data, dtype=np.float64)
+
+    if estimator == 'ksg':
+        emb = _delay_embed(data, k, tau, lags, binned=False, max_samples=max_samples)
+        te_lag = parallel_blocks(emb, _te_ksg_pairs, (rows, cols), n_jobs=n_jobs,
+                                 callback=callback, k=k, n_neighbors=n_neighbors)
+    else:
+        emb = _delay_embed(data, k, tau, lags, binned=True, n_bins=n_bins)
+        te_lag = parallel_blocks(emb, _te_binned_pairs, (rows, cols), n_jobs=n_jobs,
+                                 callback=callback, n_bins=n_bins, k=k)
+    best = np.argmax(te_lag, axis=1)
+    value = te_lag[np.arange(len(best)), best]
+
+    if estimator == 'hybrid':
+        n_refine = max(int(np.ceil(screen * len(value))), 1)
+        refine = np.argsort(value)[::-1][:n_refine]
+        # the binned values only screen the pairs, they are not comparable
+        # with the bias-corrected KSG values
+        value = np.zeros(len(value))
+        done = 0
+        for i in np.unique(best[refine]):
+            pairs = refine[best[refine] == i]
+            emb = _delay_embed(data, k, tau, [lags[i]], binned=False, max_samples=max_samples)
+
+            def refine_callback(n_done, total, done=done):
+                callback(done + n_done, n_refine)
+
+            value[pairs] = parallel_blocks(emb, _te_ksg_pairs, (rows[pairs], cols[pairs]),
+                                           n_jobs=n_jobs, k=k, n_neighbors=n_neighbors,
+                                           callback=None if callback is None else
+                                           refine_callback)[:, 0]
+            done += len(pairs)
+
+    lag = np.array(lags)[best]
+    if epochy is not None:
+        shape = (n_x, data.shape[1] - n_x)
+        return value.reshape(shape), lag.reshape(shape)
+    te = np.zeros((data.shape[1], data.shape[1]))
+    te_lag = np.zeros((data.shape[1], data.shape[1]), dtype=np.int64)
+    te[rows, cols], te_lag[rows, cols] = value, lag
+    return te, te_lag
+
+
+def _copula_normal(data):
+    '''
+    Gaussian-copula normalization of every row: ranks mapped to standard
+    normal quantiles
+    :param data: numpy.array
+                 shape (n_chan, n_samples)
+    '''
+    from scipy.special import ndtri
+
+    rank = np.argsort(np.argsort(data, axis=-1), axis=-1)
+    return ndtri((rank + 1.) / (data.shape[-1] + 1.))
+
+
+def _mi_gaussian(x, y):
+    '''
+    Gaussian-copula mutual information (nats) of all the row pairs, the pair
+    entropies come from the shared covariance matrix
+    :param x: numpy.array
+              shape (n_x, n_samples)
+    :param y: numpy.array
+              shape (n_y, n_samples)
+    :return: numpy.array
+             shape (n_x, n_y)
+    '''
+    x, y = _copula_normal(x), _copula_normal(y)
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    var_x = np.einsum('ij,ij->i', x, x)
+    var_y = np.einsum('ij,ij->i', y, y)
+    cov = np.dot(x, y.T)
+    # H(x) + H(y) - H(x, y), the 2*pi*e constants cancel
+    det = np.outer(var_x, var_y) - cov ** 2
+    det = np.maximum(det, np.finfo(float).tiny)
+    return 0.5 * (np.log(var_x)[:, np.newaxis] + np.log(var_y)[np.newaxis, :] - np.log(det))
+
+
+def _mi_binned(x, y, n_bins, block_size):
+    '''
+    Binned mutual information (nats) of all the row pairs with n_bins
+    equiprobable bins, the joint histograms of every pair come from one
+    one-hot matrix product per block of samples
+    :param x: numpy.array
+              shape (n_x, n_samples)
+    :param y: numpy.array
+              shape (n_y, n_samples)
+    :return: numpy.array
+             shape (n_x, n_y)
+    '''
+    def symbol(data):
+        rank = np.argsort(np.argsort(data, axis=-1), axis=-1)
+        return rank * n_bins // data.shape[-1]
+
+    def entropy(count):
+        prob = count / float(n_samples)
+        return -np.sum(np.where(prob > 0, prob * np.log(np.maximum(prob, 1e-300)), 0.), axis=-1)
+
+    def one_hot(sym, start, stop):
+        code = sym[:, start:stop] + n_bins * np.arange(sym.shape[0])[:, np.newaxis]
+        hot = np.zeros((sym.shape[0] * n_bins, stop - start), dtype=np.float32)
+        hot[code, np.arange(stop - start)] = 1.
+        return hot
+
+    n_samples = x.shape[-1]
+    sym_x, sym_y = symbol(x), symbol(y)
+    count = np.zeros((len(x) * n_bins, len(y) * n_bins))
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        count += np.dot(one_hot(sym_x, start, stop), one_hot(sym_y, start, stop).T)
+    count = count.reshape(len(x), n_bins, len(y), n_bins).transpose((0, 2, 1, 3))
+    # marginals are shared by all the pairs of a channel
+    h_x = entropy(np.stack([np.bincount(s, minlength=n_bins) for s in sym_x]))
+    h_y = entropy(np.stack([np.bincount(s, minlength=n_bins) for s in sym_y]))
+    h_xy = entropy(count.reshape(len(x), len(y), -1))
+    return h_x[:, np.newaxis] + h_y[np.newaxis, :] - h_xy
+
+
+def get_mutual_info(epochx, epochy=None, estimator='gcmi', n_bins=8, win=None, step=None,
+                    block_size=10000, callback=None):
+    '''
+    Calculate mutual information between channels, the samples of all the
+    epochs are pooled
+    :param epochx: instance of BaseEpochs | numpy.array
+                   data needed to be calculated
+    :param epochy: instance of BaseEpochs | numpy.array | None
+                   if None, all the channel pairs of epochx are calculated
+    :param estimator: str
+                      'gcmi': Gaussian-copula estimator
+                      'binned': histogram estimator with n_bins equiprobable bins
+    :param n_bins: int
+                   number of bins of the histogram estimator
+    :param win: int | None
+                length of the sliding window in samples,
+                if None the whole epoch is used
+    :param step: int | None
+                 step of the sliding window in samples, default win
+    :param block_size: int
+                       number of samples in one histogram block
+    :param callback: function | None
+                     called with the windows done and the total, the whole
+                     epoch being one window if win is None; an exception
+                     raised by it stops the calculation
+    :return: mi | (mi, centers)
+             mi: mutual information (nats), shape (n_chanx, n_chany) or
+                 (n_chanx, n_chany, n_windows) if win is not None
+             centers: the center sample of every window, only if win is not None
+    '''
+    if estimator == 'gcmi':
+        func = _mi_gaussian
+    elif estimator == 'binned':
+        func = lambda x, y: _mi_binned(x, y, n_bins, block_size)
+    else:
+        raise ValueError("estimator should be 'gcmi' or 'binned'")
+    n_epochs = _n_epochs(epochx)
+    datax = np.asarray(_epoch_block(epochx, 0, n_epochs), dtype=np.float64)
+    if epochy is not None:
+        if not n_epochs == _n_epochs(epochy):
+            raise TypeError('This is not the same epoch')
+        datay = np.asarray(_epoch_block(epochy, 0, n_epochs), dtype=np.float64)
+    else:
+        datay = None
+
+    def pool(data, start, stop):
+        # (n_chan, n_epochs * n_times)
+        return data[:, :, start:stop].transpose((1, 0, 2)).reshape(data.shape[1], -1)
+
+    def calculate(start, stop):
+        x = pool(datax, start, stop)
+        mi = func(x, x if datay is None else pool(datay, start, stop))
+        if datay is None:
+            np.fill_diagonal(mi, 0.)
+        return mi
+
+    n_times = datax.shape[-1]
+    if win is None:
+        mi = calculate(0, n_times)
+        if callback is not None:
+            callback(1, 1)
+        return mi
+    win = int(win)
+    step = win if step is None else int(step)
+    starts = np.arange(0, n_times - win + 1, step)
+    mi = []
+    for start in starts:
+        mi.append(calculate(start, start + win))
+        if callback is not None:
+            callback(len(mi), len(starts))
+    return np.stack(mi, axis=-1), starts + win // 2
+
+
+def _band_envelope(data, sfreq, band, order=4):
+    '''
+    Band-pass filter and Hilbert transform all the channels of all the epochs
+    in one pass
+    :param data: numpy.array
+                 shape (n_epochs, n_chan, n_times)
+    :param band: tuple | None
+                 (l_freq, h_freq), either may be None for a low-pass or
+                 high-pass, None for no filter
+    :return: numpy.array
+             analytic signal, shape (n_epochs, n_chan, n_times)
+    '''
+    from scipy.signal import butter, sosfiltfilt, hilbert
+    from scipy.fftpack import next_fast_len
+
+    l_freq, h_freq = (None, None) if band is None else band
+    nyq = sfreq / 2.
+    if l_freq is not None and h_freq is not None:
+        sos = butter(order, [l_freq / nyq, h_freq / nyq], btype='bandpass', output='sos')
+    elif l_freq is not None:
+        sos = butter(order, l_freq / nyq, btype='highpass', output='sos')
+    elif h_freq is not None:
+        sos = butter(order, h_freq / nyq, btype='lowpass', output='sos')
+    else:
+        sos = None
+    if sos is not None:
+        data = sosfiltfilt(sos, data, axis=-1)
+    n_times = data.shape[-1]
+    return hilbert(data, N=next_fast_len(n_times), axis=-1)[..., :n_times]
+
+
+def _envelope_corr(x, y, orthogonalize, block_size=8):
+    '''
+    Pearson correlation of the envelopes of one epoch
+    :param x: numpy.array
+              analytic signal, shape (n_x, n_times)
+    :param y: numpy.array
+              analytic signal, shape (n_y, n_times)
+    :param orthogonalize: bool
+                          orthogonalize each signal on the other before taking
+                          its envelope and average the two directions
+    :param block_size: int
+                       number of seed channels orthogonalized at once
+    :return: numpy.array
+             shape (n_x, n_y)
+    '''
+    tiny = np.finfo(float).tiny
+    env_x, env_y = np.abs(x), np.abs(y)
+    z_x, z_y = _zscore(env_x), _zscore(env_y)
+    if not orthogonalize:
+        return np.dot(z_x, z_y.T)
+
+    def corr(z, orth, subscripts):
+        # z is demeaned with unit norm, so only orth needs its norm
+        n_times = orth.shape[-1]
+        norm = np.sum(orth ** 2, axis=-1) - orth.sum(axis=-1) ** 2 / n_times
+        return np.einsum(subscripts, z, orth) / np.sqrt(np.maximum(norm, tiny))
+
+    unit_x = x / np.maximum(env_x, tiny)
+    unit_y = y / np.maximum(env_y, tiny)
+    con = np.empty((len(x), len(y)))
+    # blocks of seed rows keep the (block, n_y, n_times) temporaries small
+    for start in range(0, len(x), block_size):
+        sl = slice(start, start + block_size)
+        # |Im(y * conj(x) / |x|)|, y orthogonalized on x
+        y_on_x = np.abs(y.imag[np.newaxis] * unit_x[sl].real[:, np.newaxis] -
+                        y.real[np.newaxis] * unit_x[sl].imag[:, np.newaxis])
+        x_on_y = np.abs(x[sl].imag[:, np.newaxis] * unit_y.real[np.newaxis] -
+                        x[sl].real[:, np.newaxis] * unit_y.imag[np.newaxis])
+        con[sl] = (corr(z_x[sl], y_on_x, 'it,ijt->ij') + corr(z_y, x_on_y, 'jt,ijt->ij')) / 2.
+    return con
+
+
+def get_envelope_corr(epochx, epochy=None, bands=None, sfreq=None, orthogonalize=False,
+                      order=4, callback=None):
+    '''
+    Calculate band-limited amplitude envelope correlation, every channel is
+    filtered and Hilbert transformed once per band, then the envelopes are
+    correlated within each epoch and averaged over epochs
+    :param epochx: instance of BaseEpochs | numpy.array
+                   seed channels, or all the channels if epochy is None
+    :param epochy: instance of BaseEpochs | numpy.array | None
+                   target channels
+    :param bands: list of tuple | None
+                  frequency bands [(l_freq, h_freq), ...], None for the
+                  broadband envelope
+    :param sfreq: float | None
+                  sampling rate, needed if the data is numpy.array
+    :param orthogonalize: bool
+                          orthogonalize the signals pairwise to remove zero-lag
+                          (volume conduction) coupling
+    :param order: int
+                  order of the Butterworth filter
+    :param callback: function | None
+                     called with the epochs done over all the bands and the
+                     total, an exception raised by it stops the calculation
+    :return: numpy.array
+             shape (n_chanx, n_chany, n_bands)
+    '''
+    if sfreq is None:
+        if not isinstance(epochx, BaseEpochs):
+            raise ValueError('sfreq is needed for numpy.array data')
+        sfreq = epochx.info['sfreq']
+    bands = [None] if bands is None else list(bands)
+    n_epochs = _n_epochs(epochx)
+    data = np.asarray(_epoch_block(epochx, 0, n_epochs), dtype=np.float64)
+    n_x = data.shape[1]
+    if epochy is not None:
+        if not n_epochs == _n_epochs(epochy):
+            raise TypeError('This is not the same epoch')
+        data = np.concatenate((data, np.asarray(_epoch_block(epochy, 0, n_epochs),
+                                                dtype=np.float64)), axis=1)
+
+    con = np.zeros((n_x, data.shape[1] - n_x if epochy is not None else n_x, len(bands)))
+    for i, band in enumerate(bands):
+        analytic = _band_envelope(data, sfreq, band, order)
+        for j, epoch in enumerate(analytic):
+            x = epoch[:n_x]
+            con[:, :, i] += _envelope_corr(x, epoch[n_x:] if epochy is not None else x,
+                                           orthogonalize)
+            if callback is not None:
+                callback(i * n_epochs + j + 1, len(bands) * n_epochs)
+    con /= n_epochs
+    if epochy is None:
+        con[np.arange(n_x), np.arange(n_x)] = 0. if orthogonalize else 1.
+    return con
 
 
 
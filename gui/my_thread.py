@@ -5,14 +5,99 @@
 @Desc: create the threads for the main window
 """
 
+import os
+import time
+import threading
 import traceback
+from collections import OrderedDict
 import numpy as np
 from mne import io
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
 import mne
 from mne.time_frequency import tfr_morlet, psd_multitaper, psd_welch, \
                             tfr_stockwell, tfr_multitaper
 from mne.connectivity import spectral_connectivity
+try:
+    from gui.my_class import Tri_Con
+    from gui.my_func import parallel_blocks, _spec_con_pairs, _multitaper_chans, \
+        _mt_spectra_chans, _spec_con_spectra_pairs
+except:
+    from my_class import Tri_Con
+    from my_func import parallel_blocks, _spec_con_pairs, _multitaper_chans, \
+        _mt_spectra_chans, _spec_con_spectra_pairs
+try:
+    from gui.data_io import write_raw_edf, update_workspace, snapshot_workspace, commit_workspace, \
+        read_raw_file, batch_read_raw, \
+        catalog_para, annotation_events, load_raw_chunked, raw_like, raw_memmap, memmap_fname, \
+        remove_memmap
+except:
+    from data_io import write_raw_edf, update_workspace, snapshot_workspace, commit_workspace, \
+        read_raw_file, batch_read_raw, \
+        catalog_para, annotation_events, load_raw_chunked, raw_like, raw_memmap, memmap_fname, \
+        remove_memmap
+try:
+    from gui.re_ref import _fir_zero_phase, _fir_stream, _iir_stream, _resample_stream, \
+        _line_noise_stream
+except:
+    from re_ref import _fir_zero_phase, _fir_stream, _iir_stream, _resample_stream, \
+        _line_noise_stream
+
+
+def spectral_connectivity_blocks(data, indices, n_jobs=1, callback=None, cache=None,
+                                 para=None, **kwargs):
+    '''
+    mne spectral_connectivity with the channel pairs split into blocks
+    and calculated on a process pool
+    :param data: instance of BaseEpochs
+    :param indices: tuple
+                    (seeds, targets) of the channel pairs
+    :param n_jobs: int
+                   number of worker processes
+    :param callback: function | None
+                     called with the number of pairs done and the total
+    :param cache: instance of Multitaper_Cache | None
+                  in 'multitaper' mode the tapered spectra of the channels
+                  are taken from it, calculated only once, and the workers
+                  only combine them into the pairs
+    :param para: dict | None
+                 parameters from the connectivity window, the key of cache
+    :return: con, freqs, times
+    '''
+    block_size = None
+    if callback is not None:
+        # small enough blocks to report, and to cancel, every second or so
+        block_size = int(np.ceil(len(indices[0]) / max(4 * n_jobs, 16.))) \
+            if indices is not None else None
+    if cache is not None and indices is not None and kwargs.get('mode') == 'multitaper':
+        tmin, tmax = kwargs.get('tmin'), kwargs.get('tmax')
+        if (tmin is not None and tmin > data.tmin) or (tmax is not None and tmax < data.tmax):
+            data = data.copy().crop(tmin, tmax)
+        spectra, freqs = cache.tapered_spectra(data, para, fmin=kwargs.get('fmin'),
+                                               fmax=kwargs.get('fmax'),
+                                               bandwidth=kwargs.get('mt_bandwidth'),
+                                               adaptive=kwargs.get('mt_adaptive', False),
+                                               n_jobs=n_jobs)
+        result = parallel_blocks(spectra, _spec_con_spectra_pairs, indices, n_jobs=n_jobs,
+                                 block_size=block_size, callback=callback,
+                                 method=kwargs.get('method', 'coh'))
+        if kwargs.get('faverage'):
+            result = result.mean(axis=1, keepdims=True)
+            freqs = [freqs]
+        return result, freqs, data.times
+    if indices is None or (n_jobs <= 1 and callback is None):
+        con, freqs, times, n_epochs, n_tapers = spectral_connectivity(
+            data, indices=indices, **kwargs)
+        return con, freqs, times
+    # the workers get a plain array, whose time starts from 0
+    for key in ['tmin', 'tmax']:
+        if kwargs.get(key) is not None:
+            kwargs[key] = kwargs[key] - data.tmin
+    kwargs.setdefault('sfreq', data.info['sfreq'])
+    result = parallel_blocks(data.get_data(), _spec_con_pairs, indices, n_jobs=n_jobs,
+                             block_size=block_size, axis=None, callback=callback, **kwargs)
+    con = np.concatenate([block[0] for block in result], axis=0)
+    freqs, times = result[0][1], result[0][2] + data.tmin
+    return con, freqs, times
 
 
 def show_error(error):
@@ -21,7 +106,171 @@ def show_error(error):
     traceback.print_exc(error)
     print('*********************************************************************')
 
-class Import_Thread(QThread):
+
+class Job_Cancelled(Exception):
+    '''raised by Progress_Thread.report once the job is cancelled'''
+
+
+# stale workers cancelled by stop_worker, kept until their thread ends
+_stale_workers = []
+
+
+def stop_worker(worker):
+    '''
+    cancel a worker whose job is replaced by a new one, without waiting
+    for it: its signals are disconnected so the stale result is dropped
+    :param worker: instance of QThread | None
+    '''
+    _stale_workers[:] = [stale for stale in _stale_workers if stale.isRunning()]
+    if worker is None or not worker.isRunning():
+        return
+    worker.disconnect()
+    if isinstance(worker, Progress_Thread):
+        # a job waiting for this one to end is dropped as well
+        worker.pending = None
+        worker.cancel()
+    # a QThread destroyed while running takes the whole app down
+    _stale_workers.append(worker)
+
+
+class Progress_Thread(QThread):
+    '''
+    a thread reporting the progress of its job
+
+    progress_signal carries a dict of
+        done, total     work processed so far and the whole work
+        unit            unit of done and total, 'bytes', 'channels',
+                        'epochs', 'pairs', 'samples', 'windows' or '%'
+        percent         done / total in percent
+        elapsed         seconds since the job began
+        eta             seconds left estimated from the rate so far,
+                        None before any work is done
+        state           'running', 'finished', 'cancelled' or 'failed'
+    '''
+
+    progress_signal = pyqtSignal(dict)
+    # samples processed between two reports, about a second of work
+    block_samples = 10 ** 7
+    # lazily imported or memmapped raw data is processed chunk by chunk
+    # into a np.memmap file in stream_dir, next to the source data if None,
+    # see memmap_fname; the new data owns the file, see SEEG.release
+    stream_dir = None
+
+    def __init__(self, parent=None):
+        super(Progress_Thread, self).__init__(parent)
+        self.cancelled = False
+        self.done = 0
+        self.total = 1
+        self.unit = '%'
+        self.begin_time = time.time()
+        self.emit_time = 0.
+        self.stream_fname = None
+        # (args, job) of the job started while another one was running
+        self.pending = None
+
+    def start(self, *args, **job):
+        '''
+        start a job, a worker runs one job at a time: a running job is
+        cancelled and the new one starts once it ends, the GUI is not
+        blocked waiting for it
+        :param job: attributes read by the job, set once it can start
+                    since the running job may still read them
+        '''
+        if self.isRunning():
+            if self.pending is None:
+                self.finished.connect(self.start_pending)
+            self.pending = (args, job)
+            self.cancel()
+            return
+        for name, value in job.items():
+            setattr(self, name, value)
+        self.cancelled = False
+        super(Progress_Thread, self).start(*args)
+
+    def start_pending(self):
+        '''start the job waiting for the cancelled one to end'''
+        self.finished.disconnect(self.start_pending)
+        if self.pending is not None:
+            (args, job), self.pending = self.pending, None
+            self.start(*args, **job)
+
+    def replaced(self):
+        '''whether the job is cancelled for a new one, its signals are then stale'''
+        return self.pending is not None
+
+    def cancel(self):
+        '''ask the job to stop at its next report'''
+        self.cancelled = True
+
+    def stop(self):
+        '''cancel the running job and wait until it stops, e.g. on closing the app'''
+        self.pending = None
+        if self.isRunning():
+            self.cancel()
+            self.wait()
+
+    def block_chans(self, n_times):
+        '''number of channels of n_times samples processed between two reports'''
+        return max(int(self.block_samples // max(n_times, 1)), 1)
+
+    @staticmethod
+    def streamed(data):
+        '''whether data is processed from disk to disk'''
+        return isinstance(data, io.BaseRaw) and \
+            (not data.preload or isinstance(data._data, np.memmap))
+
+    def create_stream(self, prefix, data=None):
+        '''a new file for the np.memmap of a streamed job on data'''
+        self.stream_fname = memmap_fname(prefix, data, self.stream_dir)
+        return self.stream_fname
+
+    def remove_stream(self):
+        '''
+        remove the file of a cancelled or failed streamed job, the data
+        using it has to be freed first
+        '''
+        fname, self.stream_fname = self.stream_fname, None
+        if fname is not None:
+            remove_memmap(fname)
+
+    def begin(self, total, unit):
+        self.total = max(total, 1)
+        self.unit = unit
+        self.begin_time = time.time()
+        self.emit_time = 0.
+        self.report(0)
+
+    def report(self, done, total=None):
+        '''report the work done, raise Job_Cancelled if the job is cancelled'''
+        if self.cancelled:
+            raise Job_Cancelled()
+        if total is not None:
+            self.total = max(total, 1)
+        self.done = done
+        now = time.time()
+        # at most 10 reports per second reach the GUI
+        if now - self.emit_time >= 0.1 or done >= self.total:
+            self.emit_time = now
+            self.emit_progress('running')
+
+    def finish(self, state='finished'):
+        if state == 'finished' and self.cancelled:
+            # cancelled after its last report, the result is dropped
+            raise Job_Cancelled()
+        self.emit_progress(state)
+
+    def emit_progress(self, state):
+        if self.replaced():
+            # the window of the new job only follows the new job
+            return
+        elapsed = time.time() - self.begin_time
+        eta = elapsed * (self.total - self.done) / self.done if self.done else None
+        self.progress_signal.emit(dict(done=self.done, total=self.total, unit=self.unit,
+                                       percent=min(100. * self.done / self.total, 100.),
+                                       elapsed=elapsed, eta=eta, state=state))
+
+
+class Import_Thread(Progress_Thread):
     '''one thread for import data'''
 
     trigger = pyqtSignal(object)
@@ -31,34 +280,93 @@ class Import_Thread(QThread):
         # 数据路径
         self.data_path = ''
         self.seeg_data = ''
+        # True: load the whole data
+        # False: read the header only, samples are read from the file on demand
+        # str: load into a memory-mapped file at this path
+        self.preload = True
+        # channels and [tmin, tmax] to import, None for all
+        self.chans = None
+        self.time = None
 
     def import_data(self):
         '''import data selected'''
         print(self.data_path)
-        if self.data_path[-3:] == 'set':
-            self.seeg_data = io.read_raw_eeglab(self.data_path, preload=True)
-        elif self.data_path[-3:] == 'edf':
-            self.seeg_data = io.read_raw_edf(self.data_path, preload=True)
-        elif self.data_path[-3:] == 'fif':
-            self.seeg_data = io.read_raw_fif(self.data_path, preload=True)
-        elif self.data_path[-4:] == 'vhdr':
-            self.seeg_data = io.read_raw_brainvision(self.data_path, preload=True)
+        # only the header is read first, the samples are loaded chunk by
+        # chunk to report the bytes read
+        self.seeg_data = read_raw_file(self.data_path, preload=False)
+        if self.chans is not None:
+            self.seeg_data.pick_channels(self.chans)
+        if self.time is not None:
+            self.seeg_data.crop(self.time[0], min(self.time[1], self.seeg_data.times[-1]))
+        # only the picked signals within the time range are decoded
+        if self.preload is not False:
+            load_raw_chunked(self.seeg_data, preload=self.preload, progress=self.report)
 
 
     def run(self):
         '''rewrite run'''
         try:
+            self.begin(1, 'bytes')
             self.import_data()
             print('data loaded')
             self.seeg_data.set_channel_types({ch_name: 'seeg' for ch_name in self.seeg_data.ch_names})
-            self.seeg_data.load_data()
+            if self.chans is None and self.time is None:
+                # the header of the whole file goes to the catalog next to it
+                catalog_para(self.data_path, self.seeg_data, annotation_events(self.seeg_data))
+            self.finish()
             self.trigger.emit(self.seeg_data)
             self.data_path = ''
             self.seeg_data = ''
+        except Job_Cancelled:
+            # the samples loaded so far are freed
+            print('导入已取消')
+            self.finish('cancelled')
+            self.seeg_data = ''
         except Exception as error:
             show_error(error)
+            self.finish('failed')
             self.trigger.emit(self.seeg_data)
+        self.chans = None
+        self.time = None
+
+
+
+class Batch_Import_Thread(Progress_Thread):
+    '''a thread for importing a batch of raw data on a process pool'''
 
+    batch = pyqtSignal(list)
+
+    def __init__(self, parent=None):
+        super(Batch_Import_Thread, self).__init__(parent)
+        self.data_path = []
+        # concatenate contiguous segments
+        self.concat = False
+        self.n_jobs = None
+        self.read_bytes = 0
+
+    def report_file(self, info):
+        self.read_bytes += info['size'] * 2 ** 20
+        self.report(self.read_bytes)
+
+    def run(self):
+        '''rewrite run'''
+        try:
+            self.read_bytes = 0
+            self.begin(sum(os.path.getsize(path) for path in self.data_path), 'bytes')
+            result = batch_read_raw(self.data_path, n_jobs=self.n_jobs, concat=self.concat,
+                                    callback=self.report_file)
+            self.finish()
+        except Job_Cancelled:
+            print('导入已取消')
+            self.finish('cancelled')
+            result = []
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+            result = []
+        if not self.replaced():
+            self.batch.emit(result)
+        self.data_path = []
 
 
 class Load_Epoched_Data_Thread(QThread):
@@ -93,7 +401,7 @@ class Load_Epoched_Data_Thread(QThread):
             self.load.emit(self.seeg_data)
 
 
-class Resample_Thread(QThread):
+class Resample_Thread(Progress_Thread):
 
     resample = pyqtSignal(object)
 
@@ -102,21 +410,349 @@ class Resample_Thread(QThread):
         self.data = ''
         self.resampling_rate = ''
 
+    # larger factors make the polyphase filter too long
+    max_factor = 1000
+
+    def get_factors(self, sfreq):
+        '''
+        up and down, the coprime factors of resampling_rate / sfreq, exact for
+        the rates as they are written; None if either is above max_factor
+        '''
+        from fractions import Fraction
+
+        ratio = Fraction(str(self.resampling_rate)) / Fraction(str(sfreq))
+        if max(ratio.numerator, ratio.denominator) > self.max_factor:
+            return None
+        return ratio.numerator, ratio.denominator
+
+    def resample_raw(self, raw):
+        '''
+        raw.copy().resample by polyphase filtering, chunk by chunk into a new
+        raw, on disk if raw is lazily imported or memmapped; as mne, each raw
+        concatenated in raw is resampled on its own
+        '''
+        factors = self.get_factors(raw.info['sfreq'])
+        if factors is None:
+            print('%s Hz to %s Hz has no small resampling factors, use mne resample instead'
+                  % (raw.info['sfreq'], self.resampling_rate))
+            self.begin(1, 'raws')
+            raw = raw.copy().load_data().resample(self.resampling_rate)
+            self.report(1)
+            return raw
+        up, down = factors
+        lengths = [int(round(n_times * up / float(down))) for n_times in raw._raw_lengths]
+        shape = (len(raw.ch_names), sum(lengths))
+        if self.streamed(raw):
+            data = np.memmap(self.create_stream('pacs_resample_', raw), mode='w+',
+                             dtype=np.float64, shape=shape)
+        else:
+            data = np.empty(shape)
+        # the input of a chunk is about block_samples
+        step = self.block_chans(shape[0] * max(down / float(up), 1.))
+        self.begin(shape[1], 'samples')
+        offset = new_offset = 0
+        for n_times, n_new in zip(raw._raw_lengths, lengths):
+            def read(start, stop, offset=offset):
+                return raw.get_data(start=offset + start, stop=offset + stop)
+
+            def callback(done, total, new_offset=new_offset):
+                self.report(new_offset + done)
+
+            if n_new:
+                _resample_stream(read, data[:, new_offset:new_offset + n_new], n_times,
+                                 up, down, step, callback)
+            offset += n_times
+            new_offset += n_new
+        if isinstance(data, np.memmap):
+            data.flush()
+        return raw_like(raw, data, raw.info['sfreq'] * up / down, lengths)
+
+    @staticmethod
+    def resample_events(events, ratio):
+        '''the sample indices of events at a sampling rate ratio times the original'''
+        events = events.copy()
+        events[:, 0] = np.round(events[:, 0] * ratio).astype(int)
+        return events
+
     def run(self):
         '''rewrite run'''
         try:
             if self.resampling_rate > 0:
-                self.resample_data = self.data.copy().resample(self.resampling_rate)
+                if isinstance(self.data, io.BaseRaw):
+                    # the events of a raw are its annotations, in seconds
+                    self.resample_data = self.resample_raw(self.data)
+                else:
+                    self.begin(1, 'epochs')
+                    self.resample_data = self.data.copy().resample(self.resampling_rate)
+                    # mne keeps the sample indices of the original rate
+                    self.resample_data.events = self.resample_events(
+                        self.data.events, self.resampling_rate / self.data.info['sfreq'])
+                    self.report(1)
                 print('重采样结束')
+                self.finish()
                 self.resample.emit(self.resample_data)
-                self.data = ''
                 self.resample_data = ''
+                # the output file now belongs to the emitted data, which
+                # removes it once dropped, see take_memmap
+                self.stream_fname = None
+        except Job_Cancelled:
+            print('重采样已取消')
+            self.resample_data = ''
+            self.remove_stream()
+            self.finish('cancelled')
+        except Exception as error:
+            show_error(error)
+            self.resample_data = ''
+            self.remove_stream()
+            self.finish('failed')
+        self.data = ''
+
+
+
+class Export_Thread(Progress_Thread):
+    '''a thread for streaming data to a file'''
+
+    # the path and what the writer returns, e.g. the plan of save_workspace
+    export = pyqtSignal(str, object)
+
+    def __init__(self, parent=None):
+        super(Export_Thread, self).__init__(parent)
+        self.data = ''
+        self.save_path = ''
+        self.writer = write_raw_edf
+
+    def run(self):
+        '''rewrite run'''
+        try:
+            # the writers report the percent written
+            self.begin(100, '%')
+            result = self.writer(self.save_path, self.data, progress=self.report)
+            print('导出结束')
+            self.finish()
+            self.export.emit(self.save_path, result)
+        except Job_Cancelled:
+            print('导出已取消')
+            self.finish('cancelled')
+            if not self.replaced():
+                self.export.emit('', None)
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+            self.export.emit('', None)
+        self.data = ''
+
+
+class Autosave_Thread(QThread):
+    '''
+    a thread saving the new or modified data to a workspace periodically
+
+    The snapshots are taken by a timer on the GUI thread, where this object
+    lives, see snapshot_workspace: the thread only reads copies of the
+    headers and samples that are never changed in place. The written
+    groups are committed back on the GUI thread, which owns the raws
+    reading the workspace, see commit_workspace.
+    '''
+
+    autosave = pyqtSignal(list)
+
+    def __init__(self, parent=None):
+        super(Autosave_Thread, self).__init__(parent)
+        self.subject = dict()
+        self.save_path = ''
+        # seconds between two snapshots
+        self.interval = 60
+        self.snapshot = dict()
+        self.pairs = list()
+        # the plan of update_workspace written from the snapshot
+        self.plan = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.take_snapshot)
+        self.finished.connect(self.keep_saved)
+
+    def start_autosave(self):
+        '''save a snapshot now and every interval seconds'''
+        self.timer.start(int(self.interval * 1000))
+        self.take_snapshot()
+
+    def stop(self):
+        self.timer.stop()
+
+    def take_snapshot(self):
+        if self.isRunning():
+            # the last snapshot is still being written
+            return
+        self.snapshot, self.pairs = snapshot_workspace(self.subject)
+        self.plan = None
+        self.start()
+
+    def keep_saved(self):
+        '''commit the written groups and give the saved states back to the SEEG entries'''
+        plan, pairs = self.plan, self.pairs
+        self.snapshot, self.pairs, self.plan = dict(), list(), None
+        if plan is None:
+            return
+        try:
+            written = commit_workspace(plan, pairs)
+        except Exception as error:
+            show_error(error)
+            return
+        if len(written):
+            print('自动保存:', written)
+            self.autosave.emit(written)
+
+    def run(self):
+        '''rewrite run'''
+        try:
+            self.plan = update_workspace(self.save_path, self.snapshot)
         except Exception as error:
             show_error(error)
 
 
+class Filter_Cache(object):
+    '''
+    FIR / IIR filter designs shared by the Filter_Thread runs
+
+    A design is keyed by (sfreq, l_freq, h_freq, notch frequencies, method,
+    transition parameters) and made once, with the defaults of mne's
+    raw.filter and raw.notch_filter. With a path, the designs are also
+    saved there and reused by later sessions.
+    '''
+
+    def __init__(self, path=None):
+        super(Filter_Cache, self).__init__()
+        self.cache = dict()
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(sfreq, l_freq=None, h_freq=None, notch=None, method='fir', **trans):
+        def freq(value):
+            return None if value is None else round(float(value), 6)
+        if notch is not None:
+            notch = tuple(freq(value) for value in np.atleast_1d(notch))
+        return (freq(sfreq), freq(l_freq), freq(h_freq), notch, method,
+                tuple(sorted((name, repr(value)) for name, value in trans.items())))
+
+    def get_fname(self, key):
+        import hashlib
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    @staticmethod
+    def create(sfreq, l_freq=None, h_freq=None, notch=None, method='fir', **trans):
+        '''
+        :return: dict
+                 'h' the FIR kernel, or 'sos' and 'padlen' of the IIR filter
+        '''
+        from mne.filter import create_filter
+
+        if notch is None:
+            designs = [create_filter(None, sfreq, l_freq, h_freq, method=method,
+                                     verbose='error', **trans)]
+        else:
+            # the stop-bands of mne's notch_filter
+            freqs = np.atleast_1d(notch).astype(float)
+            widths = trans.pop('notch_widths', None)
+            widths = freqs / 200. if widths is None else \
+                np.broadcast_to(np.asarray(widths, float), freqs.shape)
+            tb_2 = trans.pop('trans_bandwidth', 1.) / 2.
+            lows = freqs - widths / 2. - tb_2
+            highs = freqs + widths / 2. + tb_2
+            if method == 'fir':
+                designs = [create_filter(None, sfreq, list(highs), list(lows), method=method,
+                                         l_trans_bandwidth=tb_2, h_trans_bandwidth=tb_2,
+                                         verbose='error', **trans)]
+            else:
+                # an IIR filter has one stop-band, they are cascaded
+                designs = [create_filter(None, sfreq, [high], [low], method=method,
+                                         l_trans_bandwidth=tb_2, h_trans_bandwidth=tb_2,
+                                         verbose='error', **trans)
+                           for low, high in zip(lows, highs)]
+        if method == 'fir':
+            return dict(h=designs[0])
+        return dict(sos=np.concatenate([design['sos'] for design in designs]),
+                    padlen=sum(design['padlen'] for design in designs))
+
+    def save(self, key):
+        if self.path is None:
+            return
+        fname = self.get_fname(key)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(fname + '.tmp', 'wb') as f:
+                np.savez(f, **self.cache[key])
+            os.replace(fname + '.tmp', fname)
+        except OSError:
+            # the designs are still cached in memory
+            traceback.print_exc()
+
+    def load(self, key):
+        fname = None if self.path is None else self.get_fname(key)
+        if fname is None or not os.path.isfile(fname):
+            return None
+        try:
+            with np.load(fname) as f:
+                return {name: f[name] for name in f.files}
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def design(self, sfreq, l_freq=None, h_freq=None, notch=None, method='fir', **trans):
+        '''
+        :param sfreq: float
+                      sampling frequency
+        :param l_freq: float | None
+                       low cut-off frequency
+        :param h_freq: float | None
+                       high cut-off frequency
+        :param notch: float | list | None
+                      frequencies to notch, the cut-offs are then ignored
+        :param method: str
+                       'fir' or 'iir'
+        :param trans: transition parameters of mne's create_filter, or
+                      trans_bandwidth and notch_widths of notch_filter
+        :return: dict
+                 'h' the FIR kernel, or 'sos' and 'padlen' of the IIR filter
+        '''
+        key = self.get_key(sfreq, l_freq, h_freq, notch, method, **trans)
+        with self.lock:
+            if key not in self.cache:
+                design = self.load(key)
+                if design is None:
+                    self.cache[key] = self.create(sfreq, l_freq, h_freq, notch, method, **trans)
+                    self.save(key)
+                else:
+                    self.cache[key] = design
+            return self.cache[key]
+
+    def freq_response(self, sfreq, l_freq=None, h_freq=None, notch=None, method='fir',
+                      n_freqs=1024, **trans):
+        '''
+        gain of a design as it is applied (zero-phase), to preview it
+        :param n_freqs: int
+                        number of frequencies between 0 and sfreq / 2
+        :return: numpy.array, numpy.array
+                 frequencies and gain
+        '''
+        from scipy.signal import freqz, sosfreqz
+
+        design = self.design(sfreq, l_freq, h_freq, notch, method, **trans)
+        key = self.get_key(sfreq, l_freq, h_freq, notch, method, **trans)
+        with self.lock:
+            if 'gain' not in design or len(design['gain']) != n_freqs:
+                if 'h' in design:
+                    w, response = freqz(design['h'], worN=n_freqs)
+                    gain = np.abs(response)
+                else:
+                    w, response = sosfreqz(design['sos'], worN=n_freqs)
+                    # applied forward and backward
+                    gain = np.abs(response) ** 2
+                design['freqs'] = w * sfreq / (2 * np.pi)
+                design['gain'] = gain
+                self.save(key)
+            return design['freqs'], design['gain']
+
 
-class Filter_Thread(QThread):
+class Filter_Thread(Progress_Thread):
     '''a thread for filters'''
 
     filter_signal = pyqtSignal(object)
@@ -129,10 +765,160 @@ class Filter_Thread(QThread):
         self.low_freq = None
         self.high_freq = None
         self.notch_freq = None
+        self.filter_data = None
+        # replaced by a cache saved to disk by the main window
+        self.filter_cache = Filter_Cache()
+        # the line frequency is tracked within notch_freq +- line_track Hz
+        # in the 'line' mode
+        self.line_track = 0.
+
+    def filter_stream(self, design, segments=None):
+        '''
+        apply a design of filter_cache chunk by chunk, from seeg_data on
+        disk to the np.memmap of filter_data, the memory used does not
+        depend on the length of the data
+        '''
+        source = self.seeg_data
+        data = self.filter_data._data
+        n_chan, n_times = data.shape
+        if segments is None:
+            segments = [(0, n_times)]
+        passes = 1 if 'h' in design else 2
+        length = len(design['h']) if 'h' in design else int(design['padlen'])
+        # a chunk is a few times block_samples at most while it is filtered
+        step = max(self.block_chans(4 * n_chan), 4 * length, 1)
+        self.begin(passes * sum(end - onset for onset, end in segments), 'samples')
+        offset = [0]
+
+        def callback(done, total):
+            self.report(offset[0] + done)
+
+        for onset, end in segments:
+            def read(start, stop, onset=onset):
+                return source.get_data(start=onset + start, stop=onset + stop)
+            if 'h' in design:
+                _fir_stream(read, data[:, onset:end], design['h'], step, callback)
+            else:
+                _iir_stream(read, data[:, onset:end], design['sos'], design['padlen'],
+                            step, callback)
+            offset[0] += passes * (end - onset)
+        data.flush()
+        return self.filter_data
+
+    def apply(self, design, segments=None):
+        '''filter_stream or filter_blocks, as filter_data is on disk or in memory'''
+        if self.stream_fname is not None:
+            return self.filter_stream(design, segments)
+        return self.filter_blocks(design, segments)
+
+    def filter_blocks(self, design, segments=None):
+        '''
+        apply a design of filter_cache over blocks of channels of filter_data,
+        a copy of seeg_data, so a cancelled job leaves seeg_data untouched
+        :param design: dict
+                       from filter_cache.design
+        :param segments: list | None
+                         (start, stop) samples filtered separately, all the
+                         samples at once if None
+        '''
+        from scipy.signal import sosfiltfilt
+
+        data = self.filter_data._data
+        n_chan, n_times = data.shape[-2:]
+        if segments is None:
+            segments = [(0, n_times)]
+        # the same padding as mne
+        pad = 'edge' if isinstance(self.filter_data, mne.BaseEpochs) else 'reflect_limited'
+        block = self.block_chans(data[..., 0, :].size)
+        self.begin(n_chan, 'channels')
+        for start in range(0, n_chan, block):
+            picks = slice(start, min(start + block, n_chan))
+            for onset, end in segments:
+                x = data[..., picks, onset:end]
+                if 'h' in design:
+                    x[:] = _fir_zero_phase(x, design['h'], pad)
+                else:
+                    padlen = min(int(design['padlen']), x.shape[-1] - 1)
+                    x[:] = sosfiltfilt(design['sos'], x, padlen=padlen, axis=-1)
+            self.report(picks.stop)
+        return self.filter_data
+
+    def filter_raw(self, l_freq, h_freq, method='fir', **kwargs):
+        '''seeg_data.filter, block by block'''
+        design = self.filter_cache.design(self.filter_data.info['sfreq'], l_freq, h_freq,
+                                          method=method, **kwargs)
+        segments = None
+        if isinstance(self.filter_data, io.BaseRaw):
+            # mne filters the data between boundaries of concatenated files separately
+            from mne.annotations import _annotations_starts_stops
+            segments = list(zip(*_annotations_starts_stops(
+                self.filter_data, ('edge', 'bad_acq_skip'), invert=True)))
+        self.apply(design, segments)
+        # mne only updates the info when all the channels are filtered at once
+        info = self.filter_data.info
+        if h_freq is not None and (l_freq is None or l_freq < h_freq) and \
+                (info['lowpass'] is None or h_freq < info['lowpass']):
+            info['lowpass'] = float(h_freq)
+        if l_freq is not None and (h_freq is None or l_freq < h_freq) and \
+                (info['highpass'] is None or l_freq > info['highpass']):
+            info['highpass'] = float(l_freq)
+        return self.filter_data
+
+    def line_noise_raw(self, freq, **kwargs):
+        '''
+        remove the line noise at freq and its harmonics by sinusoid
+        regression in one pass over the samples, see _line_noise_stream;
+        as filter_raw, the data between boundaries of concatenated files
+        is fitted separately
+        '''
+        data = self.filter_data._data
+        sfreq = self.filter_data.info['sfreq']
+        kwargs.setdefault('track', self.line_track)
+        if data.ndim == 2:
+            from mne.annotations import _annotations_starts_stops
+
+            self.begin(data.shape[-1], 'samples')
+            for seg_start, seg_stop in zip(*_annotations_starts_stops(
+                    self.filter_data, ('edge', 'bad_acq_skip'), invert=True)):
+                if self.stream_fname is not None:
+                    def read(start, stop, offset=seg_start):
+                        return self.seeg_data.get_data(start=offset + start, stop=offset + stop)
+                else:
+                    def read(start, stop, offset=seg_start):
+                        return data[:, offset + start:offset + stop]
+
+                def callback(done, total, offset=seg_start):
+                    self.report(offset + done)
+
+                _line_noise_stream(read, data[:, seg_start:seg_stop], sfreq, freq,
+                                   callback=callback, **kwargs)
+            if self.stream_fname is not None:
+                data.flush()
+        else:
+            # each epoch on its own
+            self.begin(len(data), 'epochs')
+            for index, epoch in enumerate(data):
+                _line_noise_stream(lambda start, stop: epoch[:, start:stop], epoch, sfreq,
+                                   freq, **kwargs)
+                self.report(index + 1)
+        return self.filter_data
+
+    def notch_raw(self, freqs, method='fir', **kwargs):
+        '''seeg_data.notch_filter, block by block'''
+        design = self.filter_cache.design(self.filter_data.info['sfreq'], notch=freqs,
+                                          method=method, **kwargs)
+        return self.apply(design)
 
     def run(self):
         '''重写run'''
         try:
+            if self.streamed(self.seeg_data):
+                self.filter_data = raw_memmap(self.seeg_data,
+                                              self.create_stream('pacs_filter_', self.seeg_data))
+            else:
+                # lazily imported data is loaded here, off the GUI thread
+                self.seeg_data.load_data()
+                self.filter_data = self.seeg_data.copy()
             if self.filter_mode == 'fir':
                 if self.notch_freq and (not self.low_freq) and (not self.high_freq):
                     # 陷波
@@ -140,31 +926,31 @@ class Filter_Thread(QThread):
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.notch_filter(self.notch_freq)
+                    self.filter_data = self.notch_raw(self.notch_freq)
                 elif (not self.notch_freq) and self.low_freq and (not self.high_freq):
                     # 高通
                     print('fir 高通')
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.filter(self.low_freq,
-                                                             self.high_freq)
+                    self.filter_data = self.filter_raw(self.low_freq,
+                                                       self.high_freq)
                 elif (not self.notch_freq) and (not self.low_freq) and self.high_freq:
                     # 低通
                     print('fir 低通')
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.filter(self.low_freq,
-                                                             self.high_freq)
+                    self.filter_data = self.filter_raw(self.low_freq,
+                                                       self.high_freq)
                 elif (not self.notch_freq) and self.low_freq and self.high_freq:
                     # 带通
                     print('fir 带通')
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.filter(self.low_freq,
-                                                             self.high_freq)
+                    self.filter_data = self.filter_raw(self.low_freq,
+                                                       self.high_freq)
             elif self.filter_mode == 'iir':
                 if self.notch_freq and (not self.low_freq) and (not self.high_freq):
                     # 陷波
@@ -172,44 +958,61 @@ class Filter_Thread(QThread):
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.notch_filter(self.notch_freq,
-                                                                   method='iir')
+                    self.filter_data = self.notch_raw(self.notch_freq,
+                                                      method='iir')
                 elif (not self.notch_freq) and self.low_freq and (not self.high_freq):
                     # 高通
                     print('iir 高通')
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.filter(self.low_freq, self.high_freq,
-                                                             method='iir')
+                    self.filter_data = self.filter_raw(self.low_freq, self.high_freq,
+                                                       method='iir')
                 elif (not self.notch_freq) and (not self.low_freq) and self.high_freq:
                     # 低通
                     print('iir 低通')
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.filter(self.low_freq, self.high_freq,
-                                                             method='iir')
+                    self.filter_data = self.filter_raw(self.low_freq, self.high_freq,
+                                                       method='iir')
                 elif (not self.notch_freq) and self.low_freq and self.high_freq:
                     # 带通
                     print('iir 带通')
                     print('low_freq:', self.low_freq)
                     print('high_freq:', self.high_freq)
                     print('notch_freq:', self.notch_freq)
-                    self.filter_data = self.seeg_data.filter(self.low_freq, self.high_freq,
-                                                             method='iir')
+                    self.filter_data = self.filter_raw(self.low_freq, self.high_freq,
+                                                       method='iir')
+            elif self.filter_mode == 'line' and self.notch_freq:
+                # 回归去工频
+                self.filter_data = self.line_noise_raw(self.notch_freq)
             print('滤波结束')
+            self.finish()
             self.filter_signal.emit(self.filter_data)
-            self.seeg_data = None
             self.low_freq = None
             self.high_freq = None
             self.notch_freq = None
+            # the output file now belongs to the emitted data, which
+            # removes it once dropped, see take_memmap
+            self.stream_fname = None
+        except Job_Cancelled:
+            print('滤波已取消')
+            self.filter_data = None
+            self.remove_stream()
+            self.finish('cancelled')
         except Exception as error:
             show_error(error)
+            self.filter_data = None
+            self.remove_stream()
+            self.finish('failed')
+        # the copy of a cancelled job is freed
+        self.seeg_data = None
+        self.filter_data = None
 
 
 
-class Calculate_Power(QThread):
+class Calculate_Power(Progress_Thread):
 
     power_signal = pyqtSignal(object, int, tuple, object)
 
@@ -223,37 +1026,63 @@ class Calculate_Power(QThread):
         self.use_fft = use_fft
         self.show_itc = show_itc
         self.itc = None
+        # epochs transformed between two reports
+        self.block_size = 10
 
-    def run(self):
+    def transform(self, data, return_itc):
         if self.method == 'Multitaper transform':
             freqs = np.logspace(*np.log10(self.freq), num=8)
             n_cycles = freqs / 2.  # different number of cycle per frequency
             time_bandwidth = 2.0
-            if self.show_itc:
-                power, self.itc = tfr_multitaper(self.data, freqs=freqs, n_cycles=n_cycles, use_fft=self.use_fft,
-                                    time_bandwidth=time_bandwidth, decim=3)
-            else:
-                power = tfr_multitaper(self.data, freqs=freqs, n_cycles=n_cycles, use_fft=self.use_fft,
-                                       time_bandwidth=time_bandwidth, decim=3, return_itc=False)
+            return tfr_multitaper(data, freqs=freqs, n_cycles=n_cycles, use_fft=self.use_fft,
+                                  time_bandwidth=time_bandwidth, decim=3, return_itc=return_itc)
         elif self.method == 'Stockwell transform':
             width = 3.
-            if self.show_itc:
-                power, self.itc = tfr_stockwell(self.data, fmin=self.freq[0], fmax=self.freq[1], width=width, return_itc=True)
-            else:
-                power = tfr_stockwell(self.data, fmin=self.freq[0], fmax=self.freq[1], width=width)
+            return tfr_stockwell(data, fmin=self.freq[0], fmax=self.freq[1], width=width,
+                                 return_itc=return_itc)
         elif self.method == 'Morlet Wavelets':
             freqs = np.logspace(*np.log10(self.freq), num=8)
             n_cycles = freqs / 2.  # different number of cycle per frequency
-            if self.show_itc:
-                power, self.itc = tfr_morlet(self.data, freqs=freqs, n_cycles=n_cycles, use_fft=self.use_fft,
-                                        decim=3)
-            else:
-                power = tfr_morlet(self.data, freqs=freqs, n_cycles=n_cycles, use_fft=self.use_fft,
-                                   decim=3, return_itc=False)
+            return tfr_morlet(data, freqs=freqs, n_cycles=n_cycles, use_fft=self.use_fft,
+                              decim=3, return_itc=return_itc)
+
+    def calculate(self):
+        self.data.load_data()
+        n_epochs = len(self.data)
+        self.begin(n_epochs, 'epochs')
+        if self.show_itc:
+            # the inter-trial coherence needs all the epochs at once
+            power, self.itc = self.transform(self.data, True)
+        else:
+            # the power is the mean over the epochs, summed block by block
+            power = None
+            for start in range(0, n_epochs, self.block_size):
+                block = self.data[start:start + self.block_size]
+                block_power = self.transform(block, False)
+                if power is None:
+                    power = block_power
+                    power.data *= len(block)
+                else:
+                    power.data += block_power.data * len(block)
+                self.report(start + len(block))
+            power.data /= n_epochs
+            power.nave = n_epochs
+        self.report(n_epochs)
+        self.finish()
         self.power_signal.emit(power, self.chan_num, self.time, self.itc)
 
+    def run(self):
+        try:
+            self.calculate()
+        except Job_Cancelled:
+            print('时频分析已取消')
+            self.finish('cancelled')
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+
 
-class Calculate_PSD(QThread):
+class Calculate_PSD(Progress_Thread):
 
     psd_signal = pyqtSignal(str, object, object, object)
 
@@ -267,28 +1096,204 @@ class Calculate_PSD(QThread):
         self.time = time
         self.nfft = nfft
         self.average = average
+        # epochs calculated between two reports
+        self.block_size = 10
 
-    def run(self):
+    def psd(self, data):
         if self.method == 'Multitaper':
-            psds, freqs = psd_multitaper(self.data, fmin=self.freq[0], fmax=self.freq[1],
-                                    tmin=self.time[0], tmax=self.time[1], n_jobs=2)
+            return psd_multitaper(data, fmin=self.freq[0], fmax=self.freq[1],
+                                  tmin=self.time[0], tmax=self.time[1], n_jobs=2)
         elif self.method == 'Welch':
-            psds, freqs = psd_welch(self.data, fmin=self.freq[0], fmax=self.freq[1],
-                                    tmin=self.time[0], tmax=self.time[1], n_fft=self.nfft,
-                                    average=self.average, n_jobs=2)
+            return psd_welch(data, fmin=self.freq[0], fmax=self.freq[1],
+                             tmin=self.time[0], tmax=self.time[1], n_fft=self.nfft,
+                             average=self.average, n_jobs=2)
+
+    def calculate(self):
+        if isinstance(self.data, mne.BaseEpochs):
+            # the psd of every epoch is independent of the others
+            self.data.load_data()
+            n_epochs = len(self.data)
+            self.begin(n_epochs, 'epochs')
+            psds = []
+            for start in range(0, n_epochs, self.block_size):
+                block_psds, freqs = self.psd(self.data[start:start + self.block_size])
+                psds.append(block_psds)
+                self.report(start + len(block_psds))
+            psds = np.concatenate(psds, axis=0)
+        else:
+            self.begin(1, '%')
+            psds, freqs = self.psd(self.data)
+            self.report(1)
         psds = 10. * np.log10(psds)
         psds_mean = psds.mean(0).mean(0)
         psds_std = psds.mean(0).std(0)
 
+        self.finish()
         self.psd_signal.emit(self.method, psds_mean, psds_std, freqs)
 
+    def run(self):
+        try:
+            self.calculate()
+        except Job_Cancelled:
+            print('功率谱计算已取消')
+            self.finish('cancelled')
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+
 
 from spectral_connectivity import Multitaper, Connectivity
-class Cal_Spec_Con(QThread):
+class Multitaper_Cache(object):
+    '''
+    Tapered Fourier coefficients shared by Cal_Spec_Con and Cal_Dir_Con
+
+    The coefficients are keyed by (event, time window, bandwidth, window
+    duration, window step) and hold every channel requested so far, so
+    each channel is transformed only once no matter how many pairs or
+    connectivity methods use it. The least recently used entries are
+    dropped once all of them take more than max_bytes.
+    '''
+
+    def __init__(self, max_bytes=2 ** 30):
+        super(Multitaper_Cache, self).__init__()
+        self.cache = OrderedDict()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_nbytes(entry):
+        return entry['coef'].nbytes if 'coef' in entry else entry['spectra'].nbytes
+
+    def store(self, key, entry):
+        '''keep entry as the most recently used one, called with the lock held'''
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        n_bytes = sum(self.get_nbytes(value) for value in self.cache.values())
+        while n_bytes > self.max_bytes and len(self.cache) > 1:
+            _, old = self.cache.popitem(last=False)
+            n_bytes -= self.get_nbytes(old)
+
+    @staticmethod
+    def get_key(para):
+        if para['sliding'][0]:
+            duration, step = para['sliding'][1], para['sliding'][2]
+        else:
+            duration, step = None, None
+        return (para['event'], tuple(para['time']), para['bandwidth'],
+                duration, step)
+
+    def fourier_coefficients(self, epoch, chans, para, n_jobs=1, callback=None):
+        '''
+        :param epoch: instance of BaseEpochs
+                      loaded epochs already cropped to para['time']
+        :param chans: list
+                      channels' name needed
+        :param para: dict
+                     parameters from the connectivity window
+        :param n_jobs: int
+                       number of worker processes over the channels
+        :param callback: function | None
+                         called with the number of channels calculated and
+                         the number missing from the cache after every block
+        :return: numpy.array, instance of Multitaper
+                 fourier coefficients with the signals in the order of chans,
+                 shape (n_windows, n_epochs, n_tapers, n_fft, n_chans)
+        '''
+        # a replaced job may still be running on the same cache
+        with self.lock:
+            key = self.get_key(para)
+            entry = self.cache.get(key)
+            missing = []
+            for chan in chans:
+                if (entry is None or chan not in entry['chan']) and chan not in missing:
+                    missing.append(chan)
+            if len(missing):
+                index = [epoch.ch_names.index(chan) for chan in missing]
+                mt_para = dict(sampling_frequency=epoch.info['sfreq'],
+                               time_halfbandwidth_product=para['bandwidth'],
+                               start_time=para['time'][0])
+                if para['sliding'][0]:
+                    mt_para['time_window_duration'] = para['sliding'][1]
+                    mt_para['time_window_step'] = para['sliding'][2]
+                print('calculating fourier coefficients of', missing)
+                if n_jobs > 1 or callback is not None:
+                    # blocks of channels on the process pool, m only keeps the
+                    # frequencies and times
+                    m = Multitaper(epoch._data[:, index[:1], :].transpose((2, 0, 1)), **mt_para)
+                    coef = parallel_blocks(epoch._data, _multitaper_chans, (index, ),
+                                           n_jobs=n_jobs, axis=-1, callback=callback,
+                                           **mt_para)
+                else:
+                    # (n_epochs, n_chans, n_times) -> (n_times, n_epochs, n_chans)
+                    m = Multitaper(epoch._data[:, index, :].transpose((2, 0, 1)), **mt_para)
+                    coef = m.fft()
+                if entry is None:
+                    entry = {'chan': list(missing), 'coef': coef, 'm': m}
+                else:
+                    entry['coef'] = np.concatenate((entry['coef'], coef), axis=-1)
+                    entry['chan'] += missing
+            self.store(key, entry)
+            index = [entry['chan'].index(chan) for chan in chans]
+            if index == list(range(len(entry['chan']))):
+                return entry['coef'], entry['m']
+            return entry['coef'][..., index], entry['m']
+
+    def tapered_spectra(self, epoch, para, fmin=None, fmax=None, bandwidth=None,
+                        adaptive=False, n_jobs=1):
+        '''
+        :param epoch: instance of BaseEpochs
+                      loaded epochs already cropped to the time used
+        :param para: dict
+                     parameters from the connectivity window
+        :param fmin: float | None
+                     lowest frequency, None for 5 cycles of the epoch as mne
+        :param fmax: float | None
+        :param bandwidth: float | None
+                          the same as mt_bandwidth of mne spectral_connectivity
+        :param adaptive: bool
+        :param n_jobs: int
+                       number of worker processes over the channels
+        :return: numpy.array, numpy.array
+                 tapered spectra of every channel of epoch from
+                 _mt_spectra_chans, shape (n_epochs, n_chan, n_tapers, n_freqs),
+                 and the frequencies
+        '''
+        sfreq = epoch.info['sfreq']
+        n_times = len(epoch.times)
+        freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+        if fmin is None:
+            fmin = 5. * sfreq / n_times
+        if fmax is None:
+            fmax = np.inf
+        freq_mask = (freqs >= fmin) & (freqs <= fmax)
+        with self.lock:
+            key = self.get_key(para) + ('tapered', tuple(epoch.ch_names), n_times,
+                                        fmin, fmax, bandwidth, adaptive)
+            entry = self.cache.get(key)
+            if entry is None:
+                print('calculating tapered spectra of', len(epoch.ch_names), 'channels')
+                mt_para = dict(sfreq=sfreq, bandwidth=bandwidth, freq_mask=freq_mask,
+                               adaptive=adaptive)
+                index = np.arange(len(epoch.ch_names))
+                if n_jobs > 1:
+                    spectra = parallel_blocks(epoch._data, _mt_spectra_chans, (index, ),
+                                              n_jobs=n_jobs, axis=1, **mt_para)
+                else:
+                    spectra = _mt_spectra_chans(epoch._data, index, **mt_para)
+                entry = {'spectra': spectra, 'freqs': freqs[freq_mask]}
+            self.store(key, entry)
+            return entry['spectra'], entry['freqs']
+
+    def clear(self):
+        with self.lock:
+            self.cache = OrderedDict()
+
+
+class Cal_Spec_Con(Progress_Thread):
 
     spec_con_signal = pyqtSignal(list)
 
-    def __init__(self, data, para, method, mode):
+    def __init__(self, data, para, method, mode, cache=None, n_jobs=1):
         super(Cal_Spec_Con, self).__init__()
         '''
         para['freq'] = [fmin, fmax]                 [float, float]
@@ -296,10 +1301,14 @@ class Cal_Spec_Con(QThread):
         para['bandwidth'] = bandwidth               float
         para['adaptive'] = use_adaptive             bool
         para['chan'] = [chanx_get, chany_get]       
+        cache: instance of Multitaper_Cache shared between runs
+        n_jobs: number of worker processes over the channel pairs
         '''
         self.data = data
         self.para = para
         self.method = method
+        self.cache = cache if cache is not None else Multitaper_Cache()
+        self.n_jobs = n_jobs
         self.sfreq = self.data.info['sfreq']
         self.mode = mode
         chan = self.data.ch_names
@@ -314,75 +1323,71 @@ class Cal_Spec_Con(QThread):
         print(self.indices)
 
     def run(self):
+        try:
+            self.calculate()
+        except Job_Cancelled:
+            print('连接计算已取消')
+            self.finish('cancelled')
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+
+    def calculate(self):
+        # the total number of pairs comes with the first report of the blocks
+        self.begin(1, 'pairs')
         self.data.load_data()
         if self.mode == 'Multitaper':
             if not self.para['sliding'][0]:
                 self.data = self.data.copy().crop (self.para['time'][0], self.para['time'][1])
-                if not isinstance(self.indices, tuple) and isinstance(self.para['chan'][0], list):
-                    self.data.pick_channels(self.para['chan'][0])
-                con, freqs, times, n_epochs, n_tapers = spectral_connectivity(
-                    self.data, method=self.method, mode='multitaper', sfreq=self.sfreq,
-                    fmin=self.para['freq'][0], fmax=self.para['freq'][1], faverage=self.para['average'],
-                    tmin=self.para['time'][0], tmax=self.para['time'][1], mt_adaptive=True,
-                    indices=self.indices, mt_bandwidth=self.para['bandwidth'])
-                if self.para['average']:
-                    con = con[:, :, 0]
-                    con += con.T - np.diag(con.diagonal())
-                elif self.para['chan'][0] != None and len(self.para['chan'][0]) == 1:
-                    pass
-                else:
-                    con = con.transpose((2, 0, 1))
-                    for i in range (con.shape[0]):
-                        con[i] = con[i] + (con[i].T - np.diag (con[i].diagonal ()))
-                    con = con.transpose ((1, 2, 0))
+                indices = self.indices
+                if not isinstance(self.indices, tuple):
+                    if isinstance(self.para['chan'][0], list):
+                        self.data.pick_channels(self.para['chan'][0])
+                    # only the lower triangle is calculated and kept
+                    indices = np.tril_indices(len(self.data.ch_names), -1)
+                con, freqs, times = spectral_connectivity_blocks(
+                    self.data, indices, n_jobs=self.n_jobs, callback=self.report,
+                    cache=self.cache, para=self.para, method=self.method, mode='multitaper',
+                    sfreq=self.sfreq, fmin=self.para['freq'][0], fmax=self.para['freq'][1],
+                    faverage=self.para['average'], tmin=self.para['time'][0], tmax=self.para['time'][1],
+                    mt_adaptive=True, mt_bandwidth=self.para['bandwidth'])
+                if not isinstance(self.indices, tuple):
+                    con = Tri_Con(con, len(self.data.ch_names))
+                self.finish()
                 self.spec_con_signal.emit([con, freqs])
             else:
+                if self.para['bandwidth'] == None:
+                    self.para['bandwidth'] = 3
+                # the total number of channels comes with the first report
+                self.begin(1, 'channels')
                 if isinstance(self.para['chan'][1], list):
                     epoch = self.data.crop(tmin=self.para['time'][0], tmax=self.para['time'][1])
                     times = epoch.times
-                    epoch_0 = epoch.copy().pick_channels(self.para['chan'][0])
-                    epoch_1 = epoch.copy().pick_channels(self.para['chan'][1])
-                    data = {i: np.zeros ((epoch_1._data.shape[2], epoch_1._data.shape[0], 2))
-                            for i in range (len (self.para['chan'][1]))}
-                    for i in range (len (data)):
-                        data[i][:, :, 0] = epoch_0._data.reshape (-1, epoch_0._data.shape[0])
-                        data[i][:, :, 1] = epoch_1._data[:, i, :].reshape (-1, epoch_1._data.shape[0])
+                    chans = self.para['chan'][0][:1] + list(self.para['chan'][1])
+                    coef, m = self.cache.fourier_coefficients(epoch, chans, self.para,
+                                                              n_jobs=self.n_jobs,
+                                                              callback=self.report)
+                    index = [epoch.ch_names.index(chan) for chan in chans]
+                    data = {i: epoch._data[:, [index[0], index[i + 1]], :].transpose((2, 0, 1))
+                            for i in range(len(self.para['chan'][1]))}
                     result = {i: None for i in range(len(data))}
-
-                    for i in range(len (data)):
-                        data_use = data[i]
-                        if self.para['bandwidth'] == None:
-                            self.para['bandwidth'] = 3
-                        m = Multitaper(data_use,
-                                        sampling_frequency=self.sfreq,
-                                        time_halfbandwidth_product=self.para['bandwidth'],
-                                        time_window_duration=self.para['sliding'][1],
-                                        time_window_step=self.para['sliding'][2],
-                                        start_time=self.para['time'][0])
-                        c = Connectivity (fourier_coefficients=m.fft(),
-                                          frequencies=m.frequencies,
-                                          time=m.time)
+                    for i in range(len(data)):
+                        c = Connectivity(fourier_coefficients=coef[..., [0, i + 1]],
+                                         frequencies=m.frequencies,
+                                         time=m.time)
                         result[i] = [c, m]
+                    self.finish()
                     self.spec_con_signal.emit ([result, data, times])
                 else:
                     epoch_1 = self.data
                     epoch_1 = epoch_1.crop(tmin=self.para['time'][0], tmax=self.para['time'][1])
-                    print(type(self.para['chan'][0]))
-                    epoch_1 = epoch_1.pick_channels(self.para['chan'][0])
-                    n_signals = len(self.para['chan'][0])
-                    data = np.zeros((epoch_1._data.shape[2], epoch_1._data.shape[0], n_signals))
-                    for i in range(n_signals):
-                        data[:, :, i] = epoch_1._data[:, i, :].reshape(-1, epoch_1._data.shape[0])
-                    m = Multitaper(data,
-                                    sampling_frequency=self.sfreq,
-                                    time_halfbandwidth_product=self.para['bandwidth'],
-                                    time_window_duration=self.para['sliding'][1],
-                                    time_window_step=self.para['sliding'][2],
-                                    start_time=self.para['time'][0])
-                    con = Connectivity(fourier_coefficients=m.fft(),
+                    coef, m = self.cache.fourier_coefficients(epoch_1, list(self.para['chan'][0]),
+                                                              self.para, n_jobs=self.n_jobs,
+                                                              callback=self.report)
+                    con = Connectivity(fourier_coefficients=coef,
                                       frequencies=m.frequencies,
                                       time=m.time)
-                    print('come  here')
+                    self.finish()
                     self.spec_con_signal.emit([con, m])
         elif self.mode == 'Morlet':
             try:
@@ -399,34 +1404,36 @@ class Cal_Spec_Con(QThread):
                     pass
                 if self.para['time'][1] == self.data.tmax:
                     self.para['time'][1] = None
-                con, freqs, times, n_epochs, n_tapers = spectral_connectivity(
-                    self.data, method=self.method, mode='cwt_morlet', sfreq=self.sfreq, cwt_freqs=self.cwt_freq,
+                n_chan = len(self.data.ch_names)
+                con, freqs, times = spectral_connectivity_blocks(
+                    self.data, np.tril_indices(n_chan, -1), n_jobs=self.n_jobs,
+                    callback=self.report, method=self.method,
+                    mode='cwt_morlet', sfreq=self.sfreq, cwt_freqs=self.cwt_freq,
                     cwt_n_cycles=self.cwt_freq/2, faverage=True, tmin=self.para['time'][0],
                     tmax=self.para['time'][1])
-                con = con[:, :, 0, :]
-                con = con.transpose ((2, 0, 1))
-                for i in range(con.shape[0]):
-                    con[i] = con[i] + (con[i].T - np.diag (con[i].diagonal ()))
-                con = con.transpose ((1, 2, 0))
+                con = Tri_Con(con[:, 0, :], n_chan)
             else:
                 if self.para['time'][0] == self.data.tmin:
                     if self.para['time'][1] == self.data.tmax:
                         self.para['time'][1] = None
                 else:
                     pass
-                con, freqs, times, n_epochs, n_tapers = spectral_connectivity(
-                    self.data, method=self.method, mode='cwt_morlet', sfreq=self.sfreq, cwt_freqs=self.cwt_freq,
+                con, freqs, times = spectral_connectivity_blocks(
+                    self.data, self.indices, n_jobs=self.n_jobs, callback=self.report,
+                    method=self.method,
+                    mode='cwt_morlet', sfreq=self.sfreq, cwt_freqs=self.cwt_freq,
                     cwt_n_cycles=self.cwt_freq/2, faverage=True, tmin=self.para['time'][0],
-                    tmax=self.para['time'][1], indices=self.indices)
+                    tmax=self.para['time'][1])
                 con = con[:, 0, :]
+            self.finish()
             self.spec_con_signal.emit ([con, times, freqs])
 
 
-class Cal_Dir_Con(QThread):
+class Cal_Dir_Con(Progress_Thread):
 
     spec_con_signal = pyqtSignal(list)
 
-    def __init__(self, data, para):
+    def __init__(self, data, para, cache=None, n_jobs=1):
         super(Cal_Dir_Con, self).__init__()
         '''
         para['freq'] = [fmin, fmax]                 [float, float]
@@ -434,117 +1441,163 @@ class Cal_Dir_Con(QThread):
         para['bandwidth'] = bandwidth               float
         para['adaptive'] = use_adaptive             bool
         para['chan'] = [chanx_get, chany_get]       
+        cache: instance of Multitaper_Cache shared between runs
+        n_jobs: number of worker processes over the channels
         '''
         self.data = data
         self.para = para
+        self.cache = cache if cache is not None else Multitaper_Cache()
+        self.n_jobs = n_jobs
         self.sfreq = self.data.info['sfreq']
 
     def run(self):
+        try:
+            self.calculate()
+        except Job_Cancelled:
+            print('连接计算已取消')
+            self.finish('cancelled')
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+
+    def calculate(self):
+        # the total number of channels comes with the first report
+        self.begin(1, 'channels')
         self.data.load_data()
         epoch = self.data.crop(tmin=self.para['time'][0], tmax=self.para['time'][1])
         times = epoch.times
-        epoch_0 = epoch.copy().pick_channels(self.para['chan'][0])
-        epoch_1 = epoch.copy().pick_channels(self.para['chan'][1])
-        data = {i: np.zeros ((epoch_1._data.shape[2], epoch_1._data.shape[0], 2))
-                for i in range (len (self.para['chan'][1]))}
-        for i in range (len (data)):
-            data[i][:, :, 0] = epoch_0._data.reshape (-1, epoch_0._data.shape[0])
-            data[i][:, :, 1] = epoch_1._data[:, i, :].reshape (-1, epoch_1._data.shape[0])
+        if self.para['bandwidth'] == None:
+            self.para['bandwidth'] = 3
+        chans = self.para['chan'][0][:1] + list(self.para['chan'][1])
+        coef, m = self.cache.fourier_coefficients(epoch, chans, self.para, n_jobs=self.n_jobs,
+                                                  callback=self.report)
+        index = [epoch.ch_names.index(chan) for chan in chans]
+        data = {i: epoch._data[:, [index[0], index[i + 1]], :].transpose((2, 0, 1))
+                for i in range(len(self.para['chan'][1]))}
         result = {i: None for i in range(len(data))}
-        if self.para['sliding'][0]:
-            for i in range(len (data)):
-                data_use = data[i]
-                if self.para['bandwidth'] == None:
-                    self.para['bandwidth'] = 3
-                m = Multitaper(data_use,
-                                sampling_frequency=self.sfreq,
-                                time_halfbandwidth_product=self.para['bandwidth'],
-                                time_window_duration=self.para['sliding'][1],
-                                time_window_step=self.para['sliding'][2],
-                                start_time=self.para['time'][0])
-                c = Connectivity (fourier_coefficients=m.fft(),
-                                  frequencies=m.frequencies,
-                                  time=m.time)
-                result[i] = [c, m]
-            self.spec_con_signal.emit([result, data, times])
-        else:
-            for i in range(len (data)):
-                data_use = data[i]
-                if self.para['bandwidth'] == None:
-                    self.para['bandwidth'] = 3
-                m = Multitaper(data_use,
-                                sampling_frequency=self.sfreq,
-                                time_halfbandwidth_product=self.para['bandwidth'],
-                                start_time=self.para['time'][0])
-                c = Connectivity (fourier_coefficients=m.fft(),
-                                  frequencies=m.frequencies,
-                                  time=m.time)
-                result[i] = [c, m]
-            self.spec_con_signal.emit ([result, data, times])
-
-
-class Cal_Time_Con(QThread):
+        for i in range(len(data)):
+            c = Connectivity(fourier_coefficients=coef[..., [0, i + 1]],
+                             frequencies=m.frequencies,
+                             time=m.time)
+            result[i] = [c, m]
+        self.finish()
+        self.spec_con_signal.emit([result, data, times])
+
+
+class Cal_Time_Con(Progress_Thread):
     from numpy import ndarray
     con_signal = pyqtSignal(ndarray, list, list)
 
-    def __init__(self, data, method, para):
+    # unit of the progress reported by each method
+    units = {'pearson': 'epochs', 'envelope': 'epochs', 'mutual information': 'windows',
+             'cross correlation': 'epochs', 'granger causality': 'epochs',
+             'transfer entropy': 'pairs'}
+
+    def __init__(self, data, method, para, n_jobs=1):
         super(Cal_Time_Con, self).__init__()
         self.data = data
         self.method = method
         self.para = para
+        # number of worker processes over the channel pairs
+        self.n_jobs = n_jobs
 
     def run(self):
         try:
-            from gui.my_func import get_pearson, get_spec_pearson, get_corr
+            self.calculate()
+        except Job_Cancelled:
+            print('连接计算已取消')
+            self.finish('cancelled')
+        except Exception as error:
+            show_error(error)
+            self.finish('failed')
+
+    def calculate(self):
+        try:
+            from gui.my_func import get_pearson, get_spec_pearson, get_corr, get_granger, \
+                get_transfer_entropy, get_mutual_info, get_envelope_corr
         except:
-            from my_func import get_pearson, get_spec_pearson, get_corr
+            from my_func import get_pearson, get_spec_pearson, get_corr, get_granger, \
+                get_transfer_entropy, get_mutual_info, get_envelope_corr
+        # the total comes with the first report, the pearson of all the
+        # channels is reported over blocks of channel rows
+        unit = self.units.get(self.method, '%')
+        if self.method == 'pearson' and self.para['plot_mode'][0]:
+            unit = 'channels'
+        self.begin(1, unit)
         data = self.data[self.para['event']].load_data()
         if self.method == 'pearson':
             if not self.para['plot_mode'][0]:
                 epochx = data.copy().pick_channels(self.para['chan'][0])
                 epochy = data.copy().pick_channels(self.para['chan'][1])
-                con = get_spec_pearson(epochx, epochy)
+                con = get_spec_pearson(epochx, epochy, n_jobs=self.n_jobs,
+                                       callback=self.report)
             else:
                 epochx, epochy = data, data
-                con = get_pearson(data)
+                con = get_pearson(data, n_jobs=self.n_jobs, callback=self.report)
         elif self.method == 'envelope':
+            # one band gives (n_chanx, n_chany), more bands are stacked on the last axis
+            bands = self.para.get('bands')
+            if bands is None and self.para.get('freq') is not None:
+                bands = [self.para['freq']]
+            env_para = dict(bands=bands, orthogonalize=self.para.get('orthogonalize', False),
+                            callback=self.report)
             if not self.para['plot_mode'][0]:
                 epochx = data.copy().pick_channels(self.para['chan'][0])
                 epochy = data.copy().pick_channels(self.para['chan'][1])
-                con = get_spec_pearson(epochx, epochy)
+                con = get_envelope_corr(epochx, epochy, **env_para)
             else:
                 epochx, epochy = data, data
-                con = mne.connectivity.envelope_correlation(data)
+                con = get_envelope_corr(data, **env_para)
+            if con.shape[-1] == 1:
+                con = con[..., 0]
         elif self.method == 'mutual information':
+            mi_para = dict(estimator=self.para.get('estimator', 'gcmi'),
+                           win=self.para.get('win'), step=self.para.get('step'),
+                           callback=self.report)
             if not self.para['plot_mode'][0]:
                 epochx = data.copy().pick_channels(self.para['chan'][0])
                 epochy = data.copy().pick_channels(self.para['chan'][1])
-                con = get_corr(epochx, epochy, baseline=self.para['baseline'])
+                con = get_mutual_info(epochx, epochy, **mi_para)
             else:
                 epochx, epochy = data, data
-                con = get_corr(data, data)
+                con = get_mutual_info(data, **mi_para)
+            if mi_para['win'] is not None:
+                # time-resolved, the window centers are kept in self.times
+                con, centers = con
+                self.times = data.times[centers]
         elif self.method == 'cross correlation':
             if not self.para['plot_mode'][0]:
                 epochx = data.copy().pick_channels(list(self.para['chan'][0]))
                 epochy = data.copy().pick_channels(self.para['chan'][1])
-                con = get_corr(epochx, epochy, baseline=self.para['baseline'], mode='same')
+                con = get_corr(epochx, epochy, baseline=self.para['baseline'], mode='same',
+                               n_jobs=self.n_jobs, callback=self.report)
             else:
                 epochx, epochy = data, data
-                con = get_corr(data, data, baseline=self.para['baseline'], mode='same')
+                con = get_corr(data, data, baseline=self.para['baseline'], mode='same',
+                               n_jobs=self.n_jobs, callback=self.report)
         elif self.method == 'granger causality':
+            # spectral granger causality is kept in self.gc_spec / self.freqs
             if not self.para['plot_mode'][0]:
                 epochx = data.copy().pick_channels(self.para['chan'][0])
                 epochy = data.copy().pick_channels(self.para['chan'][1])
-                con = get_corr(epochx, epochy, baseline=self.para['baseline'])
+                con, self.gc_spec, self.freqs = get_granger(epochx, epochy,
+                                                            order=self.para.get('order'),
+                                                            callback=self.report)
             else:
                 epochx, epochy = data, data
-                con = get_corr(data, data)
+                con, self.gc_spec, self.freqs = get_granger(data, order=self.para.get('order'),
+                                                            callback=self.report)
         elif self.method == 'transfer entropy':
+            # the chosen source lag of every pair is kept in self.lag
+            te_para = dict(lags=self.para.get('lags', (1, 2, 3, 4, 5)),
+                           estimator=self.para.get('estimator', 'binned'), n_jobs=self.n_jobs,
+                           callback=self.report)
             if not self.para['plot_mode'][0]:
                 epochx = data.copy().pick_channels(self.para['chan'][0])
                 epochy = data.copy().pick_channels(self.para['chan'][1])
-                con = get_corr(epochx, epochy, baseline=self.para['baseline'])
+                con, self.lag = get_transfer_entropy(epochx, epochy, **te_para)
             else:
                 epochx, epochy = data, data
-                con = get_corr(data, data)
+                con, self.lag = get_transfer_entropy(data, **te_para)
+        self.finish()
         self.con_signal.emit(con, epochx.ch_names, epochy.ch_names)
\ No newline at end of file
@@ -1,10 +1,585 @@
 import numpy as np
 import time
 import os
+from functools import lru_cache
+
+
+# channels of the recording system, not SEEG contacts
+DROP_CHAN = ['DC16', 'DC01', 'DC02', 'DC03', 'DC04', 'DC05', 'DC06',
+             'DC07', 'DC08', 'BP1', 'BP2', 'BP3', 'BP4', 'EKG1',
+             'EKG2', 'EMG1', 'EMG2', 'EMG3', 'EMG4', 'E', 'DC09', 'DC10',
+             'DC11', 'DC12', 'DC13', 'DC14', 'DC15']
+
+
+def _rename_chan(chan):
+    '''strip the prefix and the reference of a channel name'''
+    if 'POL' in chan:
+        chan = chan[4:]
+    if 'Ref' in chan:
+        chan = chan[4:-4]
+    return chan
+
+
+def _smart_pad(x, n_pad, pad='reflect_limited'):
+    '''
+    pad the last axis of x with its point reflection, zeros beyond its length,
+    or with its edge values if pad is 'edge'
+    '''
+    if pad == 'edge':
+        return np.concatenate([np.repeat(x[..., :1], n_pad, axis=-1), x,
+                               np.repeat(x[..., -1:], n_pad, axis=-1)], axis=-1)
+    n_reflect = min(n_pad, x.shape[-1] - 1)
+    zeros = np.zeros(x.shape[:-1] + (n_pad - n_reflect,))
+    left = 2 * x[..., :1] - x[..., n_reflect:0:-1]
+    right = 2 * x[..., -1:] - x[..., -2:-n_reflect - 2:-1]
+    return np.concatenate([zeros, left, x, right, zeros], axis=-1)
+
+
+def _fir_zero_phase(x, h, pad='reflect_limited'):
+    '''
+    zero-phase FIR filter along the last axis of x
+    :param x: numpy.array
+              shape (..., n_times)
+    :param h: numpy.array
+              odd-length symmetric kernel
+    :param pad: str
+                'reflect_limited' as mne for raw data, 'edge' for epochs
+    :return: numpy.array
+             shape (..., n_times)
+    '''
+    from scipy.signal import fftconvolve
+
+    # as mne, signals shorter than the kernel are padded by their length
+    n_pad = max(min(len(h), x.shape[-1]) - 1, 0)
+    x_pad = _smart_pad(x, n_pad, pad)
+    # the delay of the kernel is (len(h) - 1) / 2, the padding n_pad
+    start = n_pad + (len(h) - 1) // 2
+    kernel = np.reshape(h, (1,) * (x.ndim - 1) + (-1,))
+    return fftconvolve(x_pad, kernel, mode='full', axes=-1)[..., start:start + x.shape[-1]]
+
+
+def _fir_stream(read, out, h, step, callback=None):
+    '''
+    zero-phase FIR filter of a signal read block by block, by overlap-add
+    :param read: function
+                 read(start, stop) returns the samples start:stop of the
+                 signal, shape (n_chans, stop - start)
+    :param out: numpy.array
+                shape (n_chans, n_times), e.g. a np.memmap
+    :param h: numpy.array
+              odd-length symmetric kernel
+    :param step: int
+                 number of samples read at once
+    :param callback: function | None
+                     called with the number of samples done and n_times
+                     after every block
+    :return: numpy.array
+             out, the same as _fir_zero_phase(read(0, n_times), h)
+    '''
+    from scipy.signal import fftconvolve
+
+    n_times = out.shape[-1]
+    n_h = len(h)
+    n_pad = max(min(n_h, n_times) - 1, 0)
+    # out[:, i] is the sample start + i of the convolution of the padded signal
+    start = n_pad + (n_h - 1) // 2
+    kernel = h[np.newaxis]
+
+    def blocks():
+        yield _smart_pad(read(0, n_pad + 1), n_pad)[:, :n_pad]
+        for first in range(0, n_times, step):
+            yield read(first, min(first + step, n_times))
+        yield _smart_pad(read(n_times - n_pad - 1, n_times), n_pad)[:, 2 * n_pad + 1:]
+
+    def write(y, pos):
+        lo, hi = max(pos, start), min(pos + y.shape[-1], start + n_times)
+        if lo < hi:
+            out[:, lo - start:hi - start] = y[:, lo - pos:hi - pos]
+
+    # the convolution of a block overlaps the next n_h - 1 samples
+    overlap = np.zeros((out.shape[0], n_h - 1))
+    pos = 0
+    for x in blocks():
+        n = x.shape[-1]
+        if not n:
+            continue
+        y = fftconvolve(x, kernel, mode='full', axes=-1)
+        y[:, :n_h - 1] += overlap
+        write(y[:, :n], pos)
+        overlap = y[:, n:]
+        pos += n
+        if callback is not None:
+            callback(min(max(pos - n_pad, 0), n_times), n_times)
+    write(overlap, pos)
+    return out
+
+
+def _iir_stream(read, out, sos, padlen, step, callback=None):
+    '''
+    forward-backward IIR filter of a signal read block by block, the state
+    of the filter is carried from block to block; the forward pass is
+    written to out, then filtered backward block by block in reverse
+    :param read: function
+                 read(start, stop) returns the samples start:stop of the
+                 signal, shape (n_chans, stop - start)
+    :param out: numpy.array
+                shape (n_chans, n_times), e.g. a np.memmap
+    :param sos: numpy.array
+                second-order sections of the filter
+    :param padlen: int
+                   length of the odd extension at both ends
+    :param step: int
+                 number of samples read at once
+    :param callback: function | None
+                     called with the number of samples done and
+                     2 * n_times after every block, one per pass
+    :return: numpy.array
+             out, the same as sosfiltfilt(sos, read(0, n_times), padlen=padlen)
+    '''
+    from scipy.signal import sosfilt, sosfilt_zi
+
+    n_times = out.shape[-1]
+    padlen = min(int(padlen), n_times - 1)
+    zi = sosfilt_zi(sos)[:, np.newaxis, :]
+    # the odd extensions of scipy's sosfiltfilt
+    first, last = read(0, padlen + 1), read(n_times - padlen - 1, n_times)
+    left = 2 * first[:, :1] - first[:, padlen:0:-1]
+    right = 2 * last[:, -1:] - last[:, -2::-1]
+
+    start = left if padlen else first
+    state = zi * start[np.newaxis, :, :1]
+    if padlen:
+        _, state = sosfilt(sos, left, zi=state, axis=-1)
+    for begin in range(0, n_times, step):
+        stop = min(begin + step, n_times)
+        out[:, begin:stop], state = sosfilt(sos, read(begin, stop), zi=state, axis=-1)
+        if callback is not None:
+            callback(stop, 2 * n_times)
+    if padlen:
+        right, state = sosfilt(sos, right, zi=state, axis=-1)
+    end = right if padlen else out[:, -1:]
+
+    state = zi * end[np.newaxis, :, -1:]
+    if padlen:
+        _, state = sosfilt(sos, right[:, ::-1], zi=state, axis=-1)
+    for stop in range(n_times, 0, -step):
+        begin = max(stop - step, 0)
+        y, state = sosfilt(sos, out[:, begin:stop][:, ::-1], zi=state, axis=-1)
+        out[:, begin:stop] = y[:, ::-1]
+        if callback is not None:
+            callback(2 * n_times - begin, 2 * n_times)
+    return out
+
+
+def _resample_stream(read, out, n_times, up, down, step, callback=None):
+    '''
+    polyphase resampling by up / down of a signal read block by block, with
+    the anti-aliasing filter of scipy's resample_poly; beyond its ends the
+    signal is extended as _smart_pad does
+    :param read: function
+                 read(start, stop) returns the samples start:stop of the
+                 signal, shape (n_chans, stop - start)
+    :param out: numpy.array
+                shape (n_chans, n_out), e.g. a np.memmap, n_out is usually
+                round(n_times * up / down)
+    :param n_times: int
+                    number of samples of the signal
+    :param up: int
+    :param down: int
+                 coprime factors of the ratio of the sampling frequencies
+    :param step: int
+                 number of samples of out computed at once
+    :param callback: function | None
+                     called with the number of samples of out done and
+                     n_out after every block
+    :return: numpy.array
+             out
+    '''
+    from scipy.signal import firwin, upfirdn
+
+    n_out = out.shape[-1]
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0)) * up
+    # out[:, k] is the sum of x[:, n] * h[k * down - n * up + half_len],
+    # x reaches n_pad samples beyond both ends
+    n_pad = half_len // up + 2
+    n_edge = min(n_pad + 1, n_times)
+    head = _smart_pad(read(0, n_edge), n_pad)[:, :n_pad]
+    tail = _smart_pad(read(n_times - n_edge, n_times), n_pad)[:, n_edge + n_pad:]
+
+    def extended(start, stop):
+        parts = []
+        if start < 0:
+            parts.append(head[:, n_pad + start:n_pad + min(stop, 0)])
+        if start < n_times and stop > 0:
+            parts.append(read(max(start, 0), min(stop, n_times)))
+        if stop > n_times:
+            parts.append(tail[:, max(start, n_times) - n_times:stop - n_times])
+        return np.concatenate(parts, axis=-1)
+
+    for first in range(0, n_out, step):
+        last = min(first + step, n_out)
+        # the samples of x under the kernel for out[:, first:last]
+        start = -((half_len - first * down) // up)
+        stop = ((last - 1) * down + half_len) // up + 1
+        # delay the kernel so that out[:, first] is a sample of upfirdn
+        offset = first * down - start * up + half_len
+        delay = -offset % down
+        y = upfirdn(np.concatenate([np.zeros(delay), h]), extended(start, stop),
+                    up, down, axis=-1)
+        begin = (offset + delay) // down
+        out[:, first:last] = y[:, begin:begin + last - first]
+        if callback is not None:
+            callback(last, n_out)
+    return out
+
+
+@lru_cache(maxsize=4)
+def _dft_bins(n_times, first, last, n_fft):
+    '''cosines and sines of the bins first:last of an n_fft points DFT'''
+    phase = 2 * np.pi * np.outer(np.arange(n_times), np.arange(first, last)) / n_fft
+    return np.cos(phase), np.sin(phase)
+
+
+def _line_freq(x, sfreq, freq, track):
+    '''
+    frequency of the mains in x, the peak of the power summed over the
+    channels within freq +- track, refined by parabolic interpolation
+    '''
+    n_times = x.shape[-1]
+    n_fft = 2 * 2 ** int(np.ceil(np.log2(n_times)))
+    # the bins within the range and one more on each side
+    first = max(int(np.ceil((freq - track) * n_fft / sfreq)) - 1, 0)
+    last = min(int((freq + track) * n_fft / sfreq) + 2, n_fft // 2 + 1)
+    if last - first < 3:
+        return freq
+    # the spectrum at these bins only, much less than a full FFT
+    cos, sin = _dft_bins(n_times, first, last, n_fft)
+    x = x * np.hanning(n_times)
+    power = (x.dot(cos) ** 2 + x.dot(sin) ** 2).sum(0)
+    peak = np.argmax(power[1:-1]) + 1
+    left, center, right = np.log(power[peak - 1:peak + 2] + np.finfo(float).tiny)
+    curve = left - 2 * center + right
+    shift = 0.5 * (left - right) / curve if curve < 0 else 0.
+    return float(np.clip((first + peak + shift) * sfreq / n_fft, freq - track, freq + track))
+
+
+def _line_noise_stream(read, out, sfreq, freq=50., n_harmonics=None, window=4., track=0.,
+                       callback=None):
+    '''
+    remove the line noise and its harmonics by sinusoid regression in
+    sliding windows; in each window all the harmonics are fitted together,
+    for all the channels at once, and the fits of the half overlapping
+    windows are blended with a Hann taper
+    :param read: function
+                 read(start, stop) returns the samples start:stop of the
+                 signal, shape (n_chans, stop - start)
+    :param out: numpy.array
+                shape (n_chans, n_times), e.g. a np.memmap, or the signal
+                itself, a window is read before the samples it covers are
+                written
+    :param sfreq: float
+                  sampling frequency
+    :param freq: float
+                 frequency of the mains
+    :param n_harmonics: int | None
+                        number of multiples of freq removed, all those
+                        below the Nyquist frequency if None
+    :param window: float
+                   length of the windows in seconds
+    :param track: float
+                  if positive, the frequency of the mains is estimated in
+                  each window within freq +- track Hz
+    :param callback: function | None
+                     called with the number of samples done and n_times
+                     after every window
+    :return: numpy.array
+             out
+    '''
+    n_times = out.shape[-1]
+    nyq = sfreq / 2.
+    if n_harmonics is None:
+        n_harmonics = int(np.ceil(nyq / (freq + track))) - 1
+    if n_harmonics < 1 or n_harmonics * (freq + track) >= nyq:
+        raise ValueError('the harmonics of {} Hz should be below the Nyquist '
+                         'frequency {} Hz'.format(freq, nyq))
+    multiples = np.arange(1, n_harmonics + 1)
+    hop = max(int(round(window * sfreq / 2.)), 1)
+    # the halves of two consecutive windows sum to one
+    taper = 0.5 - 0.5 * np.cos(np.pi * np.arange(2 * hop) / hop)
+
+    # orthonormal bases of the sinusoids, the same for the windows of the
+    # same length without tracking
+    bases = dict()
+    # the fit of the last window on the samples not written yet
+    pending = 0.
+    for start in range(-hop, n_times, hop):
+        first, last = max(start, 0), min(start + 2 * hop, n_times)
+        x = read(first, last)
+        if last - first >= 4 * n_harmonics:
+            line = _line_freq(x, sfreq, freq, track) if track > 0 else freq
+            if (last - first, line) not in bases:
+                phase = 2 * np.pi * np.outer(np.arange(last - first) / sfreq, line * multiples)
+                design = np.concatenate([np.cos(phase), np.sin(phase)], axis=1)
+                if track > 0:
+                    bases.clear()
+                bases[(last - first, line)] = np.linalg.qr(design)[0]
+            basis = bases[(last - first, line)]
+            # least squares fit of the harmonics, all the channels at once
+            noise = taper[first - start:last - start] * x.dot(basis).dot(basis.T)
+        else:
+            # too short to fit the harmonics
+            noise = np.zeros(x.shape)
+        # the first half of this window completes the samples of the last one
+        middle = min(max(start + hop, first), last) - first
+        out[:, first:first + middle] = x[:, :middle] - (pending + noise[:, :middle])
+        pending = noise[:, middle:]
+        if callback is not None:
+            callback(first + middle, n_times)
+    return out
+
+
+class Preprocess_Pipeline(object):
+    """
+    Declarative preprocess pipeline of SEEG time series data
+
+    Parameters
+    ----------
+    steps : list of tuple
+        (name, para) of the steps run in order, name is one of
+        ('rename', {})                          strip 'POL ' and '-Ref' from the names
+        ('drop', {'chans': list of str})        drop the channels, missing ones are skipped
+        ('resample', {'sfreq': float})          resample the data
+        ('notch', {'freqs': list of float})     remove the line noise and its harmonics
+        ('line_noise', {'freq': float, 'n_harmonics': int, 'window': float, 'track': float})
+                                                the same by sinusoid regression in one pass,
+                                                see _line_noise_stream, only freq is needed
+        ('filter', {'low': float, 'high': float})
+                                                band-pass, high-pass or low-pass filter
+        Each step is used at most once, rename and drop come before the
+        steps on the samples.
+    method : 'fir' | 'iir'
+        Consecutive notch and filter steps are linear, they are fused into
+        one zero-phase FIR kernel, or one cascade of second-order sections
+        applied forward and backward, and run in a single pass per channel.
+    n_jobs : int
+        Number of threads over the blocks of channels.
+
+    Attributes
+    ----------
+    timing : dict
+        Seconds spent in each stage of the last run.
+    """
+
+    step_names = ['rename', 'drop', 'resample', 'notch', 'line_noise', 'filter']
+    # samples filtered at a time by one thread
+    block_samples = 10 ** 7
+
+    def __init__(self, steps, method='fir', n_jobs=1):
+        if method not in ['fir', 'iir']:
+            raise ValueError("method should be 'fir' or 'iir'")
+        self.steps = [(name, dict(para)) for name, para in steps]
+        self.method = method
+        self.n_jobs = max(int(n_jobs), 1)
+        self.timing = dict()
+        self.validate()
+
+    def validate(self, sfreq=None):
+        '''
+        check the step list, and the frequencies against sfreq if given
+        :param sfreq: float | None
+                      sampling frequency of the data to process
+        '''
+        names = [name for name, _ in self.steps]
+        for name in names:
+            if name not in self.step_names:
+                raise ValueError('Unknown step {}, steps should be in {}'
+                                 .format(name, self.step_names))
+            if names.count(name) > 1:
+                raise ValueError('Step {} is used more than once'.format(name))
+        for name in ['rename', 'drop']:
+            if name in names and any(names.index(name) > names.index(other)
+                                     for other in ['resample', 'notch', 'line_noise', 'filter']
+                                     if other in names):
+                raise ValueError('Step {} should come before resample, notch, line_noise '
+                                 'and filter'.format(name))
+        for name, para in self.steps:
+            if name == 'drop' and not isinstance(para.get('chans', DROP_CHAN), list):
+                raise TypeError('chans of drop should be a list of channels')
+            if name == 'resample':
+                if para.get('sfreq') is None or para['sfreq'] <= 0:
+                    raise ValueError('sfreq of resample should be positive')
+                sfreq = para['sfreq']
+            if name == 'notch':
+                freqs = np.atleast_1d(para.get('freqs', [])).astype(float)
+                if not len(freqs) or (freqs <= 0).any():
+                    raise ValueError('freqs of notch should be positive')
+                if sfreq is not None and (freqs >= sfreq / 2.).any():
+                    raise ValueError('freqs of notch should be below the Nyquist '
+                                     'frequency {} Hz'.format(sfreq / 2.))
+            if name == 'line_noise':
+                freq, track = para.get('freq'), para.get('track', 0.)
+                if freq is None or freq <= 0:
+                    raise ValueError('freq of line_noise should be positive')
+                if track < 0 or track >= freq:
+                    raise ValueError('track of line_noise should be between 0 and freq')
+                if para.get('window', 4.) <= 0:
+                    raise ValueError('window of line_noise should be positive')
+                if sfreq is not None and freq + track >= sfreq / 2.:
+                    raise ValueError('freq of line_noise should be below the Nyquist '
+                                     'frequency {} Hz'.format(sfreq / 2.))
+            if name == 'filter':
+                low, high = para.get('low'), para.get('high')
+                if low is None and high is None:
+                    raise ValueError('filter needs low, high or both')
+                if low is not None and high is not None and low >= high:
+                    raise ValueError('low of filter should be below high')
+                if sfreq is not None and high is not None and high >= sfreq / 2.:
+                    raise ValueError('high of filter should be below the Nyquist '
+                                     'frequency {} Hz'.format(sfreq / 2.))
+
+    def stages(self):
+        '''the steps with the consecutive notch and filter steps fused'''
+        stages = []
+        for name, para in self.steps:
+            if name in ['notch', 'filter']:
+                if len(stages) and stages[-1][0] == 'linear':
+                    stages[-1][1].append((name, para))
+                else:
+                    stages.append(('linear', [(name, para)]))
+            else:
+                stages.append((name, para))
+        return stages
+
+    def design(self, linear, sfreq):
+        '''
+        design the fused filter of the notch and filter steps
+        :return: numpy.array
+                 FIR kernel, or second-order sections for method='iir'
+        '''
+        from scipy.signal import butter, convolve
+        from mne.filter import create_filter
+
+        nyq = sfreq / 2.
+        kernels = []
+        for name, para in linear:
+            if name == 'notch':
+                # the same bands as mne notch_filter
+                freqs = np.atleast_1d(para['freqs']).astype(float)
+                widths = freqs / 200. if para.get('widths') is None else \
+                    np.broadcast_to(para['widths'], freqs.shape)
+                half = para.get('trans_bandwidth', 1.) / 2.
+                lows, highs = freqs - widths / 2. - half, freqs + widths / 2. + half
+                if self.method == 'fir':
+                    kernels.append(create_filter(None, sfreq, list(highs), list(lows),
+                                                 l_trans_bandwidth=half, h_trans_bandwidth=half,
+                                                 fir_design='firwin', verbose='error'))
+                else:
+                    kernels += [butter(2, [low / nyq, high / nyq], 'bandstop', output='sos')
+                                for low, high in zip(lows, highs)]
+            else:
+                low, high = para.get('low'), para.get('high')
+                if self.method == 'fir':
+                    kernels.append(create_filter(None, sfreq, low, high, fir_design='firwin',
+                                                 verbose='error'))
+                elif low is None:
+                    kernels.append(butter(4, high / nyq, 'lowpass', output='sos'))
+                elif high is None:
+                    kernels.append(butter(4, low / nyq, 'highpass', output='sos'))
+                else:
+                    kernels.append(butter(4, [low / nyq, high / nyq], 'bandpass', output='sos'))
+        if self.method == 'iir':
+            return np.concatenate(kernels, axis=0)
+        kernel = kernels[0]
+        for h in kernels[1:]:
+            kernel = convolve(kernel, h)
+        return kernel
+
+    def apply_linear(self, data, kernel):
+        '''filter the rows of data in place, blocks of channels on a thread pool'''
+        from concurrent.futures import ThreadPoolExecutor
+        from scipy.signal import sosfiltfilt
+
+        block = max(int(self.block_samples // max(data.shape[-1], 1)), 1)
+        blocks = [slice(start, min(start + block, len(data)))
+                  for start in range(0, len(data), block)]
+
+        def run(rows):
+            if self.method == 'fir':
+                data[rows] = _fir_zero_phase(data[rows], kernel)
+            else:
+                data[rows] = sosfiltfilt(kernel, data[rows], axis=-1)
+
+        if self.n_jobs == 1:
+            for rows in blocks:
+                run(rows)
+        else:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                list(pool.map(run, blocks))
+
+    def run(self, seeg, fname=None):
+        """
+        Run the steps on seeg
+
+        Parameters
+        ----------
+        seeg : instance of BaseRaw
+            SEEG time series, loaded if read lazily, modified in place.
+        fname : str | None
+            File to save the result to once all the steps are done.
+
+        Returns
+        -------
+        seeg : instance of BaseRaw
+            Preprocessed SEEG time series.
+        """
+        self.validate(seeg.info['sfreq'])
+        self.timing = dict()
+        for name, para in self.stages():
+            print('============================')
+            start = time.time()
+            if name == 'rename':
+                print('Start Renaming channels')
+                mapping = {chan: _rename_chan(chan) for chan in seeg.ch_names}
+                seeg.rename_channels({chan: new for chan, new in mapping.items() if new != chan})
+            elif name == 'drop':
+                print('Start Dropping channels')
+                drop_chan = para.get('chans', DROP_CHAN)
+                seeg.drop_channels([chan for chan in drop_chan if chan in seeg.ch_names])
+            elif name == 'resample':
+                print('Start Resampling channels')
+                seeg = seeg.load_data().resample(para['sfreq'])
+            elif name == 'line_noise':
+                print('Start Removing line noise')
+                data = seeg.load_data()._data
+                _line_noise_stream(lambda start, stop: data[:, start:stop], data,
+                                   seeg.info['sfreq'], **para)
+            else:
+                name = '+'.join(step for step, _ in para)
+                print('Start Filtering channels ({}, fused {})'.format(name, self.method))
+                seeg.load_data()
+                self.apply_linear(seeg._data, self.design(para, seeg.info['sfreq']))
+                for step, step_para in para:
+                    low, high = step_para.get('low'), step_para.get('high')
+                    if step == 'filter' and low is not None and low > seeg.info['highpass']:
+                        seeg.info['highpass'] = float(low)
+                    if step == 'filter' and high is not None and high < seeg.info['lowpass']:
+                        seeg.info['lowpass'] = float(high)
+            self.timing[name] = time.time() - start
+            print('Using time {:.2f} seconds'.format(self.timing[name]))
+        print('============================')
+        if fname is not None:
+            print('Saving SEEG')
+            start = time.time()
+            seeg.save(fname)
+            self.timing['save'] = time.time() - start
+        return seeg
 
 
 def preprocess(seeg, path, name, sfreq=1000, low=0.5, high=200,
-               rename=True, drop_chan=True):
+               rename=True, drop_chan=True, method='fir', n_jobs=1,
+               line_noise='notch', track=0.):
     """
     Preprocess pipeline of SEEG time series data
 
@@ -24,6 +599,17 @@ def preprocess(seeg, path, name, sfreq=1000, low=0.5, high=200,
         Rename channels. The default is False.
     drop_chan :list of str | bool
         Drop useless channels. The default is True.
+    method : 'fir' | 'iir'
+        The notch filters at 50, 100 and 150 Hz and the band-pass filter
+        are fused into one filter of this type. The default is 'fir'.
+    n_jobs : int
+        Number of threads filtering the channels. The default is 1.
+    line_noise : 'notch' | 'regression'
+        Remove 50 Hz and its harmonics with notch filters, or by sinusoid
+        regression before the band-pass filter. The default is 'notch'.
+    track : float
+        With regression, the line frequency is tracked within 50 +- track
+        Hz. The default is 0, no tracking.
 
     Returns
     -------
@@ -31,60 +617,21 @@ def preprocess(seeg, path, name, sfreq=1000, low=0.5, high=200,
         SEEG time series.
 
     """
+    steps = []
     if rename:
-        print('============================')
-        print('Start Renaming channels')
-        start = time.time()
-        seeg.rename_channels({chan: chan[4:]
-                                   for chan in seeg.ch_names
-                                   if 'POL' in chan})
-        seeg.rename_channels({chan: chan[4:-4]
-                                   for chan in seeg.ch_names
-                                   if 'Ref' in chan})
-        end = time.time()
-        print('Finish Renaming channels')
-        print('Using time {:.2f} seconds'.format(end - start))
-        print('============================')
+        steps.append(('rename', {}))
     if rename and (drop_chan == True):
-        print('Start Dropping channels')
-        start = time.time()
-        drop_chan = ['DC16', 'DC01', 'DC02', 'DC03', 'DC04', 'DC05', 'DC06',
-                     'DC07', 'DC08', 'BP1', 'BP2', 'BP3', 'BP4', 'EKG1',
-                     'EKG2', 'EMG1', 'EMG2', 'EMG3', 'EMG4', 'E', 'DC09', 'DC10',
-                     'DC11', 'DC12', 'DC13', 'DC14', 'DC15']
-        for chan in drop_chan:
-            try:
-                seeg.drop_channels(chan)
-            except:
-                pass
-        end = time.time()
-        print('Finish Dropping channels')
-        print('Using time {:.2f} seconds'.format(end - start))
-        print('============================')
-    print('Start Resampling channels')
-    start = time.time()
-    seeg = seeg.resample(sfreq)
-    end = time.time()
-    print('Finish Resampling channels')
-    print('Using time {:.2f} seconds'.format(end - start))
-    print('============================')
-    print('Start Filtering channels')
-    start = time.time()
-    seeg.notch_filter(50)
-    print('============================')
-    seeg.notch_filter(100)
-    print('============================')
-    seeg.notch_filter(150)
-    print('============================')
-    seeg.filter(low, high)
-    end = time.time()
-    print('Finish Filtering channels')
-    print('Using time {:.2f} seconds'.format(end - start))
-    print('============================')
-    print('Saving SEEG')
-    seeg.save(os.path.join(path, name + '.fif'))
-
-    return seeg
+        steps.append(('drop', {'chans': DROP_CHAN}))
+    steps.append(('resample', {'sfreq': sfreq}))
+    if line_noise == 'regression':
+        steps.append(('line_noise', {'freq': 50., 'track': track}))
+    elif line_noise == 'notch':
+        steps.append(('notch', {'freqs': [50, 100, 150]}))
+    else:
+        raise ValueError("line_noise should be 'notch' or 'regression'")
+    steps.append(('filter', {'low': low, 'high': high}))
+    pipeline = Preprocess_Pipeline(steps, method=method, n_jobs=n_jobs)
+    return pipeline.run(seeg, os.path.join(path, name + '.fif'))
 
 
 def get_chan_group(raw=None, chans=None):
@@ -20,12 +20,16 @@ from mne.io import BaseRaw
 import mne
 try:
     from gui.re_ref import get_chan_group
-    from gui.my_func import new_layout
-    from gui.my_thread import Calculate_Power, Calculate_PSD, Cal_Spec_Con, Cal_Dir_Con
+    from gui.my_func import new_layout, plot_sensors_connectivity
+    from gui.my_class import Tri_Con
+    from gui.my_thread import Calculate_Power, Calculate_PSD, Cal_Spec_Con, Cal_Dir_Con, \
+                              Multitaper_Cache, stop_worker
 except:
     from re_ref import get_chan_group
-    from my_func import new_layout
-    from my_thread import Calculate_Power, Calculate_PSD, Cal_Spec_Con, Cal_Dir_Con
+    from my_func import new_layout, plot_sensors_connectivity
+    from my_class import Tri_Con
+    from my_thread import Calculate_Power, Calculate_PSD, Cal_Spec_Con, Cal_Dir_Con, \
+                          Multitaper_Cache, stop_worker
 
 def show_error(error):
     print('*********************************************************************')
@@ -36,14 +40,20 @@ def show_error(error):
 
 class My_Progress(QMainWindow):
 
-    def __init__(self, delay=0):
+    def __init__(self, delay=0, worker=None):
         super(My_Progress, self).__init__()
         self.step = 0
         self.delay = delay
+        # a Progress_Thread, once it reports the bar follows its progress
+        # instead of the timer
+        self.worker = worker
+        self.reported = False
         self.init_ui()
+        if worker is not None:
+            worker.progress_signal.connect(self.update_progress)
 
     def init_ui(self):
-        self.setFixedHeight(50)
+        self.setFixedHeight(80)
         self.setFixedWidth(500)
         self.setStyleSheet("background-color:gray")
         self.setWindowFlags(Qt.WindowStaysOnTopHint |
@@ -80,6 +90,12 @@ class My_Progress(QMainWindow):
         self.pbar.setMaximum(100)
 
         self.wait_label = QLabel('Running: ')
+        self.info_label = QLabel('')
+
+        self.cancel_btn = QPushButton(self)
+        self.cancel_btn.setText('Cancel')
+        self.cancel_btn.setEnabled(self.worker is not None)
+        self.cancel_btn.clicked.connect(self.cancel)
 
         self.timer = QBasicTimer()
         self.timer.start(100, self)
@@ -88,8 +104,59 @@ class My_Progress(QMainWindow):
         layout_0 = QHBoxLayout()
         layout_0.addWidget(self.wait_label)
         layout_0.addWidget(self.pbar)
+        layout_0.addWidget(self.cancel_btn)
 
-        self.center_widget.setLayout(layout_0)
+        main_layout = QVBoxLayout()
+        main_layout.addLayout(layout_0)
+        main_layout.addWidget(self.info_label)
+
+        self.center_widget.setLayout(main_layout)
+
+    @staticmethod
+    def format_amount(amount, unit):
+        if unit == 'bytes':
+            return '{:.1f} MB'.format(amount / 2 ** 20)
+        return '{} {}'.format(int(amount), unit)
+
+    @staticmethod
+    def format_time(seconds):
+        if seconds is None:
+            return '--:--'
+        minutes, seconds = divmod(int(seconds), 60)
+        return '{:02d}:{:02d}'.format(minutes, seconds)
+
+    def update_progress(self, info):
+        '''show a report of the worker, see Progress_Thread'''
+        if info['state'] != 'running':
+            # closed on the next timer event
+            self.step = 100
+            return
+        self.reported = True
+        self.step = min(int(info['percent']), 99)
+        if info['unit'] == '%':
+            amount = ''
+        else:
+            amount = '{} / {}    '.format(self.format_amount(info['done'], info['unit']),
+                                          self.format_amount(info['total'], info['unit']))
+        self.info_label.setText(amount + 'elapsed {}    left {}'.format(
+            self.format_time(info['elapsed']), self.format_time(info['eta'])))
+
+    def cancel(self):
+        '''cancel the job of the worker, closed once the worker stops'''
+        if self.worker is not None:
+            self.worker.cancel()
+        self.wait_label.setText('Cancelling: ')
+        self.cancel_btn.setEnabled(False)
+
+    def closeEvent(self, event):
+        # the workers are reused, the next job reports to a new window
+        if self.worker is not None:
+            try:
+                self.worker.progress_signal.disconnect(self.update_progress)
+            except TypeError:
+                pass
+            self.worker = None
+        event.accept()
 
     def timerEvent(self, event):
         self.pbar.setValue(self.step)
@@ -97,7 +164,7 @@ class My_Progress(QMainWindow):
             self.timer.stop()
             self.step = 0
             self.close()
-        if self.step < 90:
+        if self.step < 90 and not self.reported:
             self.step += 1
             time.sleep(self.delay)
 
@@ -2627,8 +2694,11 @@ class Time_Freq_Win(QMainWindow):
         self.tfr_btn.setStyleSheet("QPushButton{font-size: 8pt}")
         self.erpim_topo_btn.setStyleSheet("QPushButton{font-size: 8pt}")
 
-    def show_pbar(self):
-        self.pbar = My_Progress()
+    def show_pbar(self, worker=None):
+        if getattr(self, 'pbar', None) is not None:
+            # the window of a replaced job
+            self.pbar.close()
+        self.pbar = My_Progress(worker=worker)
         self.pbar.show()
 
     def image_map(self):
@@ -2706,11 +2776,12 @@ class Time_Freq_Win(QMainWindow):
         if None in freq:
             pass
         else:
-            self.show_pbar()
             data = self.data[event]
+            stop_worker(getattr(self, 'calcu_psd_thread', None))
             self.calcu_psd_thread = Calculate_Power(data=data, method=method, chan_num=chan_num, freq=freq, time=time,
                                                   use_fft=use_fft, show_itc=show_itc)
             self.calcu_psd_thread.power_signal.connect(self.plot_tfr)
+            self.show_pbar(self.calcu_psd_thread)
             self.calcu_psd_thread.start()
 
     def plot_tfr(self, power, chan_num, time, itc):
@@ -2729,15 +2800,16 @@ class Time_Freq_Win(QMainWindow):
         self.tfr_para_win.show()
 
     def cal_tfr_topo(self, method, event, freq, time, use_fft, show_itc):
-        self.show_pbar()
         data = self.data
         if None in freq:
             pass
         else:
             if isinstance(data, BaseEpochs):
+                stop_worker(getattr(self, 'power_thread', None))
                 self.power_thread = Calculate_Power(data=data, method=method, chan_num=None, freq=freq,
                                                     time=time, use_fft=use_fft, show_itc=show_itc)
                 self.power_thread.power_signal.connect(self.plot_tfr_topo)
+                self.show_pbar(self.power_thread)
                 self.power_thread.start()
 
     def plot_tfr_topo(self, power, chan_num, baseline, itc):
@@ -2756,9 +2828,10 @@ class Time_Freq_Win(QMainWindow):
         if None in freq:
             pass
         else:
-            self.show_pbar()
+            stop_worker(getattr(self, 'calcu_psd_thread', None))
             self.calcu_psd_thread = Calculate_PSD(self.data, method, freq, time, nfft, average)
             self.calcu_psd_thread.psd_signal.connect(self.plot_psd)
+            self.show_pbar(self.calcu_psd_thread)
             self.calcu_psd_thread.start()
 
     def plot_psd(self, method, psds_mean, psds_std, freqs):
@@ -2795,16 +2868,14 @@ class Pic_Change(QMainWindow):
         super(Pic_Change, self).__init__()
         self.num = 0
         self.diagonal = diagonal
-        if isinstance(matrix, np.ndarray):
+        if isinstance(matrix, (np.ndarray, Tri_Con)):
             self.matrix = matrix
-        self.matrix_plot = self.matrix[:, :, self.num]
-        if not self.diagonal: # if the data has not been diagnoaled yet, then do it
-            self.matrix_plot += self.matrix_plot.T - np.diag(self.matrix_plot.diagonal())
+        self.matrix_plot = self.get_frame()
         self.title = title
         if n_times.any():
             self.n_times = np.array(n_times)
         else:
-            self.n_times = np.arange (self.matrix_plot.shape[2])
+            self.n_times = np.arange (self.matrix.shape[2])
         self.domain = domain
         self.init_ui()
 
@@ -2881,10 +2952,17 @@ class Pic_Change(QMainWindow):
         self.toolbar_stack.addWidget(self.toolbar)
         self.toolbar_stack.setFixedHeight(38)
 
+    def get_frame(self):
+        '''get the dense matrix of the current frame'''
+        if isinstance(self.matrix, Tri_Con):
+            return self.matrix.frame(self.num)
+        matrix_plot = self.matrix[:, :, self.num]
+        if not self.diagonal: # if the data has not been diagnoaled yet, then do it
+            matrix_plot = matrix_plot + matrix_plot.T - np.diag(matrix_plot.diagonal())
+        return matrix_plot
+
     def change_canvas(self):
-        self.matrix_plot = self.matrix[:, :, self.num]
-        if not self.diagonal:
-            self.matrix_plot += self.matrix_plot.T - np.diag(self.matrix_plot.diagonal())
+        self.matrix_plot = self.get_frame()
         self.image.set_data(self.matrix_plot)
         if self.domain == 'time':
             self.ax.set_title(self.title + ' ' + '(' + 'time:' + '' +
@@ -3638,13 +3716,18 @@ class Freq_Con_Method_Win(QMainWindow):
 
 class Con_Win(QMainWindow):
 
-    def __init__(self, data, subject):
+    def __init__(self, data, subject, n_jobs=None):
         super(Con_Win, self).__init__()
         if isinstance(data, BaseEpochs):
             self.data = data
         else:
             raise TypeError('This is not an epoch data')
         self.subject = subject
+        # worker processes for the connectivity, keep one core for the GUI
+        if n_jobs is None:
+            import os
+            n_jobs = max((os.cpu_count() or 1) - 1, 1)
+        self.n_jobs = n_jobs
         self.group = len(get_chan_group(self.data))
         self.spec_con_method = dict()
         self.spec_con_method['coh'] = 'Coherence'
@@ -3657,8 +3740,15 @@ class Con_Win(QMainWindow):
         self.spec_con_method['wpli'] = 'Weighted Phase Lag Index (WPLI)'
         self.spec_con_method['wpli2_debiased'] = 'Debiased estimator of squared WPLI'
         self.spec_con_method['psi'] = 'Phase Slope Index'
+        # fourier coefficients reused when only the connectivity method changes
+        self.mt_cache = Multitaper_Cache()
         self.init_ui()
 
+    def closeEvent(self, event):
+        # the spectra are only reused by this window
+        self.mt_cache.clear()
+        event.accept()
+
     def init_ui(self):
         self.setWindowTitle('Connectivity Analysis')
         self.setFixedHeight(290)
@@ -3871,8 +3961,11 @@ class Con_Win(QMainWindow):
     # Connecivity analysis
     #
     # Time domain connecivity
-    def show_pbar(self):
-        self.pbar = My_Progress()
+    def show_pbar(self, worker=None):
+        if getattr(self, 'pbar', None) is not None:
+            # the window of a replaced job
+            self.pbar.close()
+        self.pbar = My_Progress(worker=worker)
         self.pbar.show()
 
     # Frequency domain connectivity (Spectral)
@@ -3985,17 +4078,19 @@ class Con_Win(QMainWindow):
         self.con_win.show()
 
     def calculate_con(self, para, mode):
-        self.show_pbar()
         epoch = self.data[para['event']]
         self.para = para
+        stop_worker(getattr(self, 'calcu_con', None))
         if mode == 'Multitaper':
-            self.calcu_con = Cal_Spec_Con(epoch, para=self.para, method=self.method, mode=mode)
+            self.calcu_con = Cal_Spec_Con(epoch, para=self.para, method=self.method, mode=mode,
+                                          cache=self.mt_cache, n_jobs=self.n_jobs)
             self.calcu_con.spec_con_signal.connect(self.plot_spec_con)
-            self.calcu_con.start()
         else:
-            self.calcu_con = Cal_Spec_Con(epoch, para=self.para, method=self.method, mode=mode)
+            self.calcu_con = Cal_Spec_Con(epoch, para=self.para, method=self.method, mode=mode,
+                                          n_jobs=self.n_jobs)
             self.calcu_con.spec_con_signal.connect(self.plot_morlet_con)
-            self.calcu_con.start()
+        self.show_pbar(self.calcu_con)
+        self.calcu_con.start()
 
     def plot_time(self, con_list):
         import matplotlib.pyplot as plt
@@ -4109,9 +4204,12 @@ class Con_Win(QMainWindow):
         if self.para['average']:
             if self.para['plot_mode'][1]:
                 con = con_list[0]
-                mne.viz.plot_sensors_connectivity(self.data.info, con)
+                picks = self.para['chan'][0] if isinstance(self.para['chan'][0], list) else None
+                plot_sensors_connectivity(self.data.info, con, picks=picks)
             else:
                 con = con_list[0]
+                if isinstance(con, Tri_Con):
+                    con = con.frame(0)
                 fig, ax = plt.subplots()
                 image = ax.matshow(con[:, :])
                 fig.colorbar(image)
@@ -4187,11 +4285,12 @@ class Con_Win(QMainWindow):
         self.con_win.show ()
 
     def cal_dir_con(self, para, mode):
-        self.show_pbar()
         epoch = self.data[para['event']]
         self.para = para
-        self.cal_con = Cal_Dir_Con(data=epoch, para=para)
+        stop_worker(getattr(self, 'cal_con', None))
+        self.cal_con = Cal_Dir_Con(data=epoch, para=para, cache=self.mt_cache, n_jobs=self.n_jobs)
         self.cal_con.spec_con_signal.connect(self.plot_dir_con)
+        self.show_pbar(self.cal_con)
         self.cal_con.start()
 
     def plot_dir_con(self, con_list):